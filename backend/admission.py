@@ -0,0 +1,321 @@
+"""
+Admission control and load shedding for evaluation endpoints
+
+Evaluation requests (POST /evaluate, /evaluate/raw, /evaluate/batch and /rules/{id}/simulate)
+pass through an admission controller before they reach the threadpool. At most `limit` of
+them run at once; the rest wait in a bounded queue ordered by priority class, then arrival.
+Requests that cannot be served in time are rejected at once instead of timing out:
+
+- 429 when the queue is full and the request does not outrank anything in it
+- 503 when a request waited longer than its class allows, or was pushed out of a full
+  queue by a higher-priority one
+
+Both carry a Retry-After header estimated from the queue length and recent latency.
+
+Priority classes, highest first: critical, default, batch. A caller's class comes from the
+X-Caller header (ADMISSION_CALLER_CLASSES, e.g. "fraud-service=critical,reporting=batch"),
+else from the event type (ADMISSION_EVENT_TYPE_CLASSES, e.g. "payment=critical"), else it is
+"default". Batch requests may use only ADMISSION_BATCH_SHARE of the limit, so a batch spike
+leaves the rest of the capacity to the other classes.
+
+A POST /evaluate/batch request takes one slot for all of its events. Its latency grows with
+its size, so it does not feed the latency averages below.
+
+The limit adapts to observed latency with a gradient rule: it shrinks when recent latency
+rises above the long-term baseline and grows while latency stays near it, between
+ADMISSION_MIN_LIMIT and ADMISSION_MAX_LIMIT. Admitted, shed and queue-time metrics are
+exported at GET /metrics.
+
+All controller state is touched only from the event loop, so it needs no locks.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+from fast_ingest import InvalidPayload, RawEvaluateRequest
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "20"))
+MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "4"))
+MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "200"))
+QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))
+BATCH_SHARE = float(os.getenv("ADMISSION_BATCH_SHARE", "0.5"))
+
+# Many events per request; see evaluate_batch in main.py
+BATCH_PATH = "/evaluate/batch"
+
+CLASSES = ("critical", "default", "batch")
+PRIORITY = {name: i for i, name in enumerate(CLASSES)}
+# Longest time each class may wait for a slot, in ms
+MAX_WAIT_MS = {
+    "critical": float(os.getenv("ADMISSION_MAX_WAIT_MS_CRITICAL", "1000")),
+    "default": float(os.getenv("ADMISSION_MAX_WAIT_MS", "500")),
+    "batch": float(os.getenv("ADMISSION_MAX_WAIT_MS_BATCH", "100")),
+}
+
+# Gradient limit: how far recent latency may exceed the baseline before the limit shrinks,
+# and how quickly the limit and the two latency averages move
+TOLERANCE = 1.5
+SMOOTHING = 0.2
+SHORT_ALPHA = 0.1
+LONG_ALPHA = 0.005
+
+def parse_classes(spec: str) -> Dict[str, str]:
+    """"name=class,name=class" -> {name: class}; unknown classes are ignored with a warning"""
+    classes = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, cls = item.partition("=")
+        if cls.strip() not in PRIORITY:
+            logger.warning(f"Ignoring admission class {item!r}: class must be one of {', '.join(CLASSES)}")
+            continue
+        classes[name.strip()] = cls.strip()
+    return classes
+
+_metrics = get_metrics()
+ADMITTED = _metrics.counter("admission_admitted_total", "Evaluation requests admitted", ("priority_class",))
+SHED = _metrics.counter("admission_shed_total", "Evaluation requests rejected by admission control", ("priority_class", "reason"))
+QUEUE_SECONDS = _metrics.histogram("admission_queue_seconds", "Time admitted requests waited for a slot", ("priority_class",))
+
+class Rejected(Exception):
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+class AdmissionController:
+    """Adaptive concurrency limit with a bounded priority wait queue"""
+
+    def __init__(self, initial_limit: int = INITIAL_LIMIT, min_limit: int = MIN_LIMIT, max_limit: int = MAX_LIMIT,
+                 queue_size: int = QUEUE_SIZE, batch_share: float = BATCH_SHARE,
+                 max_wait_ms: Optional[Dict[str, float]] = None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.batch_share = batch_share
+        self.max_wait = {cls: ms / 1000 for cls, ms in (max_wait_ms or MAX_WAIT_MS).items()}
+        self.in_flight = 0
+        self.batch_in_flight = 0
+        # (priority, arrival, future, class); removed entries are skipped lazily
+        self._queue: List[Tuple[int, int, asyncio.Future, str]] = []
+        self._queued = 0
+        self._arrivals = itertools.count()
+        self.short_rtt: Optional[float] = None
+        self.long_rtt: Optional[float] = None
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _capacity(self, cls: str) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        if cls == "batch":
+            return self.batch_in_flight < max(1, int(self.limit * self.batch_share))
+        return True
+
+    def _start(self, cls: str):
+        self.in_flight += 1
+        if cls == "batch":
+            self.batch_in_flight += 1
+
+    async def acquire(self, cls: str) -> float:
+        """Wait for a slot; returns the time spent queued or raises Rejected"""
+        # Waiters only remain while there is capacity if they are batch requests over their share
+        if self._capacity(cls):
+            self._start(cls)
+            return 0.0
+
+        if self._queued >= self.queue_size and not self._evict_below(PRIORITY[cls]):
+            raise Rejected(429, "queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (PRIORITY[cls], next(self._arrivals), future, cls)
+        heapq.heappush(self._queue, entry)
+        self._queued += 1
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait[cls])
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self._queued -= 1
+                raise Rejected(503, "timeout")
+        except asyncio.CancelledError:
+            # The client went away while queued; give back a slot granted in the meantime
+            if future.done() and not future.cancelled() and future.result():
+                self.release(cls, None)
+            elif not future.done():
+                future.cancel()
+                self._queued -= 1
+            raise
+        if not future.result():
+            raise Rejected(503, "evicted")
+        return time.perf_counter() - queued_at
+
+    def _evict_below(self, priority: int) -> bool:
+        """Reject the newest waiter of the lowest class below `priority` to make room"""
+        victim = None
+        for entry in self._queue:
+            if entry[2].done() or entry[0] <= priority:
+                continue
+            if victim is None or (entry[0], entry[1]) > (victim[0], victim[1]):
+                victim = entry
+        if victim is None:
+            return False
+        victim[2].set_result(False)
+        self._queued -= 1
+        return True
+
+    def release(self, cls: str, latency: Optional[float]):
+        """Free a slot, update the limit with the request's latency and admit waiters"""
+        self.in_flight -= 1
+        if cls == "batch":
+            self.batch_in_flight -= 1
+        if latency is not None:
+            self._update_limit(latency)
+        self._grant()
+
+    def _grant(self):
+        skipped = []
+        while self._queue and self.in_flight < int(self.limit):
+            entry = heapq.heappop(self._queue)
+            future, cls = entry[2], entry[3]
+            if future.done():
+                continue
+            if not self._capacity(cls):
+                # Batch share used up: later batch waiters stay queued, other classes may go
+                skipped.append(entry)
+                continue
+            self._queued -= 1
+            self._start(cls)
+            future.set_result(True)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def _update_limit(self, latency: float):
+        if self.short_rtt is None:
+            self.short_rtt = self.long_rtt = latency
+            return
+        self.short_rtt += SHORT_ALPHA * (latency - self.short_rtt)
+        self.long_rtt += LONG_ALPHA * (latency - self.long_rtt)
+        # Let the baseline follow a lasting drop in latency quickly
+        if self.long_rtt > 2 * self.short_rtt:
+            self.long_rtt *= 0.95
+        # Only grow while the limit is actually being used
+        if self.in_flight < self.limit / 2 and self.short_rtt <= self.long_rtt * TOLERANCE:
+            return
+        gradient = max(0.5, min(1.0, TOLERANCE * self.long_rtt / max(self.short_rtt, 1e-9)))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - SMOOTHING) + target * SMOOTHING
+        self.limit = max(float(self.min_limit), min(float(self.max_limit), limit))
+
+    def retry_after(self) -> int:
+        """Seconds until a retry is likely to be admitted"""
+        latency = self.short_rtt or 0.0
+        return max(1, math.ceil((self._queued + 1) * latency / max(1, int(self.limit))))
+
+    def snapshot(self) -> Dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "short_latency_ms": round(self.short_rtt * 1000, 3) if self.short_rtt is not None else None,
+            "long_latency_ms": round(self.long_rtt * 1000, 3) if self.long_rtt is not None else None,
+        }
+
+_controller = AdmissionController()
+_metrics.gauge("admission_limit", "Current adaptive concurrency limit", function=lambda: int(_controller.limit))
+_metrics.gauge("admission_in_flight", "Evaluation requests running", function=lambda: _controller.in_flight)
+_metrics.gauge("admission_queued", "Evaluation requests waiting for a slot", function=lambda: _controller.queued)
+
+def get_admission_controller() -> AdmissionController:
+    return _controller
+
+def is_evaluation_request(scope: Dict) -> bool:
+    if scope["type"] != "http" or scope["method"] != "POST":
+        return False
+    path = scope["path"]
+    return path in ("/evaluate", "/evaluate/raw", BATCH_PATH) or (path.startswith("/rules/") and path.endswith("/simulate"))
+
+class AdmissionMiddleware:
+    """ASGI middleware applying the admission controller to evaluation requests"""
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None):
+        self.app = app
+        self.controller = controller or _controller
+        self.caller_classes = parse_classes(os.getenv("ADMISSION_CALLER_CLASSES", ""))
+        self.event_type_classes = parse_classes(os.getenv("ADMISSION_EVENT_TYPE_CLASSES", ""))
+
+    async def __call__(self, scope, receive, send):
+        if not ENABLED or not is_evaluation_request(scope):
+            await self.app(scope, receive, send)
+            return
+
+        cls, receive = await self._classify(scope, receive)
+        try:
+            waited = await self.controller.acquire(cls)
+        except Rejected as rejected:
+            SHED.inc(priority_class=cls, reason=rejected.reason)
+            response = JSONResponse(
+                {"detail": f"Server overloaded ({rejected.reason.replace('_', ' ')}), retry later"},
+                status_code=rejected.status,
+                headers={"Retry-After": str(self.controller.retry_after())}
+            )
+            await response(scope, receive, send)
+            return
+
+        ADMITTED.inc(priority_class=cls)
+        QUEUE_SECONDS.observe(waited, priority_class=cls)
+        started = time.perf_counter()
+        latency = None
+        try:
+            await self.app(scope, receive, send)
+            if scope["path"] != BATCH_PATH:
+                latency = time.perf_counter() - started
+        finally:
+            # Failed requests free their slot but say nothing about healthy latency
+            self.controller.release(cls, latency)
+
+    async def _classify(self, scope, receive):
+        """The request's priority class, and a receive callable that still yields the body"""
+        headers = dict(scope["headers"])
+        caller = headers.get(b"x-caller", b"").decode("latin-1")
+        if caller in self.caller_classes:
+            return self.caller_classes[caller], receive
+        if not self.event_type_classes or scope["path"] not in ("/evaluate", "/evaluate/raw"):
+            return "default", receive
+
+        # Read the body once to find event.type, then replay it to the endpoint
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return "default", receive
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        try:
+            event_type = RawEvaluateRequest(body, {"event.type"}).event.get("type")
+        except InvalidPayload:
+            event_type = None
+        return self.event_type_classes.get(event_type, "default") if isinstance(event_type, str) else "default", replay
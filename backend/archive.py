@@ -0,0 +1,312 @@
+"""
+Cold-tier archive for aged audit logs
+
+Audit logs older than ARCHIVE_AFTER_DAYS are moved, one audit partition period (month or day,
+see audit_storage.py) at a time, into gzip-compressed JSONL files under ARCHIVE_DIR, then
+removed from the database. Rows are written in created_at order, ARCHIVE_ROWS_PER_FILE per
+file. `manifest.json` records for every file its created_at range, event types and matched
+rule ids, so queries only open files that can contain matches. Within a file, lines that
+cannot match a rule_id/event_id filter are skipped before being decoded.
+
+Usage:
+    python archive.py run [--older-than DAYS]
+    python archive.py files
+    python archive.py query --rule-id high_value --start 2026-03-01 --end 2026-04-01
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+
+from models import AuditLog
+from audit_storage import next_partition_start, partition_start, purge_ids
+from serialization import dumps
+
+# fcntl is used to keep workers from archiving the same period concurrently (not on Windows)
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "audit_archive")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0")) or None
+ROWS_PER_FILE = int(os.getenv("ARCHIVE_ROWS_PER_FILE", "500000"))
+# Above this many distinct values a file only records min/max, which skips less
+MAX_INDEXED_VALUES = 1000
+
+MANIFEST = "manifest.json"
+
+_lock = threading.Lock()
+
+class ValueIndex:
+    """Distinct values seen in a file, degrading to a min/max range when there are too many"""
+
+    def __init__(self):
+        self.values = set()
+        self.min = None
+        self.max = None
+        self.overflow = False
+
+    def add(self, value: Any):
+        if value is None:
+            return
+        value = str(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if not self.overflow:
+            self.values.add(value)
+            if len(self.values) > MAX_INDEXED_VALUES:
+                self.overflow = True
+                self.values = set()
+
+    def to_dict(self) -> Dict:
+        return {"min": self.min, "max": self.max, "values": None if self.overflow else sorted(self.values)}
+
+def _may_contain(index: Optional[Dict], value: str) -> bool:
+    if not index or index.get("min") is None:
+        return False
+    if not (index["min"] <= value <= index["max"]):
+        return False
+    return index["values"] is None or value in index["values"]
+
+def load_manifest(archive_dir: str = ARCHIVE_DIR) -> Dict:
+    path = os.path.join(archive_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"files": [], "periods": []}
+    with open(path) as f:
+        return json.load(f)
+
+def _save_manifest(manifest: Dict, archive_dir: str):
+    path = os.path.join(archive_dir, MANIFEST)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class _FileWriter:
+    """Writes one archive file and builds its manifest entry"""
+
+    def __init__(self, archive_dir: str, name: str):
+        self.name = name
+        self.path = os.path.join(archive_dir, name)
+        self.tmp = f"{self.path}.tmp"
+        self.file = gzip.open(self.tmp, "wb")
+        self.rows = 0
+        self.min_created_at = None
+        self.max_created_at = None
+        self.event_types = ValueIndex()
+        self.rule_ids = ValueIndex()
+
+    def write(self, row: Dict):
+        created_at = row["created_at"].isoformat()
+        if self.min_created_at is None:
+            self.min_created_at = created_at
+        self.max_created_at = created_at
+        self.event_types.add(row.get("event_type"))
+        for rule_id in row.get("matched_rules") or []:
+            self.rule_ids.add(rule_id)
+        self.file.write(dumps(row) + b"\n")
+        self.rows += 1
+
+    def close(self) -> Dict:
+        self.file.close()
+        with open(self.tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self.tmp, self.path)
+        return {
+            "file": self.name,
+            "rows": self.rows,
+            "min_created_at": self.min_created_at,
+            "max_created_at": self.max_created_at,
+            "event_type": self.event_types.to_dict(),
+            "rule_ids": self.rule_ids.to_dict()
+        }
+
+def _archived_ids(archive_dir: str, entries: List[Dict]) -> Iterator[str]:
+    """Ids of the audit logs in the given archive files"""
+    for entry in entries:
+        with gzip.open(os.path.join(archive_dir, entry["file"]), "rb") as f:
+            for line in f:
+                yield json.loads(line)["id"]
+
+def archive_period(engine: Engine, start: datetime, end: datetime, archive_dir: str = ARCHIVE_DIR) -> Dict:
+    """
+    Write audit logs in [start, end) to archive files, record them in the manifest, then purge them.
+    Only rows found in the period's archive files are purged: rows written into the period after
+    it was archived are archived (to additional files) by a later run before they are removed.
+    """
+    manifest = load_manifest(archive_dir)
+    period = start.isoformat()
+    existing = [e for e in manifest["files"] if e.get("period_start") == period]
+    # Rows already archived by an earlier run (whose purge did not finish) are not written twice
+    archived = set(_archived_ids(archive_dir, existing)) if existing else set()
+
+    query = (
+        select(*AuditLog.__table__.columns)
+        .where(AuditLog.created_at >= start, AuditLog.created_at < end)
+        .order_by(AuditLog.created_at, AuditLog.id)
+        .execution_options(stream_results=True, yield_per=1000)
+    )
+    entries = []
+    writer = None
+    with engine.connect() as conn:
+        for row in conn.execute(query).mappings():
+            if row["id"] in archived:
+                continue
+            if writer is None or writer.rows >= ROWS_PER_FILE:
+                if writer is not None:
+                    entries.append(writer.close())
+                number = len(existing) + len(entries) + 1
+                writer = _FileWriter(archive_dir, f"audit_{start:%Y%m%d}_{number:04d}.jsonl.gz")
+            writer.write(dict(row))
+    if writer is not None:
+        entries.append(writer.close())
+    for entry in entries:
+        entry["period_start"] = period
+        entry["period_end"] = end.isoformat()
+    if entries or period not in manifest["periods"]:
+        # The manifest is only updated once every file is durable on disk
+        manifest["files"].extend(entries)
+        if period not in manifest["periods"]:
+            manifest["periods"].append(period)
+        _save_manifest(manifest, archive_dir)
+        logger.info(f"Archived {sum(e['rows'] for e in entries)} audit logs from {period} into {len(entries)} files")
+
+    purged = purge_ids(engine, start, end, _archived_ids(archive_dir, existing + entries))
+    return {"period_start": period, "period_end": end.isoformat(), **purged}
+
+def archive_aged_audit(engine: Engine, older_than_days: Optional[int] = None, archive_dir: str = ARCHIVE_DIR) -> List[Dict]:
+    """Archive every complete audit partition period that ended more than `older_than_days` ago"""
+    days = older_than_days or ARCHIVE_AFTER_DAYS
+    if not days:
+        return []
+    os.makedirs(archive_dir, exist_ok=True)
+    with _lock, open(os.path.join(archive_dir, ".lock"), "w") as lock_file:
+        if FCNTL_AVAILABLE:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.info("Another process is archiving audit logs, skipping")
+                return []
+
+        cutoff = partition_start(datetime.utcnow() - timedelta(days=days))
+        archived = []
+        previous = None
+        while True:
+            # Jump straight to the next period that still has rows
+            with engine.connect() as conn:
+                oldest = conn.execute(select(func.min(AuditLog.created_at))).scalar()
+            if oldest is None:
+                break
+            start = partition_start(oldest)
+            if start >= cutoff or start == previous:
+                break
+            archived.append(archive_period(engine, start, next_partition_start(start), archive_dir))
+            previous = start
+        return archived
+
+def _line_may_match(line: bytes, needles: List[bytes]) -> bool:
+    return all(needle in line for needle in needles)
+
+def query_archive(
+    rule_id: str = None,
+    event_type: str = None,
+    event_id: str = None,
+    start: datetime = None,
+    end: datetime = None,
+    limit: int = None,
+    archive_dir: str = ARCHIVE_DIR
+) -> Iterator[Dict]:
+    """Yield archived audit rows matching every given filter, oldest first"""
+    start_iso = start.isoformat() if start else None
+    end_iso = end.isoformat() if end else None
+    # Cheap byte checks that let most non-matching lines skip JSON decoding
+    needles = [json.dumps(v, ensure_ascii=False).encode() for v in (rule_id, event_id) if v is not None]
+
+    files = sorted(load_manifest(archive_dir)["files"], key=lambda e: e["min_created_at"] or "")
+    returned = 0
+    for entry in files:
+        if not entry["rows"]:
+            continue
+        if start_iso and entry["max_created_at"] < start_iso:
+            continue
+        if end_iso and entry["min_created_at"] >= end_iso:
+            continue
+        if event_type is not None and not _may_contain(entry["event_type"], event_type):
+            continue
+        if rule_id is not None and not _may_contain(entry["rule_ids"], rule_id):
+            continue
+
+        with gzip.open(os.path.join(archive_dir, entry["file"]), "rb") as f:
+            for line in f:
+                if needles and not _line_may_match(line, needles):
+                    continue
+                row = json.loads(line)
+                created_at = row.get("created_at") or ""
+                if start_iso and created_at < start_iso:
+                    continue
+                if end_iso and created_at >= end_iso:
+                    # Rows are sorted by created_at within a file
+                    break
+                if event_type is not None and row.get("event_type") != event_type:
+                    continue
+                if event_id is not None and row.get("event_id") != event_id:
+                    continue
+                if rule_id is not None and rule_id not in (row.get("matched_rules") or []):
+                    continue
+                yield row
+                returned += 1
+                if limit and returned >= limit:
+                    return
+
+def _parse_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audit log archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Archive aged audit logs now")
+    run.add_argument("--older-than", type=int, default=ARCHIVE_AFTER_DAYS, help="Age in days (default ARCHIVE_AFTER_DAYS)")
+
+    commands.add_parser("files", help="List archive files")
+
+    query = commands.add_parser("query", help="Print matching archived rows as NDJSON")
+    query.add_argument("--rule-id")
+    query.add_argument("--event-type")
+    query.add_argument("--event-id")
+    query.add_argument("--start", type=_parse_datetime)
+    query.add_argument("--end", type=_parse_datetime)
+    query.add_argument("--limit", type=int)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if not args.older_than:
+            print("Set --older-than or ARCHIVE_AFTER_DAYS")
+            sys.exit(1)
+        from database import engine
+
+        logging.basicConfig(level=logging.INFO)
+        for result in archive_aged_audit(engine, args.older_than):
+            print(result)
+    elif args.command == "files":
+        for entry in load_manifest()["files"]:
+            print(f"{entry['file']}  {entry['rows']} rows  {entry['min_created_at']} .. {entry['max_created_at']}")
+    else:
+        for row in query_archive(args.rule_id, args.event_type, args.event_id, args.start, args.end, args.limit):
+            sys.stdout.write(json.dumps(row) + "\n")
@@ -0,0 +1,305 @@
+"""
+Audit log storage management
+
+On PostgreSQL, `audit_logs` and `audit_rule_matches` are range-partitioned by `created_at`.
+Partitions (monthly by default, or daily with AUDIT_PARTITION_INTERVAL=day) are created
+AUDIT_PARTITIONS_AHEAD intervals ahead of need, with a DEFAULT partition as a safety net.
+When AUDIT_RETENTION_DAYS is set, partitions that end before the cutoff are dropped whole.
+
+Other databases (SQLite for local tests), and PostgreSQL tables created before partitioning,
+use the same tables unpartitioned: there are no partitions to manage and retention falls
+back to batched DELETEs.
+
+Usage:
+    python audit_storage.py status     # show partitions
+    python audit_storage.py maintain   # create partitions and apply retention now
+    python audit_storage.py backfill   # fill audit_rule_matches for older audit logs
+"""
+import os
+import re
+import sys
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, exists, insert, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from models import AuditLog, AuditRuleMatch
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLES = ("audit_logs", "audit_rule_matches")
+PARTITION_INTERVAL = os.getenv("AUDIT_PARTITION_INTERVAL", "month")
+PARTITIONS_AHEAD = int(os.getenv("AUDIT_PARTITIONS_AHEAD", "3"))
+RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "0")) or None
+DELETE_BATCH_SIZE = 10000
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+def partition_start(ts: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    """Start of the partition containing `ts`"""
+    if interval == "day":
+        return datetime(ts.year, ts.month, ts.day)
+    if interval == "month":
+        return datetime(ts.year, ts.month, 1)
+    raise ValueError(f"Invalid partition interval: {interval!r} (expected 'day' or 'month')")
+
+def next_partition_start(start: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == "day":
+        return start + timedelta(days=1)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+def partition_name(table: str, start: datetime, interval: str = PARTITION_INTERVAL) -> str:
+    return f"{table}_p{start:%Y%m%d}" if interval == "day" else f"{table}_p{start:%Y%m}"
+
+def is_partitioned(conn: Connection, table: str) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    relkind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}
+    ).scalar()
+    return relkind == "p"
+
+def list_partitions(conn: Connection, table: str) -> List[Tuple[str, Optional[datetime], Optional[datetime]]]:
+    """(name, start, end) of each partition; the DEFAULT partition has no bounds"""
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:table)
+        ORDER BY c.relname
+    """), {"table": table}).all()
+    partitions = []
+    for name, bound in rows:
+        match = _BOUNDS.search(bound or "")
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+        else:
+            partitions.append((name, None, None))
+    return partitions
+
+def create_partitions(engine: Engine, now: Optional[datetime] = None) -> List[str]:
+    """Create the current partition, PARTITIONS_AHEAD future ones and the DEFAULT partition"""
+    now = now or datetime.utcnow()
+    created = []
+    for table in PARTITIONED_TABLES:
+        with engine.connect() as conn:
+            if not is_partitioned(conn, table):
+                continue
+            existing = {name for name, _, _ in list_partitions(conn, table)}
+
+        statements = []
+        if f"{table}_default" not in existing:
+            statements.append((f"{table}_default", f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+        start = partition_start(now)
+        for _ in range(PARTITIONS_AHEAD + 1):
+            end = next_partition_start(start)
+            name = partition_name(table, start)
+            if name not in existing:
+                statements.append((name, (
+                    f"CREATE TABLE {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                )))
+            start = end
+
+        for name, statement in statements:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(statement))
+                created.append(name)
+                logger.info(f"Created audit partition {name}")
+            except Exception as e:
+                # e.g. the DEFAULT partition already holds rows in this range
+                logger.error(f"Failed to create audit partition {name}: {e}")
+    return created
+
+def apply_retention(engine: Engine, now: Optional[datetime] = None, days: Optional[int] = RETENTION_DAYS) -> dict:
+    """Remove audit data older than `days`: drop whole partitions where possible, else delete rows"""
+    if not days:
+        return {"dropped_partitions": [], "deleted_rows": 0}
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    dropped = []
+    deleted = 0
+
+    for table in PARTITIONED_TABLES:
+        with engine.connect() as conn:
+            partitioned = is_partitioned(conn, table)
+            partitions = list_partitions(conn, table) if partitioned else []
+        if not partitioned:
+            continue
+        for name, _, end in partitions:
+            if end is not None and end <= cutoff:
+                with engine.begin() as conn:
+                    conn.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+                logger.info(f"Dropped audit partition {name} (older than {days} days)")
+        # Rows that landed in the DEFAULT partition are deleted individually
+        with engine.begin() as conn:
+            deleted += conn.execute(
+                text(f"DELETE FROM {table}_default WHERE created_at < :cutoff"), {"cutoff": cutoff}
+            ).rowcount
+
+    with engine.connect() as conn:
+        logs_partitioned = is_partitioned(conn, "audit_logs")
+        matches_partitioned = is_partitioned(conn, "audit_rule_matches")
+    if not matches_partitioned:
+        with engine.begin() as conn:
+            deleted += conn.execute(delete(AuditRuleMatch).where(AuditRuleMatch.created_at < cutoff)).rowcount
+    if not logs_partitioned:
+        # Delete in batches to keep transactions short on large tables
+        while True:
+            batch = select(AuditLog.id).where(AuditLog.created_at < cutoff).limit(DELETE_BATCH_SIZE)
+            with engine.begin() as conn:
+                count = conn.execute(delete(AuditLog).where(AuditLog.id.in_(batch))).rowcount
+            deleted += count
+            if count < DELETE_BATCH_SIZE:
+                break
+
+    return {"dropped_partitions": dropped, "deleted_rows": deleted}
+
+def drop_empty_partitions(engine: Engine, start: datetime, end: datetime) -> List[str]:
+    """Drop partitions that lie entirely inside [start, end) and hold no rows"""
+    dropped = []
+    for table in PARTITIONED_TABLES:
+        with engine.connect() as conn:
+            partitions = list_partitions(conn, table) if is_partitioned(conn, table) else []
+        for name, p_start, p_end in partitions:
+            if p_start is None or p_start < start or p_end > end:
+                continue
+            with engine.begin() as conn:
+                # The lock keeps rows from landing between the check and the drop
+                conn.execute(text(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE"))
+                if conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name})")).scalar():
+                    continue
+                conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
+
+def purge_ids(engine: Engine, start: datetime, end: datetime, ids: Iterable[str]) -> dict:
+    """
+    Remove the audit logs with the given ids from [start, end), with their rule matches, then
+    drop partitions of the range that are left empty. Other rows in the range are kept.
+    """
+    deleted = 0
+    batch = []
+
+    def flush():
+        nonlocal deleted
+        with engine.begin() as conn:
+            conn.execute(delete(AuditRuleMatch).where(
+                AuditRuleMatch.audit_id.in_(batch), AuditRuleMatch.created_at >= start, AuditRuleMatch.created_at < end
+            ))
+            deleted += conn.execute(delete(AuditLog).where(
+                AuditLog.id.in_(batch), AuditLog.created_at >= start, AuditLog.created_at < end
+            )).rowcount
+        batch.clear()
+
+    for audit_id in ids:
+        batch.append(audit_id)
+        if len(batch) >= DELETE_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    return {"dropped_partitions": drop_empty_partitions(engine, start, end), "deleted_rows": deleted}
+
+def maintain(engine: Engine) -> dict:
+    """Create upcoming partitions, archive aged audit logs (ARCHIVE_AFTER_DAYS) and apply retention"""
+    from archive import ARCHIVE_AFTER_DAYS, archive_aged_audit
+
+    created = create_partitions(engine)
+    archived = archive_aged_audit(engine) if ARCHIVE_AFTER_DAYS else []
+    result = apply_retention(engine)
+    return {"created_partitions": created, "archived_periods": archived, **result}
+
+def rule_match_rows(audit_id: str, created_at: datetime, rule_ids: Iterable[str]) -> List[dict]:
+    return [{"rule_id": rule_id, "created_at": created_at, "audit_id": audit_id} for rule_id in dict.fromkeys(rule_ids)]
+
+def backfill_rule_matches(engine: Engine, batch_size: int = 1000) -> int:
+    """Populate audit_rule_matches for audit logs written before the table existed"""
+    query = (
+        select(AuditLog.id, AuditLog.created_at, AuditLog.matched_rules)
+        .where(~exists().where(AuditRuleMatch.audit_id == AuditLog.id, AuditRuleMatch.created_at == AuditLog.created_at))
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    inserted = 0
+    with engine.connect() as reader:
+        for chunk in reader.execute(query).partitions(batch_size):
+            rows = [r for log in chunk for r in rule_match_rows(log.id, log.created_at, log.matched_rules or [])]
+            if rows:
+                with engine.begin() as conn:
+                    conn.execute(insert(AuditRuleMatch), rows)
+                inserted += len(rows)
+    return inserted
+
+class AuditMaintenance:
+    """Background thread that runs maintain() periodically"""
+
+    def __init__(self, engine: Engine, interval: float):
+        self.engine = engine
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="audit-maintenance", daemon=True)
+
+    def start(self):
+        # Partitions must exist before the first audit log is written. Archiving and retention
+        # can take a long time, so they wait for the background thread.
+        try:
+            create_partitions(self.engine)
+        except Exception as e:
+            logger.error(f"Creating audit partitions failed: {e}")
+        self._thread.start()
+
+    def _run(self):
+        self.run_once()
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        try:
+            maintain(self.engine)
+        except Exception as e:
+            logger.error(f"Audit maintenance failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+_maintenance: Optional[AuditMaintenance] = None
+
+def start_audit_maintenance(engine: Engine):
+    """Create partitions now and keep them (and retention) up to date in the background"""
+    global _maintenance
+    if _maintenance is not None:
+        return
+    _maintenance = AuditMaintenance(engine, float(os.getenv("AUDIT_MAINTENANCE_INTERVAL", "3600")))
+    _maintenance.start()
+
+def stop_audit_maintenance():
+    global _maintenance
+    if _maintenance is not None:
+        _maintenance.stop()
+        _maintenance = None
+
+if __name__ == "__main__":
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "maintain":
+        print(maintain(engine))
+    elif command == "backfill":
+        print(f"Inserted {backfill_rule_matches(engine)} rule match rows")
+    elif command == "status":
+        with engine.connect() as conn:
+            for table in PARTITIONED_TABLES:
+                if not is_partitioned(conn, table):
+                    print(f"{table}: not partitioned")
+                    continue
+                print(f"{table}:")
+                for name, start, end in list_partitions(conn, table):
+                    bounds = f"{start} .. {end}" if start else "DEFAULT"
+                    print(f"  {name}  {bounds}")
+    else:
+        print(f"Unknown command: {command} (expected status, maintain or backfill)")
+        sys.exit(1)
@@ -0,0 +1,437 @@
+"""
+Historical replay (backtest) of candidate rules
+
+Stored audit logs, or an NDJSON file, are replayed through a candidate ruleset and compared
+with the rules that actually matched at the time (`matched_rules` in the audit log):
+
+- with `rule_id`, one candidate replaces that rule in the active ruleset
+- with `replace_ruleset`, the candidates are the whole ruleset
+- otherwise the candidates are added to (or replace same-id rules in) the active ruleset
+
+Events are evaluated in chunks by a pool of worker processes. The report has per-rule match
+counts, how many events each rule newly matches or no longer matches, and sampled examples.
+
+Window functions are replayed: each backtest starts from empty sliding windows of its own,
+records every replayed event in them, and reads the time from the events' `created_at`
+(an event without one happens at the time of the event before it). The live windows are
+never read or written. As the aggregates depend on every earlier event, a ruleset that uses
+window functions is replayed in order, in one process, whatever the number of workers.
+
+NDJSON input lines can be audit rows (as written by /audit/export or the archive, gzip is
+fine) or `{"event": ..., "context": ..., "matched_rules": [...], "created_at": ...}` objects,
+oldest first.
+
+Usage:
+    python backtest.py candidates.json [--rule-id ID] [--replace-ruleset]
+                       [--input events.ndjson | --start ... --end ... --event-type ...]
+                       [--limit N] [--workers N]
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import AuditLog, Rule
+from ruleset import CompiledRuleset, compile_spec, load_parameter_rows, load_value_sets, rule_spec
+from value_sets import get_value_set_registry
+from windows import WindowStore, use_window_store
+
+logger = logging.getLogger(__name__)
+
+# Backtests share the machine with the server, so they only use a few processes by default
+BACKTEST_WORKERS = int(os.getenv("BACKTEST_WORKERS", "2"))
+CHUNK_SIZE = int(os.getenv("BACKTEST_CHUNK_SIZE", "2000"))
+
+# (reference, event, context, matched_rules at the time, epoch seconds of the event or None)
+Record = Tuple[Dict, Dict, Dict, List[str], Optional[float]]
+
+# ========== CANDIDATES ==========
+
+def _model_dict(rule: Rule) -> Dict:
+    return {c.name: getattr(rule, c.name) for c in Rule.__table__.columns}
+
+def prepare_candidates(db: Session, candidates: List[Dict], rule_id: str = None, replace_ruleset: bool = False) -> List[Dict]:
+    """
+    Build the candidate ruleset as rule specs. Each candidate dict needs an "id" unless
+    `rule_id` is given, in which case the single candidate takes that id.
+    """
+    if rule_id is not None:
+        if len(candidates) != 1:
+            raise ValueError("Exactly one candidate rule is required with rule_id")
+        candidates = [{**candidates[0], "id": rule_id}]
+
+    rules: Dict[str, Dict] = {}
+    if not replace_ruleset:
+        rows = db.query(Rule).filter(Rule.active == True).all()
+        parameter_rows = load_parameter_rows(db, [r.id for r in rows if r.parameter_keys])
+        for r in rows:
+            rules[r.id] = rule_spec(_model_dict(r), parameter_rows.get(r.id))
+
+    candidate_ids = [c["id"] for c in candidates]
+    existing_rows = load_parameter_rows(db, candidate_ids)
+    for candidate in candidates:
+        # Templates keep the stored parameter table of the rule they replace
+        rows = existing_rows.get(candidate["id"]) if candidate.get("parameter_keys") else None
+        rules[candidate["id"]] = rule_spec(candidate, rows)
+
+    specs = sorted(rules.values(), key=lambda s: s["priority"], reverse=True)
+    for spec in specs:
+        # Fail early on candidates that do not compile
+        compile_spec(spec)
+    return specs
+
+def value_set_snapshot(db: Session, specs: List[Dict]) -> List[Tuple[str, int, List[Any], bool]]:
+    """Value sets the specs reference, for loading into the worker processes"""
+    keys = load_value_sets(db, [s["conditions"] for s in specs])
+    return get_value_set_registry().export(keys)
+
+# ========== SOURCES ==========
+
+def _timestamp(value: Any) -> Optional[float]:
+    """Epoch seconds of a created_at (datetime, ISO string or number); naive times are UTC"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+def iter_audit_records(engine: Engine, start: datetime = None, end: datetime = None,
+                       event_type: str = None, limit: int = None) -> Iterator[Record]:
+    """Stream stored audit logs, oldest first"""
+    query = select(
+        AuditLog.id, AuditLog.event_id, AuditLog.event_data, AuditLog.context_data, AuditLog.matched_rules,
+        AuditLog.created_at
+    ).order_by(AuditLog.created_at, AuditLog.id)
+    if start:
+        query = query.where(AuditLog.created_at >= start)
+    if end:
+        query = query.where(AuditLog.created_at < end)
+    if event_type:
+        query = query.where(AuditLog.event_type == event_type)
+    if limit:
+        query = query.limit(limit)
+    with engine.connect() as conn:
+        result = conn.execute(query.execution_options(stream_results=True, yield_per=CHUNK_SIZE))
+        for row in result:
+            ref = {"audit_id": row.id, "event_id": row.event_id}
+            yield ref, row.event_data or {}, row.context_data or {}, row.matched_rules or [], _timestamp(row.created_at)
+
+def iter_ndjson_records(path: str, limit: int = None) -> Iterator[Record]:
+    """Read audit rows or {"event", "context", "matched_rules"} objects from an NDJSON file"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for n, line in enumerate(f):
+            if limit and n >= limit:
+                break
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if "event_data" in item:
+                ref = {"audit_id": item.get("id"), "event_id": item.get("event_id")}
+                yield (ref, item.get("event_data") or {}, item.get("context_data") or {}, item.get("matched_rules") or [],
+                       _timestamp(item.get("created_at")))
+            else:
+                ref = {"event_id": item.get("event_id"), "line": n + 1}
+                yield (ref, item.get("event") or {}, item.get("context") or {}, item.get("matched_rules") or [],
+                       _timestamp(item.get("created_at")))
+
+def _chunks(records: Iterable[Record], size: int) -> Iterator[List[Record]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# ========== EVALUATION ==========
+
+def _empty_report() -> Dict:
+    return {"events": 0, "events_changed": 0, "errors": 0, "rules": {}, "examples": {}}
+
+class ReplayWindows(WindowStore):
+    """Sliding windows of one backtest, starting empty; time is that of the event being replayed"""
+
+    def __init__(self):
+        super().__init__(clock=lambda: self.now)
+        self.now = 0.0
+
+def evaluate_chunk(ruleset: CompiledRuleset, records: List[Record], sample_size: int,
+                   windows: Optional[ReplayWindows] = None) -> Dict:
+    """
+    Replay one chunk and compare with what matched at the time.
+    Rulesets with window functions need the backtest's `windows`; events are recorded in them.
+    """
+    report = _empty_report()
+    if windows is None:
+        _evaluate_records(ruleset, records, sample_size, report, None)
+    else:
+        with use_window_store(windows):
+            _evaluate_records(ruleset, records, sample_size, report, windows)
+    return report
+
+def _evaluate_records(ruleset: CompiledRuleset, records: List[Record], sample_size: int, report: Dict,
+                      windows: Optional[ReplayWindows]):
+    rules = report["rules"]
+    examples = report["examples"]
+    for ref, event, context, baseline, ts in records:
+        report["events"] += 1
+        if windows is not None and ts is not None:
+            windows.now = ts
+        try:
+            matched, _, _ = ruleset.evaluate(event, context, record_windows=windows is not None)
+        except Exception:
+            report["errors"] += 1
+            continue
+        matched = set(matched)
+        baseline = set(baseline)
+        if matched != baseline:
+            report["events_changed"] += 1
+        for rule_id in matched | baseline:
+            counts = rules.get(rule_id)
+            if counts is None:
+                counts = rules[rule_id] = {"matched": 0, "baseline_matched": 0, "newly_matched": 0, "no_longer_matched": 0}
+            if rule_id in matched:
+                counts["matched"] += 1
+            if rule_id in baseline:
+                counts["baseline_matched"] += 1
+            if rule_id in matched and rule_id not in baseline:
+                change = "newly_matched"
+            elif rule_id in baseline and rule_id not in matched:
+                change = "no_longer_matched"
+            else:
+                continue
+            counts[change] += 1
+            samples = examples.setdefault(rule_id, {"newly_matched": [], "no_longer_matched": []})[change]
+            if len(samples) < sample_size:
+                samples.append({**ref, "event": event})
+
+def merge_reports(total: Dict, part: Dict, sample_size: int):
+    for key in ("events", "events_changed", "errors"):
+        total[key] += part[key]
+    for rule_id, counts in part["rules"].items():
+        target = total["rules"].setdefault(rule_id, dict.fromkeys(counts, 0))
+        for key, value in counts.items():
+            target[key] += value
+    for rule_id, changes in part["examples"].items():
+        target = total["examples"].setdefault(rule_id, {"newly_matched": [], "no_longer_matched": []})
+        for change, samples in changes.items():
+            target[change].extend(samples[:sample_size - len(target[change])])
+
+def _pin_value_sets(condition: Any, versions: Dict[str, int]) -> Any:
+    """Copy of a condition AST with unpinned value set references pinned to `versions`"""
+    if not isinstance(condition, dict):
+        return condition
+    pinned = dict(condition)
+    if "clauses" in pinned and isinstance(pinned["clauses"], list):
+        pinned["clauses"] = [_pin_value_sets(c, versions) for c in pinned["clauses"]]
+    if "value_set" in pinned and pinned.get("value_set_version") is None and pinned["value_set"] in versions:
+        pinned["value_set_version"] = versions[pinned["value_set"]]
+    return pinned
+
+def load_ruleset(specs: List[Dict], value_sets: List[Tuple[str, int, List[Any], bool]],
+                 owner: Optional[str] = None) -> CompiledRuleset:
+    """
+    Load the value sets and compile the candidate ruleset. Unpinned references are pinned
+    to the snapshot's latest versions, so the registry's latest versions are left alone.
+    With `owner`, the sets are held until released with `registry.hold(owner, set())`, as a
+    ruleset rebuild in this process would otherwise drop them.
+    """
+    registry = get_value_set_registry()
+    if owner is not None:
+        registry.hold(owner, {(name, version) for name, version, _, _ in value_sets})
+    versions = {}
+    for name, version, values, latest in value_sets:
+        registry.put(name, version, values)
+        if latest:
+            versions[name] = version
+    return CompiledRuleset([compile_spec({**s, "conditions": _pin_value_sets(s["conditions"], versions)}) for s in specs])
+
+# The candidate ruleset of a worker process (each worker serves a single backtest)
+_worker_ruleset: Optional[CompiledRuleset] = None
+
+def _init_worker(specs: List[Dict], value_sets: List[Tuple[str, int, List[Any], bool]]):
+    global _worker_ruleset
+    _worker_ruleset = load_ruleset(specs, value_sets)
+
+def _worker_chunk(records: List[Record], sample_size: int) -> Dict:
+    return evaluate_chunk(_worker_ruleset, records, sample_size)
+
+def run_backtest(
+    records: Iterable[Record],
+    specs: List[Dict],
+    value_sets: List[Tuple[str, int, List[Any], bool]],
+    workers: int = None,
+    sample_size: int = 5,
+    progress: Callable[[int], None] = None
+) -> Dict:
+    """
+    Replay `records` through the candidate ruleset using `workers` processes, or in this
+    process, in order, when there is one worker or the ruleset uses window functions
+    """
+    workers = workers or BACKTEST_WORKERS
+    started = time.time()
+    report = _empty_report()
+    owner = f"backtest-{uuid.uuid4()}"
+    try:
+        ruleset = load_ruleset(specs, value_sets, owner)
+        if workers <= 1 or ruleset.window_specs:
+            windows = ReplayWindows() if ruleset.window_specs else None
+            for chunk in _chunks(records, CHUNK_SIZE):
+                merge_reports(report, evaluate_chunk(ruleset, chunk, sample_size, windows), sample_size)
+                if progress:
+                    progress(report["events"])
+        else:
+            # spawn avoids forking a process that may be running server threads
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(specs, value_sets)) as pool:
+                pending = set()
+                for chunk in _chunks(records, CHUNK_SIZE):
+                    # Bound the number of chunks held in memory
+                    if len(pending) >= workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            merge_reports(report, future.result(), sample_size)
+                        if progress:
+                            progress(report["events"])
+                    pending.add(pool.submit(_worker_chunk, chunk, sample_size))
+                for future in pending:
+                    merge_reports(report, future.result(), sample_size)
+    finally:
+        get_value_set_registry().hold(owner, set())
+
+    elapsed = time.time() - started
+    report["rules"] = dict(sorted(
+        report["rules"].items(),
+        key=lambda item: (item[1]["newly_matched"] + item[1]["no_longer_matched"], item[1]["matched"]),
+        reverse=True
+    ))
+    report["elapsed_seconds"] = round(elapsed, 3)
+    report["events_per_second"] = round(report["events"] / elapsed) if elapsed else None
+    return report
+
+# ========== JOBS ==========
+
+class BacktestJob:
+    def __init__(self, params: Dict):
+        self.id = str(uuid.uuid4())
+        self.params = params
+        self.status = "pending"
+        self.events = 0
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "params": self.params,
+            "events_processed": self.events,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+class BacktestJobs:
+    """Backtest jobs run in background threads of this process; finished jobs are kept in memory"""
+
+    def __init__(self, max_jobs: int = 100):
+        self.max_jobs = max_jobs
+        self._jobs: Dict[str, BacktestJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self, params: Dict, run: Callable[[Callable[[int], None]], Dict]) -> BacktestJob:
+        job = BacktestJob(params)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                del self._jobs[next(iter(self._jobs))]
+        threading.Thread(target=self._run, args=(job, run), name=f"backtest-{job.id[:8]}", daemon=True).start()
+        return job
+
+    def _run(self, job: BacktestJob, run: Callable[[Callable[[int], None]], Dict]):
+        job.status = "running"
+
+        def progress(events: int):
+            job.events = events
+
+        try:
+            job.result = run(progress)
+            job.events = job.result["events"]
+            job.status = "completed"
+        except Exception as e:
+            logger.error(f"Backtest {job.id} failed: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        job.finished_at = datetime.utcnow()
+
+    def get(self, job_id: str) -> Optional[BacktestJob]:
+        return self._jobs.get(job_id)
+
+# Global job registry
+_jobs = BacktestJobs()
+
+def get_backtest_jobs() -> BacktestJobs:
+    """Get the process-wide backtest job registry"""
+    return _jobs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay past events through candidate rules")
+    parser.add_argument("candidates", help="JSON file with a rule or a list of rules")
+    parser.add_argument("--rule-id", help="Replace this rule with the (single) candidate")
+    parser.add_argument("--replace-ruleset", action="store_true", help="Candidates are the whole ruleset")
+    parser.add_argument("--input", help="NDJSON file of events instead of stored audit logs")
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    parser.add_argument("--event-type")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--sample-size", type=int, default=5)
+    args = parser.parse_args()
+
+    from database import SessionLocal, engine
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.candidates) as f:
+        candidates = json.load(f)
+    if isinstance(candidates, dict):
+        candidates = [candidates]
+    for c in candidates:
+        c.setdefault("id", c.get("name", "").strip().lower().replace(" ", "_").replace("-", "_")[:48])
+
+    db = SessionLocal()
+    try:
+        specs = prepare_candidates(db, candidates, args.rule_id, args.replace_ruleset)
+        value_sets = value_set_snapshot(db, specs)
+    finally:
+        db.close()
+
+    if args.input:
+        records = iter_ndjson_records(args.input, args.limit)
+    else:
+        records = iter_audit_records(engine, args.start, args.end, args.event_type, args.limit)
+    report = run_backtest(records, specs, value_sets, args.workers, args.sample_size)
+    json.dump(report, sys.stdout, indent=2, default=str)
+    sys.stdout.write("\n")
@@ -0,0 +1,294 @@
+"""
+Bulk rule import and export
+
+An import validates every rule first (schema, condition structure, regexes, decision tables,
+value set references) and rejects the whole batch if any rule is invalid. Valid batches are
+upserted by rule id in a single transaction: rule rows, version rows and history are written
+with batched statements, and running workers reload the ruleset once afterwards.
+
+Existing rules keep their `active` state unless the import sets it, and get a new version
+only when their conditions or actions change. Template parameter tables are not part of the
+import; set them with PUT /rules/{rule_id}/parameters.
+
+Usage:
+    python bulk_rules.py import rules.ndjson [--dry-run]
+    python bulk_rules.py export > rules.ndjson
+"""
+import argparse
+import json
+import sys
+import uuid
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+from models import Rule, RuleVersion, ValueSet
+from schemas import BulkRule
+from evaluator import validate_condition
+from decision_tables import DecisionTable, DecisionTableError
+from value_sets import collect_value_set_refs
+from rule_history import record_rule_changes
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Stop collecting validation errors after this many
+MAX_ERRORS = 100
+
+RULE_FIELDS = ("name", "priority", "conditions", "actions", "tags", "stop_on_match",
+               "description", "parameter_keys", "decision_table")
+
+class BulkImportError(ValueError):
+    """The batch was rejected; `errors` lists every invalid rule"""
+
+    def __init__(self, errors: List[Dict]):
+        super().__init__(f"{len(errors)} invalid rules")
+        self.errors = errors
+
+def make_id(name: str) -> str:
+    """Rule id derived from its name"""
+    return name.strip().lower().replace(" ", "_").replace("-", "_")[:48]
+
+def rule_to_dict(r: Rule) -> dict:
+    """Serialize a rule row with the same fields as RuleResponse"""
+    return {
+        "id": r.id,
+        "name": r.name,
+        "priority": r.priority,
+        "active": r.active,
+        "version": r.version,
+        "conditions": r.conditions,
+        "actions": r.actions,
+        "tags": r.tags or [],
+        "stop_on_match": r.stop_on_match,
+        "created_by": r.created_by,
+        "created_at": r.created_at,
+        "updated_at": r.updated_at,
+        "description": r.description,
+        "parameter_keys": r.parameter_keys,
+        "decision_table": r.decision_table
+    }
+
+def parse_rules(body: bytes) -> List[Any]:
+    """Rules from a JSON array or NDJSON (one rule per line)"""
+    text = body.decode("utf-8-sig").strip()
+    if text.startswith("["):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+    items = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON on line {number}: {e}")
+    return items
+
+def _rule_error(rule: BulkRule) -> Optional[str]:
+    error = validate_condition(rule.conditions)
+    if error:
+        return error
+    if rule.decision_table:
+        if rule.parameter_keys:
+            return "A rule cannot be both a template and a decision table"
+        try:
+            DecisionTable(rule.decision_table)
+        except DecisionTableError as e:
+            return f"Invalid decision table: {e}"
+    return None
+
+def _chunks(items: List, size: int = 1000):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def validate_rules(db: Optional[Session], items: List[Any], value_sets: Optional[Set[Tuple[str, int]]] = None,
+                   check: Optional[Callable[[int, BulkRule], Optional[str]]] = None) -> List[BulkRule]:
+    """
+    Validate a batch in one pass; raises BulkImportError listing every invalid rule.
+    Value set references are checked against `value_sets` ((name, version) pairs) when
+    given, otherwise against the database. `check(index, rule)` may return an error for
+    a rule that is otherwise valid.
+    """
+    errors = []
+    rules = []
+    seen = {}
+    refs = {}
+
+    for index, item in enumerate(items):
+        if len(errors) >= MAX_ERRORS:
+            break
+        try:
+            rule = BulkRule.model_validate(item)
+        except ValidationError as e:
+            errors.append({"index": index, "error": "; ".join(
+                f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()
+            )})
+            continue
+        rule.id = rule.id or make_id(rule.name)
+        error = _rule_error(rule)
+        if rule.id in seen:
+            error = f"Duplicate rule id (also at index {seen[rule.id]})"
+        if not error and check is not None:
+            error = check(index, rule)
+        if error:
+            errors.append({"index": index, "id": rule.id, "error": error})
+            continue
+        seen[rule.id] = index
+        for ref in collect_value_set_refs(rule.conditions):
+            refs.setdefault(ref, index)
+        rules.append(rule)
+
+    # Value set references are checked with one query per chunk of names
+    if refs:
+        names = sorted({name for name, _ in refs})
+        existing = set(value_sets) if value_sets is not None else set()
+        if value_sets is None:
+            for chunk in _chunks(names):
+                existing.update(db.query(ValueSet.name, ValueSet.version).filter(ValueSet.name.in_(chunk)).all())
+        existing_names = {name for name, _ in existing}
+        for (name, version), index in refs.items():
+            found = (name, version) in existing if version is not None else name in existing_names
+            if not found and len(errors) < MAX_ERRORS:
+                suffix = f" v{version}" if version is not None else ""
+                errors.append({"index": index, "id": items[index].get("id") or make_id(items[index]["name"]),
+                               "error": f"Unknown value set: {name}{suffix}"})
+
+    if errors:
+        raise BulkImportError(sorted(errors, key=lambda e: e["index"]))
+    return rules
+
+def upsert_rules(db: Session, rules: List[BulkRule], created_by: str = None) -> Dict[str, int]:
+    """
+    Insert or update validated rules with their version rows and history, without committing.
+    Returns counts of created, updated and unchanged rules.
+    """
+    ids = [rule.id for rule in rules]
+    existing = {}
+    latest_versions = {}
+    for chunk in _chunks(ids):
+        existing.update((r.id, r) for r in db.query(Rule).filter(Rule.id.in_(chunk)))
+        latest_versions.update(
+            db.query(RuleVersion.rule_id, func.max(RuleVersion.version))
+            .filter(RuleVersion.rule_id.in_(chunk))
+            .group_by(RuleVersion.rule_id)
+            .all()
+        )
+
+    now = datetime.utcnow()
+    new_rules = []
+    changed = []
+    versions = []
+    counts = {"created": 0, "updated": 0, "unchanged": 0}
+    for payload in rules:
+        author = created_by or payload.created_by or "system"
+        values = {name: getattr(payload, name) for name in RULE_FIELDS}
+        values["tags"] = values["tags"] or []
+        values["parameter_keys"] = values["parameter_keys"] or None
+        values["decision_table"] = values["decision_table"] or None
+        rule = existing.get(payload.id)
+
+        if rule is None:
+            new_rules.append({**values, "id": payload.id, "version": 1, "active": payload.active is not False,
+                              "created_by": author, "created_at": now, "updated_at": now})
+            versions.append({"id": str(uuid.uuid4()), "rule_id": payload.id, "version": 1,
+                             "conditions": values["conditions"], "actions": values["actions"],
+                             "created_by": author, "created_at": now})
+            counts["created"] += 1
+            continue
+
+        if payload.active is not None:
+            values["active"] = payload.active
+        updates = {name: value for name, value in values.items() if getattr(rule, name) != value}
+        if not updates:
+            counts["unchanged"] += 1
+            continue
+        for name, value in updates.items():
+            setattr(rule, name, value)
+        if "conditions" in updates or "actions" in updates:
+            rule.version = (latest_versions.get(rule.id) or 0) + 1
+            versions.append({"id": str(uuid.uuid4()), "rule_id": rule.id, "version": rule.version,
+                             "conditions": rule.conditions, "actions": rule.actions,
+                             "created_by": author, "created_at": now})
+        rule.updated_at = now
+        counts["updated"] += 1
+        changed.append(rule)
+
+    # New rows go in as multi-row INSERTs; updated rules are flushed with the history below
+    for chunk in _chunks(new_rules):
+        db.execute(insert(Rule), chunk)
+    for chunk in _chunks(versions):
+        db.execute(insert(RuleVersion), chunk)
+    record_rule_changes(db, changed + new_rules, changed_at=now)
+    counts["versions"] = len(versions)
+    return counts
+
+def import_rules(db: Session, items: List[Any], created_by: str = None, dry_run: bool = False) -> Dict[str, int]:
+    """Validate and upsert a batch in one transaction (rolled back on error or dry run)"""
+    rules = validate_rules(db, items)
+    try:
+        counts = upsert_rules(db, rules, created_by)
+        if dry_run:
+            db.rollback()
+        else:
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    logger.info(f"Bulk import of {len(rules)} rules: {counts}{' (dry run)' if dry_run else ''}")
+    return {**counts, "dry_run": dry_run}
+
+def iter_rule_dicts(db: Session, active: bool = None, tag: str = None) -> Iterator[Dict]:
+    """Every rule, highest priority first, loaded in batches"""
+    query = db.query(Rule)
+    if active is not None:
+        query = query.filter(Rule.active == active)
+    if tag:
+        query = query.filter(Rule.tags.contains([tag]))
+    query = query.order_by(Rule.priority.desc(), Rule.created_at.desc(), Rule.id.desc())
+    for rule in query.yield_per(1000):
+        yield rule_to_dict(rule)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk rule import and export")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("import", help="Validate and upsert rules from a JSON array or NDJSON file")
+    run.add_argument("path", help="Input file, or - for stdin")
+    run.add_argument("--created-by", help="Author recorded on new rules and versions")
+    run.add_argument("--dry-run", action="store_true", help="Validate and roll back")
+
+    export = commands.add_parser("export", help="Print every rule as NDJSON")
+    export.add_argument("--active", type=lambda v: v.lower() == "true")
+    export.add_argument("--tag")
+
+    args = parser.parse_args()
+    from database import SessionLocal, engine
+    from models import Base
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if args.command == "import":
+            logging.basicConfig(level=logging.INFO)
+            body = sys.stdin.buffer.read() if args.path == "-" else open(args.path, "rb").read()
+            try:
+                print(import_rules(db, parse_rules(body), args.created_by, args.dry_run))
+            except BulkImportError as e:
+                for error in e.errors:
+                    print(error, file=sys.stderr)
+                sys.exit(1)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+        else:
+            for rule in iter_rule_dicts(db, args.active, args.tag):
+                sys.stdout.buffer.write(dumps(rule) + b"\n")
+    finally:
+        db.close()
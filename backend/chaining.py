@@ -0,0 +1,206 @@
+"""
+Forward-chaining evaluation
+
+In chaining mode, actions can change the facts the rules read. An action with an "assert"
+object sets field paths in a working memory (a copy of the event and context), and one with
+a "retract" list removes them:
+
+    {"type": "flag_account", "payload": {...}, "assert": {"context.account.flagged": true}}
+    {"type": "clear_review", "retract": ["context.account.review"]}
+
+Rules are evaluated from an agenda ordered by priority (highest first). Every rule is evaluated
+once. After that, a rule is evaluated again only when a fact it reads has changed, which is
+found through an index from field path to the rules reading it. Each rule fires (contributes
+actions) at most once. If a rule that already fired matches again after a change, that is a
+cycle: it is reported in the explanation and the rule is not fired again. stop_on_match stops
+the chain. Re-evaluations are capped at CHAIN_MAX_ITERATIONS (default 100). With an evaluation
+budget, the chain stops when it runs out and rules never evaluated are reported as skipped.
+"""
+import copy
+import heapq
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from ruleset import CompiledRule, CompiledRuleset, EvaluationBudget, collect_field_paths
+
+MAX_ITERATIONS = int(os.getenv("CHAIN_MAX_ITERATIONS", "100"))
+
+ROOTS = ("event", "context")
+
+class DependencyIndex:
+    """Which rules read which field paths"""
+
+    def __init__(self, rules: List[CompiledRule]):
+        # Rules reading exactly `path`, and rules reading `path` or anything below it
+        self._exact: Dict[str, Set[int]] = {}
+        self._under: Dict[str, Set[int]] = {}
+        for position, rule in enumerate(rules):
+            paths = collect_field_paths(rule.conditions)
+            if rule.parameters is not None:
+                paths.update(rule.parameters.keys)
+            if rule.decision_table is not None:
+                paths.update(rule.decision_table.fields)
+            for path in paths:
+                self._exact.setdefault(path, set()).add(position)
+                parts = path.split(".")
+                for i in range(1, len(parts) + 1):
+                    self._under.setdefault(".".join(parts[:i]), set()).add(position)
+
+    def readers(self, path: str) -> Set[int]:
+        """Rules affected by a change at `path`: readers of it, of anything below it, or of a parent"""
+        affected = set(self._under.get(path, ()))
+        parts = path.split(".")
+        for i in range(1, len(parts)):
+            affected.update(self._exact.get(".".join(parts[:i]), ()))
+        return affected
+
+def dependency_index(ruleset: CompiledRuleset) -> DependencyIndex:
+    """The ruleset's dependency index, built on first use"""
+    if ruleset.dependency_index is None:
+        ruleset.dependency_index = DependencyIndex(ruleset.rules)
+    return ruleset.dependency_index
+
+def _set_path(memory: Dict, path: str, value: Any) -> bool:
+    """Set a path in working memory; returns True if the value changed"""
+    parts = path.split(".")
+    target = memory
+    for part in parts[:-1]:
+        child = target.get(part)
+        if not isinstance(child, dict):
+            child = target[part] = {}
+        target = child
+    if parts[-1] in target and target[parts[-1]] == value:
+        return False
+    target[parts[-1]] = copy.deepcopy(value)
+    return True
+
+def _remove_path(memory: Dict, path: str) -> bool:
+    """Remove a path from working memory; returns True if it was there (even with a null value)"""
+    parts = path.split(".")
+    target = memory
+    for part in parts[:-1]:
+        target = target.get(part)
+        if not isinstance(target, dict):
+            return False
+    if parts[-1] not in target:
+        return False
+    del target[parts[-1]]
+    return True
+
+def apply_assertions(memory: Dict, actions: List[Dict]) -> Tuple[Dict[str, Any], List[str]]:
+    """Apply the assert/retract parts of actions; returns (changes, errors)"""
+    changes = {}
+    errors = []
+    for action in actions:
+        for path, value in (action.get("assert") or {}).items():
+            if path.split(".", 1)[0] not in ROOTS or "." not in path:
+                errors.append(f"Cannot assert {path}: paths start with event. or context.")
+            elif _set_path(memory, path, value):
+                changes[path] = value
+        for path in action.get("retract") or []:
+            if path.split(".", 1)[0] not in ROOTS or "." not in path:
+                errors.append(f"Cannot retract {path}: paths start with event. or context.")
+            elif _remove_path(memory, path):
+                changes[path] = None
+    return changes, errors
+
+def evaluate_chained(
+    ruleset: CompiledRuleset,
+    event: Dict,
+    context: Dict,
+    max_iterations: Optional[int] = None,
+    record_windows: bool = True,
+    stats=None,
+    budget: Optional[EvaluationBudget] = None
+) -> Tuple[List[str], List[Dict], List[Dict], Dict]:
+    """
+    Evaluate the ruleset with forward chaining.
+    Returns (matched_rules, actions, explanation, chain) where `chain` summarizes the run:
+    re-evaluations, asserted facts, cycles and why it stopped.
+    """
+    if record_windows and ruleset.window_specs:
+        ruleset.observe_windows(event, context)
+    max_iterations = MAX_ITERATIONS if max_iterations is None else max_iterations
+    index = dependency_index(ruleset)
+    rules = ruleset.rules
+
+    memory = {"event": copy.deepcopy(event), "context": copy.deepcopy(context)}
+    agenda = [(-rule.priority, position) for position, rule in enumerate(rules)]
+    heapq.heapify(agenda)
+    pending = set(range(len(rules)))
+    evaluated: Set[int] = set()
+    fired: Set[int] = set()
+    memo = ruleset.new_memo()
+
+    matched_rules = []
+    actions = []
+    all_explanations = []
+    samples = [] if stats is not None else None
+    chain = {"iterations": 0, "facts": {}, "cycles": [], "stopped": "agenda_empty"}
+
+    while agenda:
+        if budget is not None and budget.skips(rules[agenda[0][1]]):
+            # The agenda is priority-ordered, so every rule left is below the protected priority
+            budget.skipped.extend(rules[p].id for p in range(len(rules)) if p not in evaluated)
+            all_explanations.append(budget.explanation())
+            chain["stopped"] = "budget"
+            break
+        _, position = heapq.heappop(agenda)
+        pending.discard(position)
+        if position in evaluated:
+            if chain["iterations"] >= max_iterations:
+                chain["stopped"] = "max_iterations"
+                break
+            chain["iterations"] += 1
+        evaluated.add(position)
+
+        rule = rules[position]
+        started = time.perf_counter()
+        result = rule.evaluate(memory["event"], memory["context"], memo)
+        if samples is not None:
+            samples.append((rule.id, result.matched, len(result.actions), time.perf_counter() - started))
+        if not result.matched:
+            continue
+        if position in fired:
+            chain["cycles"].append(rule.id)
+            all_explanations.append({"rule_id": rule.id, "message": "Matched again when re-evaluated; already fired for this event, so not fired twice (cycle)"})
+            continue
+
+        fired.add(position)
+        matched_rules.append(rule.id)
+        actions.extend(result.actions)
+        changes, errors = apply_assertions(memory, result.actions)
+        entry = {
+            "rule_id": rule.id,
+            "rule_name": rule.name,
+            "matched": True,
+            "explanation": result.explanation,
+            **result.details
+        }
+        if changes:
+            entry["asserted"] = changes
+        if errors:
+            entry["errors"] = errors
+        all_explanations.append(entry)
+
+        if rule.stop_on_match:
+            all_explanations.append({"message": f"Stopped at rule {rule.id} (stop_on_match=True)"})
+            chain["stopped"] = "stop_on_match"
+            break
+
+        if changes:
+            chain["facts"].update(changes)
+            # Cached clause results may read the facts that just changed
+            memo = ruleset.new_memo()
+            for path in changes:
+                for reader in index.readers(path):
+                    if reader not in pending and reader in evaluated:
+                        pending.add(reader)
+                        heapq.heappush(agenda, (-rules[reader].priority, reader))
+
+    if samples:
+        stats.record(samples)
+    if chain["stopped"] == "max_iterations":
+        all_explanations.append({"message": f"Stopped after {max_iterations} re-evaluations (max_iterations)"})
+    return matched_rules, actions, all_explanations, chain
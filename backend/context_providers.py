@@ -0,0 +1,275 @@
+"""
+Context enrichment with pluggable providers and a two-tier cache
+
+Instead of every caller shipping e.g. the user profile in `context`, a provider can be
+registered for a top-level context key:
+
+    register_provider("user", fetch_user, key_field="event.user_id", ttl=300)
+
+When a rule reads `context.user.*` and the caller did not send `context.user`, the provider
+is called with the key read from `key_field`. Providers are only called for the context keys
+that evaluation actually touches. Results are cached per process (LRU with TTL) and, when
+REDIS_URL is set, in Redis shared by all workers. Concurrent misses for the same key are
+coalesced into a single provider call.
+
+Providers can also be configured with CONTEXT_PROVIDERS, a comma-separated list of
+`name:key_field=module.function` entries.
+"""
+import importlib
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional
+
+from evaluator import get_nested_value
+
+# Try to import Redis, but make it optional
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Seconds a request waits for a fetch already in flight for the same key
+DEFAULT_TIMEOUT = float(os.getenv("CONTEXT_PROVIDER_TIMEOUT", "2"))
+
+class LocalCache:
+    """Per-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class InMemorySharedCache:
+    """Stand-in for the shared tier, for tests and single-process deployments"""
+
+    def __init__(self, max_entries: int = 10000):
+        self._cache = LocalCache(max_entries)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._cache.get(key)
+        return None if value is _MISSING else value
+
+    def set(self, key: str, value: str, ttl: float):
+        self._cache.set(key, value, ttl)
+
+class RedisSharedCache:
+    """Shared cache tier backed by Redis"""
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.2)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self.client.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis get failed: {e}")
+            return None
+
+    def set(self, key: str, value: str, ttl: float):
+        try:
+            self.client.set(key, value, ex=max(1, int(ttl)))
+        except redis.RedisError as e:
+            logger.warning(f"Redis set failed: {e}")
+
+class TwoTierCache:
+    """Local LRU/TTL cache in front of an optional shared cache, with request coalescing"""
+
+    def __init__(self, local: LocalCache, shared=None):
+        self.local = local
+        self.shared = shared
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: str, loader: Callable[[], Any], ttl: float, timeout: Optional[float] = None) -> Any:
+        """
+        Cached value of `key`, calling `loader` on a miss. Callers that find a load already
+        in flight wait up to `timeout` seconds for it (concurrent.futures.TimeoutError).
+        """
+        value = self.local.get(key)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result(timeout)
+
+        try:
+            value = self._load(key, loader, ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _load(self, key: str, loader: Callable[[], Any], ttl: float) -> Any:
+        if self.shared is not None:
+            raw = self.shared.get(key)
+            if raw is not None:
+                value = json.loads(raw)
+                self.local.set(key, value, ttl)
+                return value
+
+        value = loader()
+        self.local.set(key, value, ttl)
+        if self.shared is not None and value is not None:
+            self.shared.set(key, json.dumps(value, default=str), ttl)
+        return value
+
+class ContextProvider:
+    """Fetches one top-level context key for an event"""
+
+    def __init__(self, name: str, fetch: Callable[[Any], Optional[Dict]], key_field: str, ttl: float = 300,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.name = name
+        self.fetch = fetch
+        self.key_field = key_field
+        self.ttl = ttl
+        # How long a request waits for another request's in-flight fetch of the same key
+        self.timeout = timeout
+
+class ProviderRegistry:
+    def __init__(self):
+        self.providers: Dict[str, ContextProvider] = {}
+        self.cache = TwoTierCache(LocalCache(int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "10000"))))
+
+    def register(self, name: str, fetch: Callable[[Any], Optional[Dict]], key_field: str, ttl: float = 300,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.providers[name] = ContextProvider(name, fetch, key_field, ttl, timeout)
+
+    def unregister(self, name: str):
+        self.providers.pop(name, None)
+
+    def load(self, provider: ContextProvider, event: Dict, context: Dict) -> Any:
+        key = get_nested_value({"event": event, "context": context}, provider.key_field)
+        if key is None:
+            return None
+        cache_key = f"ctx:{provider.name}:{key}"
+        try:
+            return self.cache.get_or_load(cache_key, lambda: provider.fetch(key), provider.ttl, provider.timeout)
+        except FutureTimeoutError:
+            logger.error(f"Context provider {provider.name} timed out for {key} after {provider.timeout}s")
+            return None
+        except Exception as e:
+            logger.error(f"Context provider {provider.name} failed for {key}: {e}")
+            return None
+
+class EnrichedContext(dict):
+    """
+    Request context that fills in provider-backed keys the first time they are read.
+    Keys sent by the caller always win.
+    """
+
+    def __init__(self, context: Dict, event: Dict, registry: ProviderRegistry):
+        super().__init__(context)
+        self._event = event
+        self._registry = registry
+        self._resolved = set()
+
+    def _resolve(self, key: Any) -> bool:
+        if dict.__contains__(self, key):
+            return True
+        provider = self._registry.providers.get(key)
+        if provider is None or key in self._resolved:
+            return False
+        self._resolved.add(key)
+        value = self._registry.load(provider, self._event, self)
+        if value is None:
+            return False
+        dict.__setitem__(self, key, value)
+        return True
+
+    def __contains__(self, key: Any) -> bool:
+        return self._resolve(key)
+
+    def __missing__(self, key: Any) -> Any:
+        if self._resolve(key):
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if self._resolve(key) else default
+
+# Global registry instance
+_registry = ProviderRegistry()
+
+def get_provider_registry() -> ProviderRegistry:
+    """Get the process-wide context provider registry"""
+    return _registry
+
+def register_provider(name: str, fetch: Callable[[Any], Optional[Dict]], key_field: str, ttl: float = 300,
+                      timeout: float = DEFAULT_TIMEOUT):
+    """Register a provider for the top-level context key `name`"""
+    _registry.register(name, fetch, key_field, ttl, timeout)
+
+def provider_key_fields() -> set:
+    """Event/context paths the registered providers read their keys from"""
+    return {p.key_field for p in _registry.providers.values()}
+
+def enrich_context(event: Dict, context: Dict) -> Dict:
+    """Wrap the request context so registered providers fill in missing keys lazily"""
+    if not _registry.providers:
+        return context
+    return EnrichedContext(context or {}, event, _registry)
+
+def configure_from_env():
+    """Set up the shared cache tier and providers listed in CONTEXT_PROVIDERS"""
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        if REDIS_AVAILABLE:
+            _registry.cache.shared = RedisSharedCache(redis_url)
+            logger.info(f"Context cache using Redis at {redis_url}")
+        else:
+            logger.warning("REDIS_URL is set but redis is not installed. Shared context cache disabled.")
+
+    ttl = float(os.getenv("CONTEXT_PROVIDER_TTL", "300"))
+    for entry in filter(None, (e.strip() for e in os.getenv("CONTEXT_PROVIDERS", "").split(","))):
+        try:
+            spec, target = entry.split("=", 1)
+            name, key_field = spec.split(":", 1)
+            module_name, fn_name = target.rsplit(".", 1)
+            fetch = getattr(importlib.import_module(module_name), fn_name)
+            register_provider(name, fetch, key_field, ttl)
+            logger.info(f"Registered context provider {name} ({key_field} -> {target})")
+        except (ValueError, ImportError, AttributeError) as e:
+            logger.error(f"Invalid CONTEXT_PROVIDERS entry {entry!r}: {e}")
@@ -0,0 +1,429 @@
+"""
+Decision table rules compiled to hash and interval lookups
+
+A decision table lists input columns and rows; each row gives one cell per input and
+the actions to emit when it matches:
+
+    {
+      "hit_policy": "first",
+      "inputs": [
+        {"field": "event.country"},
+        {"field": "event.amount", "match": "range"}
+      ],
+      "rows": [
+        {"id": "us_small", "when": ["US", {"min": 0, "max": 1000}], "actions": [...]},
+        {"id": "any_large", "when": ["-", {"min": 1000}], "actions": [...], "priority": 10}
+      ]
+    }
+
+Equality cells are a scalar, a list of alternatives, or "-" (any value). Range cells are
+{"min", "max"} (min inclusive, max exclusive unless "min_inclusive"/"max_inclusive" say
+otherwise) or "-". Equality columns are compiled into nested hash maps and the first range
+column into an interval index, so lookup cost does not grow with the number of rows.
+
+Hit policies:
+- first: the first matching row (table order)
+- unique: exactly one row may match; several matches are an error
+- collect: every matching row (table order)
+- priority: the matching row with the highest "priority"
+"""
+import csv
+import io
+import json
+import math
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Tuple
+
+from evaluator import get_nested_value
+
+HIT_POLICIES = ("first", "unique", "collect", "priority")
+WILDCARD = "-"
+
+class DecisionTableError(ValueError):
+    """Raised when a decision table definition is invalid"""
+
+def _is_wildcard(cell: Any) -> bool:
+    return cell is None or cell == WILDCARD
+
+def _bound_kind(bound: Any, cell: Any) -> str:
+    """Range bounds must be finite numbers or strings so that they can be sorted"""
+    if isinstance(bound, str):
+        return "string"
+    if isinstance(bound, (int, float)) and not isinstance(bound, bool) and math.isfinite(bound):
+        return "number"
+    raise DecisionTableError(f"Invalid range cell: {cell!r}, bounds must be finite numbers or strings")
+
+class Interval:
+    """A numeric (or otherwise ordered) range cell"""
+    __slots__ = ("min", "max", "min_inclusive", "max_inclusive")
+
+    def __init__(self, min: Any = None, max: Any = None, min_inclusive: bool = True, max_inclusive: bool = False):
+        self.min = min
+        self.max = max
+        self.min_inclusive = min_inclusive
+        self.max_inclusive = max_inclusive
+
+    @classmethod
+    def from_cell(cls, cell: Dict) -> "Interval":
+        if not isinstance(cell, dict) or not set(cell) <= {"min", "max", "min_inclusive", "max_inclusive"}:
+            raise DecisionTableError(f"Invalid range cell: {cell!r}")
+        iv = cls(cell.get("min"), cell.get("max"), cell.get("min_inclusive", True), cell.get("max_inclusive", False))
+        if not isinstance(iv.min_inclusive, bool) or not isinstance(iv.max_inclusive, bool):
+            raise DecisionTableError(f"Invalid range cell: {cell!r}, min_inclusive/max_inclusive must be booleans")
+        if len({_bound_kind(b, cell) for b in (iv.min, iv.max) if b is not None}) > 1:
+            raise DecisionTableError(f"Invalid range cell: {cell!r}, min and max must be of one type")
+        return iv
+
+    def bound_kind(self) -> Optional[str]:
+        """"number" or "string" for the type of the bounds, None when unbounded"""
+        for bound in (self.min, self.max):
+            if bound is not None:
+                return _bound_kind(bound, None)
+        return None
+
+    def to_cell(self) -> Dict:
+        cell = {}
+        if self.min is not None:
+            cell["min"] = self.min
+            if not self.min_inclusive:
+                cell["min_inclusive"] = False
+        if self.max is not None:
+            cell["max"] = self.max
+            if self.max_inclusive:
+                cell["max_inclusive"] = True
+        return cell
+
+    def contains(self, value: Any) -> bool:
+        try:
+            if self.min is not None:
+                if value < self.min or (value == self.min and not self.min_inclusive):
+                    return False
+            if self.max is not None:
+                if value > self.max or (value == self.max and not self.max_inclusive):
+                    return False
+            return True
+        except TypeError:
+            return False
+
+class IntervalIndex:
+    """
+    Stabbing-query index over intervals.
+    Boundary points split the line into elementary segments, each holding the rows
+    that cover it, so a lookup is one binary search.
+    """
+
+    def __init__(self, intervals: List[Tuple[int, Optional[Interval]]]):
+        points = sorted({p for _, iv in intervals if iv for p in (iv.min, iv.max) if p is not None})
+        self.points = points
+        # Segments: (-inf, p0), [p0], (p0, p1), [p1], ..., (pn, +inf)
+        # Each interval covers a contiguous run of segments, so one sweep over the
+        # segments, adding rows where their run starts and dropping them where it ends,
+        # builds every segment's row set.
+        position = {p: i for i, p in enumerate(points)}
+        last = 2 * len(points)
+        starts: List[List[int]] = [[] for _ in range(last + 1)]
+        ends: List[List[int]] = [[] for _ in range(last + 1)]
+        for row, iv in intervals:
+            first, stop = self._span(iv, position, last)
+            if first <= stop:
+                starts[first].append(row)
+                ends[stop].append(row)
+
+        self.segments: List[Tuple[int, ...]] = []
+        active = set()
+        current: Tuple[int, ...] = ()
+        for segment in range(last + 1):
+            if starts[segment]:
+                active.update(starts[segment])
+                current = tuple(sorted(active))
+            self.segments.append(current)
+            if ends[segment]:
+                active.difference_update(ends[segment])
+                current = tuple(sorted(active))
+
+    @staticmethod
+    def _span(iv: Optional[Interval], position: Dict[Any, int], last: int) -> Tuple[int, int]:
+        """First and last segment covered by an interval (first > last when it is empty)"""
+        if iv is None:
+            return 0, last
+        first, stop = 0, last
+        if iv.min is not None:
+            i = position[iv.min]
+            first = 2 * i + 1 if iv.min_inclusive else 2 * i + 2
+        if iv.max is not None:
+            i = position[iv.max]
+            stop = 2 * i + 1 if iv.max_inclusive else 2 * i
+        return first, stop
+
+    def lookup(self, value: Any) -> Tuple[int, ...]:
+        try:
+            i = bisect_left(self.points, value)
+        except TypeError:
+            return ()
+        if i < len(self.points) and self.points[i] == value:
+            return self.segments[2 * i + 1]
+        return self.segments[2 * i]
+
+class DecisionTable:
+    """Compiled decision table"""
+
+    def __init__(self, definition: Dict):
+        if not isinstance(definition, dict):
+            raise DecisionTableError("decision_table must be an object")
+        self.definition = definition
+        self.hit_policy = definition.get("hit_policy", "first")
+        if self.hit_policy not in HIT_POLICIES:
+            raise DecisionTableError(f"Unknown hit policy: {self.hit_policy}")
+
+        inputs = definition.get("inputs") or []
+        if not isinstance(inputs, list) or not inputs:
+            raise DecisionTableError("decision_table needs a list of at least one input column")
+        self.fields: List[str] = []
+        self.equality_cols: List[int] = []
+        self.range_cols: List[int] = []
+        for i, col in enumerate(inputs):
+            if not isinstance(col, dict) or not col.get("field") or not isinstance(col["field"], str):
+                raise DecisionTableError(f"Input column {i} needs a field")
+            match = col.get("match", "equals")
+            if match not in ("equals", "range"):
+                raise DecisionTableError(f"Input column {i}: unknown match type {match}")
+            self.fields.append(col["field"])
+            (self.range_cols if match == "range" else self.equality_cols).append(i)
+
+        rows = definition.get("rows") or []
+        if not isinstance(rows, list):
+            raise DecisionTableError("decision_table rows must be a list")
+        self.rows: List[Dict] = []
+        self.row_ids: List[str] = []
+        self.row_priorities: List[int] = []
+        cells: List[List[Any]] = []
+        bound_kinds: Dict[int, str] = {}
+        for n, row in enumerate(rows):
+            if not isinstance(row, dict):
+                raise DecisionTableError(f"Row {n} must be an object")
+            when = row.get("when", [])
+            if not isinstance(when, list):
+                raise DecisionTableError(f"Row {n}: when must be a list of cells")
+            if len(when) != len(inputs):
+                raise DecisionTableError(f"Row {n}: expected {len(inputs)} cells, got {len(when)}")
+            priority = row.get("priority", 0)
+            if not isinstance(priority, int) or isinstance(priority, bool):
+                raise DecisionTableError(f"Row {n}: priority must be an integer")
+            if not isinstance(row.get("actions", []), list):
+                raise DecisionTableError(f"Row {n}: actions must be a list")
+            parsed = list(when)
+            for i in self.range_cols:
+                parsed[i] = None if _is_wildcard(when[i]) else Interval.from_cell(when[i])
+                kind = parsed[i] and parsed[i].bound_kind()
+                if kind and bound_kinds.setdefault(i, kind) != kind:
+                    raise DecisionTableError(f"Row {n}: range bounds in column {i} mix numbers and strings")
+            for i in self.equality_cols:
+                cell = when[i]
+                if isinstance(cell, dict):
+                    raise DecisionTableError(f"Row {n}: equality cells must be scalars or lists")
+                if isinstance(cell, list) and any(isinstance(v, (list, dict)) for v in cell):
+                    raise DecisionTableError(f"Row {n}: equality alternatives must be scalars")
+            cells.append(parsed)
+            self.rows.append(row)
+            self.row_ids.append(str(row.get("id", n)))
+            self.row_priorities.append(priority)
+
+        self._index = self._build_index(list(range(len(self.rows))), cells, 0)
+
+    def _build_index(self, rows: List[int], cells: List[List[Any]], depth: int):
+        """Nested hash maps over equality columns; leaves index the range columns"""
+        if depth == len(self.equality_cols):
+            if not self.range_cols:
+                return tuple(rows)
+            first = self.range_cols[0]
+            return IntervalIndex([(r, cells[r][first]) for r in rows]), {r: cells[r] for r in rows}
+
+        col = self.equality_cols[depth]
+        exact: Dict[Any, List[int]] = {}
+        wildcard: List[int] = []
+        for r in rows:
+            cell = cells[r][col]
+            if _is_wildcard(cell):
+                wildcard.append(r)
+            else:
+                for v in (cell if isinstance(cell, list) else [cell]):
+                    exact.setdefault(v, []).append(r)
+        return (
+            {v: self._build_index(rs, cells, depth + 1) for v, rs in exact.items()},
+            self._build_index(wildcard, cells, depth + 1) if wildcard else None
+        )
+
+    def _probe(self, node, values: List[Any], depth: int, out: List[int]):
+        if depth == len(self.equality_cols):
+            if not self.range_cols:
+                out.extend(node)
+                return
+            index, row_cells = node
+            first = self.range_cols[0]
+            for r in index.lookup(values[first]):
+                if all(row_cells[r][i] is None or row_cells[r][i].contains(values[i]) for i in self.range_cols[1:]):
+                    out.append(r)
+            return
+
+        exact, wildcard = node
+        value = values[self.equality_cols[depth]]
+        try:
+            child = exact.get(value)
+        except TypeError:
+            child = None
+        if child is not None:
+            self._probe(child, values, depth + 1, out)
+        if wildcard is not None:
+            self._probe(wildcard, values, depth + 1, out)
+
+    def lookup(self, event: Dict, context: Dict) -> Tuple[List[int], Dict[str, Any], Optional[str]]:
+        """
+        Find the rows selected by the hit policy.
+        Returns (row_indexes, input_values, error)
+        """
+        merged = {"event": event, "context": context}
+        values = [get_nested_value(merged, f) for f in self.fields]
+        inputs = dict(zip(self.fields, values))
+
+        matches: List[int] = []
+        self._probe(self._index, values, 0, matches)
+        matches.sort()
+
+        if not matches or self.hit_policy == "collect":
+            return matches, inputs, None
+        if self.hit_policy == "first":
+            return matches[:1], inputs, None
+        if self.hit_policy == "unique":
+            if len(matches) > 1:
+                ids = [self.row_ids[r] for r in matches]
+                return [], inputs, f"Hit policy 'unique' violated by rows {ids}"
+            return matches, inputs, None
+        # priority: highest priority wins, table order breaks ties
+        best = max(matches, key=lambda r: (self.row_priorities[r], -r))
+        return [best], inputs, None
+
+    def evaluate(self, event: Dict, context: Dict) -> Tuple[List[Dict], Dict]:
+        """Return (actions, explanation) for the rows selected by the hit policy"""
+        rows, inputs, error = self.lookup(event, context)
+        actions = []
+        for r in rows:
+            actions.extend(self.rows[r].get("actions", []))
+        explanation = {
+            "hit_policy": self.hit_policy,
+            "inputs": inputs,
+            "matched_rows": [self.row_ids[r] for r in rows]
+        }
+        if error:
+            explanation["error"] = error
+        return actions, explanation
+
+# ========== CSV IMPORT / EXPORT ==========
+# Header cells are input fields ("event.country", or "event.amount:range" for range
+# columns) followed by optional "id", "priority" and "actions" (JSON) columns.
+# Equality cells are exported as JSON ("US" is written "\"US\"") so that strings such as
+# "5411" or "null" keep their type; on import, text that is not valid JSON is read as a string.
+# Range cells use interval notation such as "[0..1000)", "(10..]" or "[..5]".
+
+META_COLUMNS = ("id", "priority", "actions")
+
+def _parse_equality_cell(text: str) -> Any:
+    text = text.strip()
+    if text in ("", WILDCARD):
+        return WILDCARD
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return text
+    return value if not isinstance(value, dict) else text
+
+def _parse_range_cell(text: str) -> Any:
+    text = text.strip()
+    if text in ("", WILDCARD):
+        return WILDCARD
+    if len(text) < 4 or text[0] not in "[(" or text[-1] not in ")]" or ".." not in text:
+        raise DecisionTableError(f"Invalid range cell {text!r}, expected e.g. [0..100)")
+    lo, hi = text[1:-1].split("..", 1)
+    cell: Dict[str, Any] = {}
+    if lo.strip():
+        cell["min"] = json.loads(lo)
+        cell["min_inclusive"] = text[0] == "["
+    if hi.strip():
+        cell["max"] = json.loads(hi)
+        cell["max_inclusive"] = text[-1] == "]"
+    return cell
+
+def _format_range_cell(cell: Any) -> str:
+    if _is_wildcard(cell):
+        return WILDCARD
+    iv = Interval.from_cell(cell)
+    lo = json.dumps(iv.min) if iv.min is not None else ""
+    hi = json.dumps(iv.max) if iv.max is not None else ""
+    return f"{'[' if iv.min_inclusive else '('}{lo}..{hi}{']' if iv.max_inclusive else ')'}"
+
+def _format_equality_cell(cell: Any) -> str:
+    if _is_wildcard(cell):
+        return WILDCARD
+    return json.dumps(cell)
+
+def table_from_csv(text: str, hit_policy: str = "first") -> Dict:
+    """Parse a CSV export back into a decision table definition"""
+    reader = csv.reader(io.StringIO(text))
+    try:
+        header = [h.strip() for h in next(reader)]
+    except StopIteration:
+        raise DecisionTableError("CSV is empty")
+
+    inputs = []
+    input_positions = []
+    meta = {}
+    for pos, name in enumerate(header):
+        if name in META_COLUMNS:
+            meta[name] = pos
+            continue
+        field, _, match = name.partition(":")
+        inputs.append({"field": field, "match": match or "equals"})
+        input_positions.append(pos)
+
+    rows = []
+    for line_no, record in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in record):
+            continue
+        record = record + [""] * (len(header) - len(record))
+        try:
+            when = [
+                _parse_range_cell(record[pos]) if col["match"] == "range" else _parse_equality_cell(record[pos])
+                for col, pos in zip(inputs, input_positions)
+            ]
+            row: Dict[str, Any] = {"when": when}
+            if "id" in meta and record[meta["id"]].strip():
+                row["id"] = record[meta["id"]].strip()
+            if "priority" in meta and record[meta["priority"]].strip():
+                row["priority"] = int(record[meta["priority"]])
+            row["actions"] = json.loads(record[meta["actions"]]) if "actions" in meta and record[meta["actions"]].strip() else []
+        except ValueError as e:
+            raise DecisionTableError(f"Line {line_no}: {e}")
+        rows.append(row)
+
+    definition = {"hit_policy": hit_policy, "inputs": inputs, "rows": rows}
+    DecisionTable(definition)  # validate
+    return definition
+
+def table_to_csv(definition: Dict) -> str:
+    """Export a decision table definition as CSV"""
+    inputs = definition.get("inputs", [])
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(
+        [f"{c['field']}:range" if c.get("match") == "range" else c["field"] for c in inputs]
+        + list(META_COLUMNS)
+    )
+    for n, row in enumerate(definition.get("rows", [])):
+        when = row.get("when", [])
+        writer.writerow(
+            [
+                _format_range_cell(cell) if col.get("match") == "range" else _format_equality_cell(cell)
+                for col, cell in zip(inputs, when)
+            ]
+            + [row.get("id", n), row.get("priority", ""), json.dumps(row.get("actions", []))]
+        )
+    return out.getvalue()
@@ -0,0 +1,489 @@
+"""
+Server-side action dispatch
+
+Actions returned by an evaluation can be executed by the server instead of by every client.
+A handler is registered per action `type`:
+
+    from dispatch import action_handler
+
+    @action_handler("send_alert", batch_size=100, concurrency=2)
+    def send_alerts(actions):          # batch_size > 1: called with a list of actions
+        alerts_api.send_many([a["payload"] for a in actions])
+
+    @action_handler("block_transaction", concurrency=8)
+    def block(action):                 # batch_size 1: called with one action
+        payments_api.block(action["payload"]["transaction_id"])
+
+Handler modules are listed in DISPATCH_HANDLERS (comma-separated module names) and imported at
+startup; dispatch is on when DISPATCH_ENABLED=true. Actions without a handler are not
+dispatched.
+
+The evaluation only hands its actions to an in-memory intake queue. A dispatcher thread
+writes them to a local SQLite outbox (DISPATCH_OUTBOX_PATH), in one transaction per batch.
+It then runs them on a thread pool per type, limited to the handler's `concurrency`, in
+batches of up to its `batch_size`. The same action twice for one event is stored once. A
+failed call is retried with exponential backoff and jitter, up to `max_attempts`; after
+that the action is marked dead and kept for inspection. Actions still in the intake queue
+are written out on shutdown; on a crash, the last DISPATCH_POLL_INTERVAL of them can be lost.
+
+Every worker process of the server shares the outbox. A dispatcher claims due actions in a
+single UPDATE that marks them running under its own owner id with a lease
+(DISPATCH_LEASE_SECONDS), so no action is handed to two processes. The lease is renewed while
+the owner is alive. Actions whose owner died (a crash or restart) are claimed again once
+their lease expires, so handlers should be idempotent. An outbox error (e.g. a locked or full
+disk) fails one iteration of the dispatcher thread, which keeps running.
+
+For load tests, DISPATCH_STUB_TYPES registers counting stub handlers, which sleep
+DISPATCH_STUB_LATENCY_MS per call:
+
+    python dispatch.py bench --actions 100000 --batch-size 100
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("DISPATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+OUTBOX_PATH = os.getenv("DISPATCH_OUTBOX_PATH", "action_outbox.db")
+POLL_INTERVAL = float(os.getenv("DISPATCH_POLL_INTERVAL", "0.05"))
+BACKOFF_SECONDS = float(os.getenv("DISPATCH_BACKOFF_SECONDS", "0.5"))
+MAX_BACKOFF_SECONDS = float(os.getenv("DISPATCH_MAX_BACKOFF_SECONDS", "300"))
+# Actions per task for handlers called one action at a time
+UNBATCHED_CHUNK = 16
+# Dispatched actions are kept this long to deduplicate late repeats of the same event
+RETENTION_SECONDS = float(os.getenv("DISPATCH_RETENTION_SECONDS", "3600"))
+# Running actions of a dispatcher that stopped renewing them are retried after this long
+LEASE_SECONDS = float(os.getenv("DISPATCH_LEASE_SECONDS", "300"))
+# Pause after a failed dispatcher iteration
+ERROR_BACKOFF_SECONDS = 1.0
+
+_metrics = get_metrics()
+DISPATCHED = _metrics.counter("dispatch_actions_total", "Actions by type and outcome (enqueued, duplicate, done, retried, dead)", ("type", "outcome"))
+CALL_SECONDS = _metrics.histogram("dispatch_call_seconds", "Duration of handler calls", ("type",))
+
+class ActionHandler:
+    """A registered handler with its dispatch limits"""
+
+    def __init__(self, type: str, fn: Callable, concurrency: int = 4, batch_size: int = 1, max_attempts: int = 5):
+        self.type = type
+        self.fn = fn
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+
+_handlers: Dict[str, ActionHandler] = {}
+
+def register_handler(type: str, fn: Callable, concurrency: int = 4, batch_size: int = 1, max_attempts: int = 5) -> ActionHandler:
+    """Dispatch actions of `type` to `fn`; with batch_size > 1, fn receives a list of actions"""
+    handler = _handlers[type] = ActionHandler(type, fn, concurrency, batch_size, max_attempts)
+    return handler
+
+def action_handler(type: str, **options):
+    """Decorator form of register_handler"""
+    def decorator(fn: Callable) -> Callable:
+        register_handler(type, fn, **options)
+        return fn
+    return decorator
+
+class StubHandler:
+    """Counts the actions it receives, optionally sleeping per call"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self.actions = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, actions):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            self.actions += len(actions) if isinstance(actions, list) else 1
+
+def dedup_key(event_key: str, encoded_action: str) -> str:
+    """Key of an action within an event, from its canonical (sorted-key) JSON"""
+    return f"{event_key}:{hashlib.sha1(encoded_action.encode()).hexdigest()[:20]}"
+
+def backoff(attempts: int) -> float:
+    """Seconds before retry number `attempts`, with jitter"""
+    return min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedup_key TEXT NOT NULL UNIQUE,
+    type TEXT NOT NULL,
+    action TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    last_error TEXT,
+    updated_at REAL NOT NULL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, type, next_attempt);
+"""
+
+# Columns added after the first release, for outbox files created before them
+LATER_COLUMNS = {"owner": "TEXT", "lease_until": "REAL"}
+
+def connect_outbox(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+    for name, kind in LATER_COLUMNS.items():
+        if name not in columns:
+            try:
+                conn.execute(f"ALTER TABLE outbox ADD COLUMN {name} {kind}")
+            except sqlite3.OperationalError:
+                # Another worker added it first
+                pass
+    conn.commit()
+    return conn
+
+class ActionDispatcher:
+    """Outbox writer and scheduler thread, with a thread pool per action type"""
+
+    def __init__(self, path: str = OUTBOX_PATH, handlers: Optional[Dict[str, ActionHandler]] = None):
+        self.path = path
+        self.handlers = _handlers if handlers is None else handlers
+        self._intake: "queue.Queue[Tuple[str, List[Dict]]]" = queue.Queue()
+        self._results: "queue.Queue[Tuple[str, List[int], List[int], Optional[str]]]" = queue.Queue()
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+        self._busy: Dict[str, int] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="action-dispatch", daemon=True)
+        self._last_purge = 0.0
+        self._last_renewal = 0.0
+        # Marks the actions this dispatcher claimed; unique per process and start
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+    def start(self):
+        connect_outbox(self.path).close()
+        self._thread.start()
+
+    def stop(self):
+        """Write queued actions to the outbox, finish running calls and stop"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+
+    def submit(self, event_key: str, actions: Iterable[Dict]):
+        """Hand an evaluation's actions to the dispatcher; never blocks on dispatch"""
+        handled = [a for a in actions if isinstance(a, dict) and a.get("type") in self.handlers]
+        if handled:
+            self._intake.put((str(event_key), handled))
+            self._wake.set()
+
+    def _run(self):
+        conn = connect_outbox(self.path)
+        try:
+            while True:
+                stopping = self._stop.is_set()
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+                if not self._iterate(conn, stopping) and not stopping:
+                    self._stop.wait(ERROR_BACKOFF_SECONDS)
+                if stopping:
+                    break
+            for pool in self._pools.values():
+                pool.shutdown(wait=True)
+            self._iterate(conn, stopping=True)
+        finally:
+            conn.close()
+
+    def _iterate(self, conn: sqlite3.Connection, stopping: bool) -> bool:
+        """One pass of the dispatcher thread; an error is logged and the next pass retries"""
+        try:
+            self._persist(conn)
+            self._apply_results(conn)
+            if not stopping:
+                self._schedule(conn)
+                self._renew(conn)
+                self._purge(conn)
+            return True
+        except Exception as e:
+            logger.error(f"Action dispatch pass failed: {e}")
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            return False
+
+    def _persist(self, conn: sqlite3.Connection):
+        rows: Dict[str, List[Tuple]] = {}
+        now = time.time()
+        items = []
+        while True:
+            try:
+                items.append(self._intake.get_nowait())
+            except queue.Empty:
+                break
+        for event_key, actions in items:
+            for action in actions:
+                encoded = json.dumps(action, sort_keys=True, default=str)
+                rows.setdefault(action["type"], []).append((dedup_key(event_key, encoded), action["type"], encoded, now, now))
+        if not rows:
+            return
+        counts = []
+        try:
+            for type, type_rows in rows.items():
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (dedup_key, type, action, next_attempt, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    type_rows
+                )
+                counts.append((type, conn.total_changes - before, len(type_rows)))
+            conn.commit()
+        except sqlite3.Error:
+            # Keep the actions for the next pass
+            for item in items:
+                self._intake.put(item)
+            raise
+        finally:
+            for _ in items:
+                self._intake.task_done()
+        for type, inserted, total in counts:
+            DISPATCHED.inc(inserted, type=type, outcome="enqueued")
+            if inserted < total:
+                DISPATCHED.inc(total - inserted, type=type, outcome="duplicate")
+
+    def _schedule(self, conn: sqlite3.Connection):
+        now = time.time()
+        for type, handler in self.handlers.items():
+            free = handler.concurrency - self._busy.get(type, 0)
+            if free <= 0:
+                continue
+            # Unbatched handlers get a chunk of actions per task, called one at a time
+            chunk = handler.batch_size if handler.batch_size > 1 else UNBATCHED_CHUNK
+            # One statement, so another worker's dispatcher cannot claim the same rows.
+            # Running rows whose lease ran out belong to a dispatcher that died.
+            rows = conn.execute(
+                "UPDATE outbox SET status = 'running', attempts = attempts + 1, owner = ?, lease_until = ?, updated_at = ? "
+                "WHERE id IN (SELECT id FROM outbox WHERE type = ? AND ("
+                "(status = 'pending' AND next_attempt <= ?) OR (status = 'running' AND lease_until < ?)"
+                ") ORDER BY next_attempt LIMIT ?) "
+                "RETURNING id, action, attempts",
+                (self.owner, now + LEASE_SECONDS, now, type, now, now, free * chunk)
+            ).fetchall()
+            conn.commit()
+            if not rows:
+                continue
+            pool = self._pools.get(type)
+            if pool is None:
+                pool = self._pools[type] = ThreadPoolExecutor(max_workers=handler.concurrency, thread_name_prefix=f"dispatch-{type}")
+            # Spread the rows over the free workers
+            size = max(1, min(chunk, -(-len(rows) // free)))
+            for i in range(0, len(rows), size):
+                self._busy[type] = self._busy.get(type, 0) + 1
+                pool.submit(self._call, handler, rows[i:i + size])
+
+    def _call(self, handler: ActionHandler, rows: List[Tuple]):
+        """Run a task's claimed (id, action, attempts) rows; reports (type, done ids, [(id, attempts, error)])"""
+        done, failed = [], []
+        if handler.batch_size > 1:
+            started = time.perf_counter()
+            try:
+                handler.fn([json.loads(row[1]) for row in rows])
+                done = [row[0] for row in rows]
+            except Exception as e:
+                failed = [(row[0], row[2], f"{type(e).__name__}: {e}") for row in rows]
+            CALL_SECONDS.observe(time.perf_counter() - started, type=handler.type)
+        else:
+            for row in rows:
+                started = time.perf_counter()
+                try:
+                    handler.fn(json.loads(row[1]))
+                    done.append(row[0])
+                except Exception as e:
+                    failed.append((row[0], row[2], f"{type(e).__name__}: {e}"))
+                CALL_SECONDS.observe(time.perf_counter() - started, type=handler.type)
+        self._results.put((handler.type, done, failed))
+        self._wake.set()
+
+    def _apply_results(self, conn: sqlite3.Connection):
+        now = time.time()
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+        if not results:
+            return
+        outcomes = []
+        # Rows are only updated while this dispatcher still owns them
+        try:
+            for type, done, failed in results:
+                if done:
+                    conn.execute(
+                        f"UPDATE outbox SET status = 'done', updated_at = ? WHERE owner = ? AND id IN ({','.join(map(str, done))})",
+                        (now, self.owner)
+                    )
+                    outcomes.append((type, "done", len(done)))
+                handler = self.handlers.get(type)
+                max_attempts = handler.max_attempts if handler else 1
+                for action_id, attempts, error in failed:
+                    if attempts >= max_attempts:
+                        conn.execute(
+                            "UPDATE outbox SET status = 'dead', last_error = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                            (error, now, action_id, self.owner)
+                        )
+                        outcomes.append((type, "dead", 1))
+                        logger.error(f"Action {action_id} ({type}) failed {attempts} times, giving up: {error}")
+                    else:
+                        conn.execute(
+                            "UPDATE outbox SET status = 'pending', next_attempt = ?, last_error = ?, updated_at = ? "
+                            "WHERE id = ? AND owner = ?",
+                            (now + backoff(attempts), error, now, action_id, self.owner)
+                        )
+                        outcomes.append((type, "retried", 1))
+            conn.commit()
+        except sqlite3.Error:
+            # Apply them again on the next pass
+            for result in results:
+                self._results.put(result)
+            raise
+        for type, _, _ in results:
+            self._busy[type] -= 1
+        for type, outcome, count in outcomes:
+            DISPATCHED.inc(count, type=type, outcome=outcome)
+
+    def _renew(self, conn: sqlite3.Connection):
+        """Extend the lease on this dispatcher's running actions"""
+        now = time.time()
+        if now - self._last_renewal < LEASE_SECONDS / 3:
+            return
+        self._last_renewal = now
+        conn.execute(
+            "UPDATE outbox SET lease_until = ? WHERE status = 'running' AND owner = ?",
+            (now + LEASE_SECONDS, self.owner)
+        )
+        conn.commit()
+
+    def _purge(self, conn: sqlite3.Connection):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        conn.execute("DELETE FROM outbox WHERE status = 'done' AND updated_at < ?", (now - RETENTION_SECONDS,))
+        conn.commit()
+
+    def stats(self) -> Dict:
+        """Outbox counts by type and status"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            rows = conn.execute("SELECT type, status, COUNT(*) FROM outbox GROUP BY type, status").fetchall()
+        finally:
+            conn.close()
+        counts: Dict[str, Dict[str, int]] = {}
+        for type, status, count in rows:
+            counts.setdefault(type, {})[status] = count
+        return {"handlers": sorted(self.handlers), "queued": self._intake.qsize(), "outbox": counts}
+
+    def wait_idle(self, timeout: float = 60) -> bool:
+        """Block until everything submitted is done or dead (for tests and benchmarks)"""
+        deadline = time.monotonic() + timeout
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            while time.monotonic() < deadline:
+                # unfinished_tasks counts submissions not yet committed to the outbox
+                if not self._intake.unfinished_tasks and not conn.execute(
+                    "SELECT 1 FROM outbox WHERE status IN ('pending', 'running') LIMIT 1"
+                ).fetchone():
+                    return True
+                time.sleep(POLL_INTERVAL)
+            return False
+        finally:
+            conn.close()
+
+def register_stub_handlers(types: Iterable[str], latency_ms: float = 0.0, batch_size: int = 1, concurrency: int = 4) -> StubHandler:
+    stub = StubHandler(latency_ms)
+    for type in types:
+        register_handler(type, stub, concurrency=concurrency, batch_size=batch_size)
+    return stub
+
+_dispatcher: Optional[ActionDispatcher] = None
+
+def start_action_dispatch() -> Optional[ActionDispatcher]:
+    """Import handler modules and start the dispatcher when DISPATCH_ENABLED is set"""
+    global _dispatcher
+    if not ENABLED or _dispatcher is not None:
+        return _dispatcher
+    for module in filter(None, (m.strip() for m in os.getenv("DISPATCH_HANDLERS", "").split(","))):
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.error(f"Failed to import action handlers from {module}: {e}")
+    stub_types = [t.strip() for t in os.getenv("DISPATCH_STUB_TYPES", "").split(",") if t.strip()]
+    if stub_types:
+        register_stub_handlers(stub_types, float(os.getenv("DISPATCH_STUB_LATENCY_MS", "0")),
+                               int(os.getenv("DISPATCH_STUB_BATCH_SIZE", "1")))
+    if not _handlers:
+        logger.warning("DISPATCH_ENABLED is set but no action handlers are registered")
+    _dispatcher = ActionDispatcher()
+    _dispatcher.start()
+    logger.info(f"Dispatching actions of type {', '.join(sorted(_handlers))} via {OUTBOX_PATH}")
+    return _dispatcher
+
+def stop_action_dispatch():
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.stop()
+        _dispatcher = None
+
+def get_action_dispatcher() -> Optional[ActionDispatcher]:
+    return _dispatcher
+
+def bench(args):
+    if os.path.exists(args.outbox):
+        os.remove(args.outbox)
+    stub = register_stub_handlers(["send_alert"], args.latency_ms, args.batch_size, args.concurrency)
+    dispatcher = ActionDispatcher(args.outbox, {"send_alert": _handlers["send_alert"]})
+    dispatcher.start()
+    started = time.perf_counter()
+    submit_seconds = 0.0
+    for i in range(0, args.actions, args.per_event):
+        actions = [{"type": "send_alert", "payload": {"n": n}} for n in range(i, min(i + args.per_event, args.actions))]
+        t = time.perf_counter()
+        dispatcher.submit(f"event-{i}", actions)
+        submit_seconds += time.perf_counter() - t
+    dispatcher.wait_idle(timeout=600)
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+    events = -(-args.actions // args.per_event)
+    print(f"{stub.actions} actions in {stub.calls} calls, {elapsed:.2f}s ({stub.actions / elapsed:,.0f}/s); "
+          f"submit {submit_seconds / events * 1e6:.1f}us per event")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Action dispatch tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="Dispatch stub actions and report throughput")
+    b.add_argument("--actions", type=int, default=100000)
+    b.add_argument("--per-event", type=int, default=2)
+    b.add_argument("--batch-size", type=int, default=100)
+    b.add_argument("--concurrency", type=int, default=4)
+    b.add_argument("--latency-ms", type=float, default=1.0, help="Stub latency per call")
+    b.add_argument("--outbox", default="bench_outbox.db")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    bench(args)
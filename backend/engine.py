@@ -0,0 +1,293 @@
+"""
+Embeddable rules engine
+
+RulesEngine evaluates rules in-process, with no HTTP, no request validation and no database
+access per event. Evaluation has the same semantics as POST /evaluate: rules in priority
+order, stop_on_match, templates, decision tables, value sets, sliding windows, context
+providers, forward chaining and time budgets. The response has the same shape too.
+
+    engine = RulesEngine.from_ndjson("rules.ndjson", value_sets={"blocked_cards": [...]})
+    engine = RulesEngine.from_rules([{"name": ..., "conditions": ..., "actions": ...}])
+    engine = RulesEngine.from_database()  # the active rules, as the server loads them
+
+    engine.evaluate({"type": "payment", "amount": 900}, {"country": "US"})
+    engine.evaluate_many([event, (event, context), (event, context, event_id)])
+    engine.simulate("high_value_payment", event)
+
+Rule dicts are validated like a bulk import (see bulk_rules.py), so `GET /rules/export`
+output loads as it is, and rules of equal priority keep the file's order, which is the
+order the server evaluates them in. Rules with "active": false can be simulated but are not evaluated.
+A template rule can carry its parameter table under "parameters", as returned by
+GET /rules/{rule_id}/parameters. Value sets are given as {name: values}, or as
+{name: {version: values}} for pinned versions. They live in the process-wide value set
+registry, so a (name, version) that is already loaded is shared.
+
+Nothing is audited unless audit sinks are added. Each sink is called with every
+evaluation's audit record. The first id a sink returns becomes the response's audit_log_id.
+The engine is a snapshot of its rules; build a new one to pick up changes.
+
+Usage:
+    python engine.py rules.ndjson [--value-sets sets.json] [--chain] < events.ndjson
+    python engine.py rules.ndjson --events events.ndjson --bench [--repeat N]
+"""
+import argparse
+import json
+import sys
+import time
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from sqlalchemy.orm import Session
+
+from ruleset import (
+    CompiledRule, CompiledRuleset, EvaluationBudget, build_ruleset, compile_spec, load_value_sets,
+    rule_spec, ruleset_fingerprint
+)
+from chaining import evaluate_chained
+from context_providers import enrich_context
+from bulk_rules import BulkImportError, parse_rules, validate_rules
+from templates import ParameterRow, collect_param_refs, validate_parameter_rows
+from value_sets import get_value_set_registry, validate_values
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Called with the audit record of an evaluation; may return the id it was stored under
+AuditSink = Callable[[Dict], Optional[str]]
+
+def evaluate_ruleset(ruleset: CompiledRuleset, event: Dict, context: Dict, chain: bool = False,
+                     max_iterations: int = None, record_windows: bool = True, stats=None,
+                     budget: EvaluationBudget = None):
+    """(matched_rules, actions, explanation, chain summary or None)"""
+    if chain:
+        return evaluate_chained(ruleset, event, context, max_iterations, record_windows, stats, budget)
+    return (*ruleset.evaluate(event, context, record_windows, stats, budget), None)
+
+def simulation_response(rule_id: str, rule_name: str, result) -> Dict:
+    """Response of /rules/{rule_id}/simulate for a rule result"""
+    return {
+        "matched": result.matched,
+        "rule_id": rule_id,
+        "rule_name": rule_name,
+        "would_execute": result.actions,
+        "explanation": result.explanation,
+        **result.details
+    }
+
+def load_value_set_map(value_sets: Dict[str, Union[List, Dict]]) -> Set[Tuple[str, int]]:
+    """Register {name: values} (as version 1) or {name: {version: values}}; returns the keys"""
+    registry = get_value_set_registry()
+    keys = set()
+    for name, values in value_sets.items():
+        versions = {int(v): members for v, members in values.items()} if isinstance(values, dict) else {1: values}
+        for version, members in versions.items():
+            error = validate_values(members)
+            if error:
+                raise ValueError(f"Value set {name} v{version}: {error}")
+            registry.put(name, version, members)
+            keys.add((name, version))
+        registry.set_latest(name, max(versions))
+    return keys
+
+def _parameter_rows(rule_id: str, keys: List[str], required: Set[str], rows: Any) -> Tuple[List[ParameterRow], Optional[str]]:
+    if not isinstance(rows, list):
+        return [], "parameters must be a list of rows"
+    for i, row in enumerate(rows):
+        valid = isinstance(row, dict) and isinstance(row.get("key"), (list, type(None))) and isinstance(row.get("params", {}), dict)
+        if not valid:
+            return [], f"Row {i}: must be an object with a key list (or null) and a params object"
+    error = validate_parameter_rows(keys, rows, required)
+    if error:
+        return [], error
+    return [ParameterRow(row.get("id") or f"{rule_id}:{i}", row.get("key"), row.get("params", {}))
+            for i, row in enumerate(rows)], None
+
+class RulesEngine:
+    """A compiled ruleset with the evaluation API of the server"""
+
+    def __init__(self, ruleset: CompiledRuleset, inactive: Optional[List[CompiledRule]] = None,
+                 value_sets: Optional[Set[Tuple[str, int]]] = None, audit_sinks: Optional[List[AuditSink]] = None,
+                 record_windows: bool = True):
+        self.ruleset = ruleset
+        self.audit_sinks: List[AuditSink] = list(audit_sinks or [])
+        # Without it, events are not counted in the sliding windows (as in historical replays)
+        self.record_windows = record_windows
+        self._rules = {rule.id: rule for rule in inactive or []}
+        self._rules.update((rule.id, rule) for rule in ruleset.rules)
+        # Keep the engine's value sets loaded when the server's ruleset reloads in this process
+        self._owner = f"engine-{id(self)}"
+        if value_sets:
+            get_value_set_registry().hold(self._owner, value_sets)
+
+    @classmethod
+    def from_rules(cls, rules: List[Dict], value_sets: Optional[Dict[str, Union[List, Dict]]] = None, **options) -> "RulesEngine":
+        """Validate and compile rule dicts; raises BulkImportError listing every invalid rule"""
+        keys = load_value_set_map(value_sets or {})
+        parameters: Dict[int, List[ParameterRow]] = {}
+
+        def check_parameters(index: int, rule) -> Optional[str]:
+            if not rule.parameter_keys:
+                return None
+            required = collect_param_refs(rule.conditions) | collect_param_refs(rule.actions)
+            parameters[index], error = _parameter_rows(rule.id, rule.parameter_keys, required,
+                                                       rules[index].get("parameters") or [])
+            return error
+
+        validated = validate_rules(None, rules, keys, check_parameters)
+        active, inactive = [], []
+        for index, (item, rule) in enumerate(zip(rules, validated)):
+            compiled = compile_spec(rule_spec({**rule.model_dump(), "version": item.get("version") or 1},
+                                              parameters.get(index)))
+            (inactive if rule.active is False else active).append(compiled)
+
+        active.sort(key=lambda r: r.priority, reverse=True)
+        return cls(CompiledRuleset(active), inactive, keys, **options)
+
+    @classmethod
+    def from_ndjson(cls, path: str, value_sets: Optional[Dict[str, Union[List, Dict]]] = None, **options) -> "RulesEngine":
+        """Rules from an NDJSON file (or a JSON array), such as GET /rules/export output"""
+        with open(path, "rb") as f:
+            return cls.from_rules(parse_rules(f.read()), value_sets, **options)
+
+    @classmethod
+    def from_database(cls, db: Optional[Session] = None, **options) -> "RulesEngine":
+        """The active rules and the value sets they reference, loaded once"""
+        if db is None:
+            from database import SessionLocal
+            with SessionLocal() as session:
+                return cls.from_database(session, **options)
+        ruleset = build_ruleset(db, ruleset_fingerprint(db))
+        keys = load_value_sets(db, [rule.conditions for rule in ruleset.rules])
+        return cls(ruleset, value_sets=keys, **options)
+
+    def __len__(self) -> int:
+        return len(self.ruleset.rules)
+
+    def add_audit_sink(self, sink: AuditSink):
+        self.audit_sinks.append(sink)
+
+    def close(self):
+        """Release the engine's value sets"""
+        get_value_set_registry().hold(self._owner, set())
+
+    def evaluate(self, event: Dict, context: Optional[Dict] = None, event_id: Optional[str] = None,
+                 chain: bool = False, max_iterations: Optional[int] = None, budget_ms: Optional[float] = None) -> Dict:
+        """Evaluate the active rules; returns the /evaluate response"""
+        start_time = time.time()
+        budget = EvaluationBudget.for_request(budget_ms, start_time)
+        context = enrich_context(event, context or {})
+        matched_rules, actions, explanation, chain_summary = evaluate_ruleset(
+            self.ruleset, event, context, chain, max_iterations, self.record_windows, budget=budget
+        )
+        evaluation_time_ms = int((time.time() - start_time) * 1000)
+
+        audit_id = None
+        if self.audit_sinks:
+            record = {
+                "event_id": event_id,
+                "event": event,
+                "context": dict(context),
+                "matched_rules": matched_rules,
+                "actions": actions,
+                "explanation": explanation,
+                "evaluation_time_ms": evaluation_time_ms
+            }
+            for sink in self.audit_sinks:
+                stored_id = sink(record)
+                audit_id = audit_id or stored_id
+
+        response = {
+            "actions": actions,
+            "matched_rules": matched_rules,
+            "explanation": explanation,
+            "evaluation_time_ms": evaluation_time_ms,
+            "audit_log_id": audit_id
+        }
+        if chain_summary is not None:
+            response["chain"] = chain_summary
+        if budget is not None:
+            response["skipped_rules"] = budget.skipped
+        return response
+
+    def evaluate_many(self, events: Iterable[Union[Dict, Tuple]], context: Optional[Dict] = None, **options) -> List[Dict]:
+        """
+        Evaluate a sequence of events, each either an event (evaluated with `context`) or an
+        (event, context) or (event, context, event_id) tuple. Options are those of evaluate().
+        """
+        results = []
+        for item in events:
+            if isinstance(item, tuple):
+                results.append(self.evaluate(*item, **options))
+            else:
+                results.append(self.evaluate(item, context, **options))
+        return results
+
+    def simulate(self, rule_id: str, event: Dict, context: Optional[Dict] = None) -> Dict:
+        """Evaluate one rule, active or not; returns the /rules/{rule_id}/simulate response"""
+        rule = self._rules.get(rule_id)
+        if rule is None:
+            raise KeyError(f"Unknown rule {rule_id}")
+        return simulation_response(rule.id, rule.name, rule.evaluate(event, enrich_context(event, context or {})))
+
+def _read_events(lines: Iterable[bytes]) -> List[Tuple]:
+    """(event, context, event_id) from NDJSON lines of /evaluate requests or bare events"""
+    events = []
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if "event" in item:
+            events.append((item["event"], item.get("context") or {}, item.get("event_id")))
+        else:
+            events.append((item, {}, None))
+    return events
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate events in-process against a rules file")
+    parser.add_argument("rules", help="Rules as NDJSON or a JSON array")
+    parser.add_argument("--value-sets", help="JSON file of {name: values}")
+    parser.add_argument("--events", help="NDJSON events or /evaluate requests (default stdin)")
+    parser.add_argument("--chain", action="store_true", help="Forward chaining")
+    parser.add_argument("--bench", action="store_true", help="Report evaluation latency instead of printing results")
+    parser.add_argument("--repeat", type=int, default=10000, help="Evaluations to time with --bench")
+    args = parser.parse_args()
+
+    value_sets = None
+    if args.value_sets:
+        with open(args.value_sets) as f:
+            value_sets = json.load(f)
+    try:
+        engine = RulesEngine.from_ndjson(args.rules, value_sets, record_windows=not args.bench)
+    except BulkImportError as e:
+        for error in e.errors:
+            print(error, file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.events:
+        with open(args.events, "rb") as f:
+            events = _read_events(f)
+    else:
+        events = _read_events(sys.stdin.buffer)
+
+    if not args.bench:
+        for result in engine.evaluate_many(events, chain=args.chain):
+            sys.stdout.buffer.write(dumps(result) + b"\n")
+        sys.exit(0)
+
+    if not events:
+        print("No events to time", file=sys.stderr)
+        sys.exit(1)
+    timings = []
+    for i in range(args.repeat):
+        event, context, event_id = events[i % len(events)]
+        started = time.perf_counter()
+        engine.evaluate(event, context, event_id, chain=args.chain)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print(f"{len(engine)} rules, {args.repeat} evaluations: "
+          f"mean {sum(timings) / len(timings) * 1e6:.1f} us, "
+          f"p50 {timings[len(timings) // 2] * 1e6:.1f} us, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1e6:.1f} us")
@@ -1,10 +1,17 @@
 """
 Enhanced condition evaluator with support for multiple operators and functions
 """
-import re
+import json
 from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 
+from functools import lru_cache
+
+from geo import GEO_OPS, GeofenceIndex, compile_fence, geo_value_error, haversine_km, parse_point
+from safe_regex import MAX_INPUT_LENGTH, compile_regex, regex_error
+from value_sets import MEMBERSHIP_OPS, get_value_set_registry
+from windows import WINDOW_FUNCTIONS, WindowSpec, get_window_store
+
 def get_nested_value(obj: Dict, path: str) -> Any:
     """Get nested value from object using dot notation (e.g., 'user.tier')"""
     parts = path.split(".")
@@ -29,14 +36,91 @@ def days_since(date_str: str) -> Optional[int]:
         pass
     return None
 
-def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Optional[List] = None) -> Tuple[bool, List]:
+class ClauseTable:
+    """
+    Clauses (leaves or whole sub-trees) that occur more than once across a ruleset.
+    Each distinct clause gets a slot; every occurrence of it maps to that slot, so the
+    clause is evaluated at most once per event. Clauses that read template parameters
+    are never shared, since their result depends on the rule's parameter row.
+    """
+
+    def __init__(self, conditions_list: List[Any]):
+        occurrences: Dict[str, List[Dict]] = {}
+        for condition in conditions_list:
+            self._collect(condition, occurrences)
+        self.slots: Dict[int, int] = {}
+        self.size = 0
+        for nodes in occurrences.values():
+            if len(nodes) < 2:
+                continue
+            for node in nodes:
+                self.slots[id(node)] = self.size
+            self.size += 1
+        # The conditions must outlive the table: slots are keyed by object identity
+        self._conditions = conditions_list
+
+    def _collect(self, condition: Any, occurrences: Dict[str, List[Dict]]) -> bool:
+        """Register every shareable sub-tree; returns False if the tree reads a parameter"""
+        if not isinstance(condition, dict) or not condition:
+            return False
+        shareable = "param" not in condition
+        for clause in condition.get("clauses", []) or []:
+            shareable = self._collect(clause, occurrences) and shareable
+        if shareable:
+            key = json.dumps(condition, sort_keys=True, default=str)
+            occurrences.setdefault(key, []).append(condition)
+        return shareable
+
+class ClauseMemo:
+    """
+    Per-event results of shared clauses (0 = not evaluated, 1 = false, 2 = true), and of
+    geofence index probes by point
+    """
+    __slots__ = ("slots", "results", "explanations", "geofences", "probes")
+
+    def __init__(self, table: ClauseTable, geofences: Optional[GeofenceIndex] = None):
+        self.slots = table.slots
+        self.results = bytearray(table.size)
+        self.explanations: List[Optional[List]] = [None] * table.size
+        self.geofences = geofences
+        self.probes: Dict[Tuple[float, float], set] = {}
+
+    def probe(self, point: Tuple[float, float]) -> set:
+        """Keys of the indexed geofences containing `point`, probed once per event"""
+        hits = self.probes.get(point)
+        if hits is None:
+            hits = self.probes[point] = self.geofences.probe(point)
+        return hits
+
+def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Optional[List] = None,
+                   params: Optional[Dict] = None, memo: Optional[ClauseMemo] = None) -> Tuple[bool, List]:
     """
     Evaluate a condition AST against event and context.
+    `params` supplies values for clauses that use {"param": name} instead of "value".
+    With a `memo`, clauses shared across rules are evaluated once per event and their
+    result and explanation reused.
     Returns (result, explanation_list)
     """
     if explanation is None:
         explanation = []
-    
+
+    if memo is not None:
+        slot = memo.slots.get(id(condition))
+        if slot is not None:
+            cached = memo.results[slot]
+            if cached:
+                explanation.extend(memo.explanations[slot])
+                return cached == 2, explanation
+            start = len(explanation)
+            result, explanation = _eval_clause(condition, event, context, explanation, params, memo)
+            memo.results[slot] = 2 if result else 1
+            memo.explanations[slot] = explanation[start:]
+            return result, explanation
+
+    return _eval_clause(condition, event, context, explanation, params, memo)
+
+def _eval_clause(condition: Dict, event: Dict, context: Dict, explanation: List,
+                 params: Optional[Dict], memo: Optional[ClauseMemo]) -> Tuple[bool, List]:
     if not condition:
         return True, explanation
     
@@ -49,13 +133,13 @@ def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Opt
             if len(clauses) != 1:
                 explanation.append({"error": "NOT operator requires exactly one clause"})
                 return False, explanation
-            result, sub_expl = eval_condition(clauses[0], event, context, [])
+            result, sub_expl = eval_condition(clauses[0], event, context, [], params, memo)
             explanation.extend(sub_expl)
             return not result, explanation
         
         results = []
         for clause in clauses:
-            result, sub_expl = eval_condition(clause, event, context, [])
+            result, sub_expl = eval_condition(clause, event, context, [], params, memo)
             results.append(result)
             explanation.extend(sub_expl)
         
@@ -68,6 +152,15 @@ def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Opt
             explanation.append({"operator": "OR", "results": results, "final": final})
             return final, explanation
     
+    # Resolve template parameters
+    if "param" in condition:
+        name = condition["param"]
+        if not params or name not in params:
+            explanation.append({"error": f"Missing parameter: {name}", "param": name})
+            return False, explanation
+        condition = {**condition, "value": params[name]}
+        condition.pop("param")
+    
     # Handle function calls
     if "fn" in condition:
         fn_name = condition["fn"]
@@ -93,6 +186,9 @@ def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Opt
             explanation.append({"function": "days_since", "field": field_path, "days": days})
             return True, explanation
         
+        if fn_name in WINDOW_FUNCTIONS:
+            return _eval_window(condition, event, context, explanation)
+        
         explanation.append({"error": f"Unknown function: {fn_name}"})
         return False, explanation
     
@@ -105,7 +201,17 @@ def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Opt
         # Merge event and context
         merged = {"event": event, "context": context}
         actual = get_nested_value(merged, field)
-        
+
+        # Membership against a shared, named value set
+        if "value_set" in condition:
+            return _eval_value_set(condition, field, op, actual, explanation)
+
+        if op in GEO_OPS:
+            return _eval_geo(condition, field, op, actual, merged, explanation, memo)
+
+        if op == "regex":
+            return _eval_regex(condition, field, actual, explanation)
+
         result = _compare_values(actual, op, val)
         
         explanation.append({
@@ -121,6 +227,180 @@ def eval_condition(condition: Dict, event: Dict, context: Dict, explanation: Opt
     explanation.append({"error": "Invalid condition structure"})
     return False, explanation
 
+@lru_cache(maxsize=4096)
+def _window_spec(fn: str, args: Tuple) -> WindowSpec:
+    return WindowSpec.from_condition({"fn": fn, "args": list(args)})
+
+def _eval_window(condition: Dict, event: Dict, context: Dict, explanation: List) -> Tuple[bool, List]:
+    """Evaluate count_over / sum_over / distinct_count_over against the window store"""
+    fn_name = condition["fn"]
+    try:
+        spec = _window_spec(fn_name, tuple(condition.get("args", [])))
+    except (ValueError, TypeError) as e:
+        explanation.append({"error": str(e)})
+        return False, explanation
+    
+    key = get_nested_value({"event": event, "context": context}, spec.key_field)
+    if key is None:
+        explanation.append({"function": fn_name, "field": spec.key_field, "result": None, "error": "Missing key"})
+        return False, explanation
+    
+    aggregate = get_window_store().query(spec, key)
+    entry = {"function": fn_name, "field": spec.key_field, "window": spec.window, "aggregate": aggregate}
+    if spec.value_field:
+        entry["value_field"] = spec.value_field
+    if "op" in condition and "value" in condition:
+        op = condition["op"]
+        val = condition["value"]
+        result = _compare_values(aggregate, op, val)
+        entry.update({"op": op, "value": val, "result": result})
+        explanation.append(entry)
+        return result, explanation
+    explanation.append(entry)
+    return True, explanation
+
+def _eval_value_set(condition: Dict, field: str, op: str, actual: Any, explanation: List) -> Tuple[bool, List]:
+    """Evaluate an `in`/`not_in` clause against a named value set"""
+    name = condition["value_set"]
+    version = condition.get("value_set_version")
+
+    if op not in MEMBERSHIP_OPS:
+        explanation.append({"error": f"Operator {op} is not supported with value_set"})
+        return False, explanation
+
+    members = get_value_set_registry().get(name, version)
+    if members is None:
+        explanation.append({"field": field, "error": f"Unknown value set: {name}", "result": False})
+        return False, explanation
+
+    result = False
+    if actual is not None:
+        try:
+            result = (actual in members) if op == "in" else (actual not in members)
+        except TypeError:
+            result = False
+
+    explanation.append({
+        "field": field,
+        "operator": op,
+        "expected": {"value_set": members.name, "version": members.version},
+        "actual": actual,
+        "result": result
+    })
+    return result, explanation
+
+COMPARISON_OPS = ("==", "!=", ">", "<", ">=", "<=", "in", "not_in", "contains", "regex", "starts_with", "ends_with") + GEO_OPS
+FUNCTIONS = ("days_since",) + WINDOW_FUNCTIONS
+
+def validate_condition(condition: Any, path: str = "conditions") -> Optional[str]:
+    """Check the structure of a condition AST without evaluating it; returns an error or None"""
+    if not isinstance(condition, dict):
+        return f"{path}: expected an object"
+    if not condition:
+        return None
+
+    if "type" in condition and condition["type"] in ["AND", "OR", "NOT"]:
+        clauses = condition.get("clauses")
+        if not isinstance(clauses, list):
+            return f"{path}: {condition['type']} requires a list of clauses"
+        if condition["type"] == "NOT" and len(clauses) != 1:
+            return f"{path}: NOT operator requires exactly one clause"
+        for i, clause in enumerate(clauses):
+            error = validate_condition(clause, f"{path}.clauses[{i}]")
+            if error:
+                return error
+        return None
+
+    op = condition.get("op")
+    if op is not None and op not in COMPARISON_OPS:
+        return f"{path}: unknown operator {op}"
+
+    if "fn" in condition:
+        fn_name = condition["fn"]
+        if fn_name not in FUNCTIONS:
+            return f"{path}: unknown function {fn_name}"
+        if fn_name in WINDOW_FUNCTIONS:
+            try:
+                WindowSpec.from_condition(condition)
+            except (ValueError, TypeError) as e:
+                return f"{path}: {e}"
+        elif len(condition.get("args", [])) != 1:
+            return f"{path}: days_since requires one argument"
+        return None
+
+    if "field" not in condition or op is None:
+        return f"{path}: invalid condition structure"
+    if "value_set" in condition and op not in MEMBERSHIP_OPS:
+        return f"{path}: operator {op} is not supported with value_set"
+    if op in GEO_OPS and "param" not in condition:
+        error = geo_value_error(op, condition.get("value"))
+        if error:
+            return f"{path}: {error}"
+    if op == "regex" and "param" not in condition:
+        error = regex_error(condition.get("value"))
+        if error:
+            return f"{path}: {error}"
+    if "max_length" in condition and (not isinstance(condition["max_length"], int) or condition["max_length"] < 0):
+        return f"{path}: max_length must be a non-negative integer"
+    return None
+
+def _eval_regex(condition: Dict, field: str, actual: Any, explanation: List) -> Tuple[bool, List]:
+    """Evaluate a regex clause with a precompiled, safety-checked pattern and a capped input length"""
+    val = condition.get("value")
+    entry = {"field": field, "operator": "regex", "expected": val, "actual": actual, "result": False}
+    explanation.append(entry)
+    if not isinstance(actual, str):
+        return False, explanation
+    compiled, error = compile_regex(val) if isinstance(val, str) else (None, regex_error(val))
+    if compiled is None:
+        entry["error"] = error
+        return False, explanation
+    max_length = condition.get("max_length", MAX_INPUT_LENGTH)
+    if len(actual) > max_length:
+        entry["actual"] = actual[:64] + "..."
+        entry["error"] = f"Input is longer than {max_length} characters"
+        return False, explanation
+    entry["result"] = compiled.search(actual) is not None
+    return entry["result"], explanation
+
+def _eval_geo(condition: Dict, field: str, op: str, actual: Any, merged: Dict, explanation: List,
+              memo: Optional[ClauseMemo]) -> Tuple[bool, List]:
+    """Evaluate within_polygon / within_radius / distance_gt; fences use the shared index when there is one"""
+    val = condition.get("value")
+    entry = {"field": field, "operator": op, "expected": val, "actual": actual, "result": False}
+    explanation.append(entry)
+    if actual is None:
+        return False, explanation
+    point = parse_point(actual)
+    if point is None:
+        entry["error"] = "Not a point"
+        return False, explanation
+
+    if op == "distance_gt":
+        error = geo_value_error(op, val)
+        other = None
+        if error is None:
+            other = parse_point(get_nested_value(merged, val["from"])) if "from" in val else parse_point(val["point"])
+        if other is None:
+            entry["error"] = error or f"{val['from']} is not a point"
+            return False, explanation
+        distance = haversine_km(point, other)
+        entry["distance_km"] = round(distance, 3)
+        entry["result"] = distance > val["km"]
+        return entry["result"], explanation
+
+    fence = memo.geofences.clauses.get(id(condition)) if memo is not None and memo.geofences is not None else None
+    if fence is not None:
+        entry["result"] = fence.key in memo.probe(point)
+        return entry["result"], explanation
+
+    fence = compile_fence(op, val)
+    if fence is None:
+        entry["error"] = geo_value_error(op, val)
+        return False, explanation
+    entry["result"] = fence.contains(point)
+    return entry["result"], explanation
+
 def _compare_values(actual: Any, op: str, expected: Any) -> bool:
     """Compare actual value with expected using operator"""
     if actual is None:
@@ -154,8 +434,9 @@ def _compare_values(actual: Any, op: str, expected: Any) -> bool:
                 return expected in actual
             return False
         elif op == "regex":
-            if isinstance(actual, str) and isinstance(expected, str):
-                return bool(re.search(expected, actual))
+            if isinstance(actual, str) and isinstance(expected, str) and len(actual) <= MAX_INPUT_LENGTH:
+                compiled, _ = compile_regex(expected)
+                return compiled is not None and compiled.search(actual) is not None
             return False
         elif op == "starts_with":
             if isinstance(actual, str) and isinstance(expected, str):
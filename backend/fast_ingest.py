@@ -0,0 +1,165 @@
+"""
+Fast ingestion path for /evaluate/raw
+
+The request body is read as raw bytes and only the field paths referenced by the active
+ruleset are extracted from it. Rules are evaluated against sparse `event`/`context` dicts
+holding just those values, so nothing else in the payload is turned into Python objects.
+The full payload is only decoded when the audit log needs it.
+
+pysimdjson is used for on-demand extraction when installed, then orjson, then the
+standard library json module.
+"""
+import json
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Try to import fast JSON parsers, but make them optional
+try:
+    import simdjson
+    SIMDJSON_AVAILABLE = True
+except ImportError:
+    SIMDJSON_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+class InvalidPayload(ValueError):
+    """Raised when the request body is not a valid evaluate request"""
+
+_local = threading.local()
+
+def _simdjson_parse(body: bytes):
+    """Parse with a per-thread parser (parsers are not thread-safe)"""
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = _local.parser = simdjson.Parser()
+    try:
+        return parser.parse(body)
+    except RuntimeError:
+        # A document from the previous parse is still referenced
+        parser = _local.parser = simdjson.Parser()
+        return parser.parse(body)
+
+def _loads(body: bytes) -> Any:
+    if ORJSON_AVAILABLE:
+        return orjson.loads(body)
+    return json.loads(body)
+
+def _to_python(value: Any) -> Any:
+    """Convert simdjson proxies into plain Python objects"""
+    if SIMDJSON_AVAILABLE:
+        if isinstance(value, simdjson.Object):
+            return value.as_dict()
+        if isinstance(value, simdjson.Array):
+            return value.as_list()
+    return value
+
+def _set_path(target: Dict, parts: List[str], value: Any):
+    cur = target
+    for p in parts[:-1]:
+        nxt = cur.get(p)
+        if not isinstance(nxt, dict):
+            nxt = {}
+            cur[p] = nxt
+        cur = nxt
+    cur[parts[-1]] = value
+
+def _get_path(obj: Any, parts: List[str]) -> Tuple[bool, Any]:
+    """Same traversal rules as evaluator.get_nested_value, but reports misses"""
+    cur = obj
+    for p in parts:
+        if isinstance(cur, dict) and p in cur:
+            cur = cur[p]
+        elif isinstance(cur, list) and p.isdigit() and int(p) < len(cur):
+            cur = cur[int(p)]
+        else:
+            return False, None
+    return True, cur
+
+def _pointer(parts: List[str]) -> str:
+    return "/" + "/".join(p.replace("~", "~0").replace("/", "~1") for p in parts)
+
+class RawEvaluateRequest:
+    """
+    Evaluate request decoded on demand from raw bytes.
+    `event` and `context` hold only the referenced paths.
+    """
+
+    def __init__(self, body: bytes, paths: Iterable[str]):
+        self._doc = None
+        self._full = None
+        self.event: Dict[str, Any] = {}
+        self.context: Dict[str, Any] = {}
+
+        if SIMDJSON_AVAILABLE:
+            try:
+                self._doc = _simdjson_parse(body)
+            except ValueError as e:
+                raise InvalidPayload(f"Invalid JSON: {e}")
+            if not isinstance(self._doc, simdjson.Object):
+                raise InvalidPayload("Request body must be a JSON object")
+            lookup = self._lookup_simdjson
+        else:
+            try:
+                self._full = _loads(body)
+            except ValueError as e:
+                raise InvalidPayload(f"Invalid JSON: {e}")
+            if not isinstance(self._full, dict):
+                raise InvalidPayload("Request body must be a JSON object")
+            lookup = self._lookup_full
+
+        found, event = lookup(["event"], shallow=True)
+        if not found or not isinstance(event, dict):
+            raise InvalidPayload("'event' must be a JSON object")
+        self.event_id = lookup(["event_id"])[1]
+        self.async_mode = bool(lookup(["async_mode"])[1])
+        self.chain = bool(lookup(["chain"])[1])
+        # Historical replays and chaining options are handled by the full request path
+        self.as_of = lookup(["as_of"])[1]
+        self.max_iterations = lookup(["max_iterations"])[1]
+        self.budget_ms = lookup(["budget_ms"])[1]
+        if self.budget_ms is not None and (isinstance(self.budget_ms, bool) or not isinstance(self.budget_ms, (int, float))):
+            raise InvalidPayload("'budget_ms' must be a number")
+
+        extracted = set()
+        for path in sorted(set(paths), key=len):
+            parts = path.split(".")
+            if parts[0] not in ("event", "context") or len(parts) < 2:
+                continue
+            # Skip paths inside a subtree that was already extracted whole
+            if any(tuple(parts[:i]) in extracted for i in range(2, len(parts))):
+                continue
+            found, value = lookup(parts)
+            if found:
+                extracted.add(tuple(parts))
+                _set_path(self.event if parts[0] == "event" else self.context, parts[1:], value)
+
+    def _lookup_simdjson(self, parts: List[str], shallow: bool = False) -> Tuple[bool, Any]:
+        try:
+            value = self._doc.at_pointer(_pointer(parts))
+        except (KeyError, IndexError, ValueError, TypeError):
+            return False, None
+        if shallow and isinstance(value, simdjson.Object):
+            # Only the type is needed here; avoid converting the whole event
+            return True, {}
+        return True, _to_python(value)
+
+    def _lookup_full(self, parts: List[str], shallow: bool = False) -> Tuple[bool, Any]:
+        return _get_path(self._full, parts)
+
+    def _materialize(self) -> Dict:
+        if self._full is None:
+            self._full = _to_python(self._doc)
+        return self._full
+
+    def full_event(self) -> Dict:
+        """Decode the complete event (for audit storage)"""
+        return self._materialize().get("event") or {}
+
+    def full_context(self) -> Dict:
+        """Decode the complete context (for audit storage)"""
+        context = self._materialize().get("context")
+        return context if isinstance(context, dict) else {}
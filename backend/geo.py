@@ -0,0 +1,205 @@
+"""
+Geospatial operators and the shared geofence index
+
+Operators, on a field holding a point ({"lat": .., "lon": ..} or [lat, lon]):
+
+    {"field": "event.location", "op": "within_polygon", "value": [[lat, lon], [lat, lon], ...]}
+    {"field": "event.location", "op": "within_radius", "value": {"center": [lat, lon], "km": 25}}
+    {"field": "event.location", "op": "distance_gt", "value": {"from": "context.user.home", "km": 500}}
+
+`distance_gt` measures great-circle distance to another field ("from") or a fixed point
+("point").
+
+Every polygon and radius geofence in the ruleset is registered once (identical fences are
+shared) in a grid of GEO_CELL_DEGREES cells. An event's point is probed once: its cell gives the
+few candidate fences, only those are tested exactly, and the set of fences containing the
+point is reused by every rule that asks about it.
+"""
+import json
+import math
+import os
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+CELL_DEGREES = float(os.getenv("GEO_CELL_DEGREES", "0.5"))
+# Fences spanning more cells than this are tested on every probe instead of being gridded
+MAX_CELLS_PER_FENCE = 4096
+
+FENCE_OPS = ("within_polygon", "within_radius")
+GEO_OPS = FENCE_OPS + ("distance_gt",)
+
+Point = Tuple[float, float]
+
+def parse_point(value: Any) -> Optional[Point]:
+    """(lat, lon) from {"lat", "lon"/"lng"} or [lat, lon]; None if it is not a valid point"""
+    try:
+        if isinstance(value, dict):
+            lat, lon = value["lat"], value.get("lon", value.get("lng"))
+        elif isinstance(value, (list, tuple)) and len(value) == 2:
+            lat, lon = value
+        else:
+            return None
+        lat, lon = float(lat), float(lon)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+def haversine_km(a: Point, b: Point) -> float:
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+class Geofence:
+    """A polygon or circle with its bounding box"""
+    __slots__ = ("key", "kind", "vertices", "center", "km", "bbox")
+
+    def __init__(self, key: str, kind: str, vertices: Optional[List[Point]] = None,
+                 center: Optional[Point] = None, km: Optional[float] = None):
+        self.key = key
+        self.kind = kind
+        self.vertices = vertices
+        self.center = center
+        self.km = km
+        if kind == "within_polygon":
+            # Edges take the short way round, so a polygon crossing the antimeridian gets
+            # longitudes beyond +-180 instead of spanning the rest of the globe
+            self.vertices = vertices = _unwrap(vertices)
+            lats = [v[0] for v in vertices]
+            lons = [v[1] for v in vertices]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+        else:
+            dlat = math.degrees(km / EARTH_RADIUS_KM)
+            # Longitude degrees shrink towards the poles; near them the box spans every longitude
+            coslat = math.cos(math.radians(min(89.0, abs(center[0]) + dlat)))
+            dlon = min(180.0, dlat / coslat) if coslat > 0 else 180.0
+            self.bbox = (max(-90.0, center[0] - dlat), center[1] - dlon, min(90.0, center[0] + dlat), center[1] + dlon)
+
+    def contains(self, point: Point) -> bool:
+        if not (self.bbox[0] <= point[0] <= self.bbox[2]):
+            return False
+        if self.kind == "within_radius":
+            return haversine_km(self.center, point) <= self.km
+        for lon in (point[1], point[1] + 360, point[1] - 360):
+            if self.bbox[1] <= lon <= self.bbox[3] and _point_in_polygon((point[0], lon), self.vertices):
+                return True
+        return False
+
+def _unwrap(vertices: List[Point]) -> List[Point]:
+    """Shift each vertex's longitude by 360 degrees where that brings it closer to the previous one"""
+    unwrapped = [vertices[0]]
+    for lat, lon in vertices[1:]:
+        previous = unwrapped[-1][1]
+        unwrapped.append((lat, lon + 360 * round((previous - lon) / 360)))
+    return unwrapped
+
+def _point_in_polygon(point: Point, vertices: List[Point]) -> bool:
+    """Even-odd ray casting on (lat, lon) treated as planar coordinates"""
+    lat, lon = point
+    inside = False
+    j = len(vertices) - 1
+    for i in range(len(vertices)):
+        lat_i, lon_i = vertices[i]
+        lat_j, lon_j = vertices[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if lon < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+def geo_value_error(op: str, value: Any) -> Optional[str]:
+    """Why a geo clause's value is invalid, or None"""
+    if op == "within_polygon":
+        if not isinstance(value, list) or len(value) < 3:
+            return "within_polygon requires a list of at least 3 [lat, lon] points"
+        if any(parse_point(v) is None for v in value):
+            return "within_polygon points must be valid [lat, lon] pairs"
+        return None
+    if not isinstance(value, dict) or not isinstance(value.get("km"), (int, float)) or value["km"] < 0:
+        return f"{op} requires an object with a non-negative km"
+    if op == "within_radius":
+        if parse_point(value.get("center")) is None:
+            return "within_radius requires a center [lat, lon]"
+        return None
+    if op == "distance_gt":
+        if isinstance(value.get("from"), str):
+            return None
+        if parse_point(value.get("point")) is None:
+            return "distance_gt requires a point [lat, lon] or a from field"
+        return None
+    return f"Not a geo operator: {op}"
+
+def fence_key(op: str, value: Any) -> str:
+    return json.dumps([op, value], sort_keys=True)
+
+@lru_cache(maxsize=4096)
+def _compile_fence(key: str) -> Optional[Geofence]:
+    op, value = json.loads(key)
+    if geo_value_error(op, value):
+        return None
+    if op == "within_polygon":
+        return Geofence(key, op, vertices=[parse_point(v) for v in value])
+    return Geofence(key, op, center=parse_point(value["center"]), km=float(value["km"]))
+
+def compile_fence(op: str, value: Any) -> Optional[Geofence]:
+    """The geofence of a within_polygon/within_radius clause (None if the value is invalid)"""
+    return _compile_fence(fence_key(op, value))
+
+class GeofenceIndex:
+    """Grid of every geofence in a ruleset, probed once per point"""
+
+    def __init__(self, clauses: Iterable[Tuple[Dict, Geofence]]):
+        self.fences: Dict[str, Geofence] = {}
+        # Fence of each indexed clause, by clause identity, so evaluation does not re-key it
+        self.clauses: Dict[int, Geofence] = {}
+        self._cells: Dict[Tuple[int, int], List[Geofence]] = {}
+        self._large: List[Geofence] = []
+        for clause, fence in clauses:
+            self.clauses[id(clause)] = fence
+            if fence.key in self.fences:
+                continue
+            self.fences[fence.key] = fence
+            lat0, lon0 = _index(fence.bbox[0]), _index(fence.bbox[1])
+            lat1, lon1 = _index(fence.bbox[2]), _index(fence.bbox[3])
+            if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > MAX_CELLS_PER_FENCE:
+                self._large.append(fence)
+                continue
+            for i in range(lat0, lat1 + 1):
+                for j in range(lon0, lon1 + 1):
+                    self._cells.setdefault((i, _wrap(j)), []).append(fence)
+
+    def __len__(self) -> int:
+        return len(self.fences)
+
+    def probe(self, point: Point) -> Set[str]:
+        """Keys of every fence containing the point"""
+        candidates = self._cells.get(_cell(*point), ())
+        return {f.key for f in candidates if f.contains(point)} | {f.key for f in self._large if f.contains(point)}
+
+def _index(degrees: float) -> int:
+    return int(math.floor(degrees / CELL_DEGREES))
+
+def _cell(lat: float, lon: float) -> Tuple[int, int]:
+    return _index(lat), _wrap(_index(lon))
+
+def _wrap(j: int) -> int:
+    """Cell column modulo 360 degrees, so boxes crossing the antimeridian land in the right cells"""
+    columns = int(round(360 / CELL_DEGREES))
+    return (j + columns // 2) % columns - columns // 2
+
+def collect_geofences(condition: Any, clauses: Optional[List[Tuple[Dict, Geofence]]] = None) -> List[Tuple[Dict, Geofence]]:
+    """(clause, geofence) for every fence a condition AST tests"""
+    if clauses is None:
+        clauses = []
+    if isinstance(condition, dict):
+        if condition.get("op") in FENCE_OPS and "param" not in condition:
+            fence = compile_fence(condition["op"], condition.get("value"))
+            if fence is not None:
+                clauses.append((condition, fence))
+        for clause in condition.get("clauses", []) or []:
+            collect_geofences(clause, clauses)
+    return clauses
@@ -0,0 +1,224 @@
+"""
+Idempotent evaluation by event_id
+
+Upstream retries resend the same event_id. The first evaluation of an event_id stores its
+response under (event_id, ruleset fingerprint) for IDEMPOTENCY_TTL seconds (default 300), in
+a bounded in-memory LRU (IDEMPOTENCY_CACHE_SIZE entries). Retries within the TTL replay the
+stored response, with its original audit_log_id, without evaluating again or writing another
+audit row. A retry that arrives while the first request is still being evaluated waits for it
+and gets the same response. Once the rules or value sets change, the fingerprint changes and
+the event is evaluated again.
+
+The response is stored with a hash of the request (event, context and evaluation options). A
+request that reuses an event_id with a different body raises IdempotencyConflict (409)
+instead of getting another request's decision.
+
+With IDEMPOTENCY_DURABLE=true, responses are also written to the `idempotency_records` table,
+so replays survive restarts and are shared between workers. Without it, each worker has its
+own cache.
+
+The TTL can be set per caller (X-Caller header) with IDEMPOTENCY_CALLER_TTLS, e.g.
+"fraud-service=600,loadtest=0"; a TTL of 0 turns idempotency off for that caller.
+Requests without an event_id are always evaluated.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import and_, delete, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from metrics import get_metrics
+from models import IdempotencyRecord
+
+logger = logging.getLogger(__name__)
+
+TTL = float(os.getenv("IDEMPOTENCY_TTL", "300"))
+CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+DURABLE = os.getenv("IDEMPOTENCY_DURABLE", "false").lower() in ("1", "true", "yes")
+# Expired durable records are deleted at most this often, in seconds
+PURGE_INTERVAL = 60
+
+def parse_caller_ttls(spec: str) -> Dict[str, float]:
+    """"caller=seconds,caller=seconds" -> {caller: seconds}"""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        caller, _, seconds = item.partition("=")
+        try:
+            ttls[caller.strip()] = float(seconds)
+        except ValueError:
+            logger.warning(f"Ignoring idempotency TTL {item!r}: expected caller=seconds")
+    return ttls
+
+CALLER_TTLS = parse_caller_ttls(os.getenv("IDEMPOTENCY_CALLER_TTLS", ""))
+
+def ttl_for(caller: Optional[str]) -> float:
+    """Seconds to keep a caller's responses; 0 means no idempotency"""
+    return CALLER_TTLS.get(caller, TTL) if caller else TTL
+
+def fingerprint_key(fingerprint: Any) -> str:
+    return hashlib.sha1(repr(fingerprint).encode()).hexdigest()[:20]
+
+def request_hash(event: Dict, context: Dict, chain: bool = False, max_iterations: Optional[int] = None,
+                 budget_ms: Optional[float] = None) -> str:
+    """Hash of the canonical request: the same request sent to /evaluate, /evaluate/raw or a batch hashes alike"""
+    canonical = {
+        "event": event,
+        "context": context or {},
+        "chain": bool(chain),
+        "max_iterations": max_iterations,
+        "budget_ms": float(budget_ms) if budget_ms is not None else None
+    }
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+class IdempotencyConflict(Exception):
+    """An event_id was reused for a request with a different body"""
+
+    def __init__(self, event_id: str):
+        super().__init__(f"event_id {event_id} was already used for a different request")
+        self.event_id = event_id
+
+_metrics = get_metrics()
+REQUESTS = _metrics.counter(
+    "idempotency_requests_total",
+    "Evaluations with an event_id by outcome (miss, hit, coalesced, durable_hit, conflict)",
+    ("result",)
+)
+
+class IdempotencyCache:
+    """Responses by (event_id, fingerprint), with in-flight evaluations shared by concurrent retries"""
+
+    def __init__(self, max_entries: int = CACHE_SIZE, engine: Optional[Engine] = None):
+        self.max_entries = max_entries
+        self.engine = engine
+        # key -> (expires at, response, request hash)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Dict, Optional[str]]]" = OrderedDict()
+        # key -> (future response, request hash)
+        self._in_flight: Dict[Tuple[str, str], Tuple[Future, Optional[str]]] = {}
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get(self, key: Tuple[str, str]) -> Optional[Tuple[Dict, Optional[str]]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def _put(self, key: Tuple[str, str], response: Dict, ttl: float, digest: Optional[str]):
+        self._entries[key] = (time.monotonic() + ttl, response, digest)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def run(self, event_id: str, fingerprint: Any, ttl: float, evaluate: Callable[[], Dict],
+            digest: Optional[str] = None) -> Tuple[Dict, bool]:
+        """
+        The response for `event_id` under this ruleset: stored, shared with an in-flight
+        evaluation, or computed by `evaluate` and stored. Returns (response, replayed).
+        Raises IdempotencyConflict when the stored or in-flight request has another `digest`
+        (see request_hash).
+        """
+        key = (str(event_id), fingerprint_key(fingerprint))
+        with self._lock:
+            stored = self._get(key)
+            if stored is not None:
+                _check_digest(key, stored[1], digest)
+                REQUESTS.inc(result="hit")
+                return stored[0], True
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = (future, digest)
+            else:
+                future, leader_digest = in_flight
+                _check_digest(key, leader_digest, digest)
+
+        if not leader:
+            REQUESTS.inc(result="coalesced")
+            return future.result(), True
+
+        try:
+            stored = self._load(key) if self.engine is not None else None
+            replayed = stored is not None
+            if replayed:
+                response, stored_digest = stored
+                REQUESTS.inc(result="durable_hit")
+            else:
+                response, stored_digest = evaluate(), digest
+                REQUESTS.inc(result="miss")
+                if self.engine is not None:
+                    self._store(key, response, ttl, digest)
+            with self._lock:
+                self._put(key, response, ttl, stored_digest)
+            _check_digest(key, stored_digest, digest)
+            future.set_result(response)
+            return response, replayed
+        except BaseException as e:
+            # Waiting retries fail the same way; the next retry evaluates again
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _load(self, key: Tuple[str, str]) -> Optional[Tuple[Dict, Optional[str]]]:
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(select(IdempotencyRecord.response, IdempotencyRecord.request_hash).where(and_(
+                    IdempotencyRecord.event_id == key[0],
+                    IdempotencyRecord.fingerprint == key[1],
+                    IdempotencyRecord.expires_at > datetime.utcnow()
+                ))).first()
+                return (row.response, row.request_hash) if row is not None else None
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to read idempotency record for {key[0]}: {e}")
+            return None
+
+    def _store(self, key: Tuple[str, str], response: Dict, ttl: float, digest: Optional[str]):
+        now = datetime.utcnow()
+        try:
+            with self.engine.begin() as conn:
+                if time.monotonic() - self._last_purge > PURGE_INTERVAL:
+                    self._last_purge = time.monotonic()
+                    conn.execute(delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= now))
+                conn.execute(insert(IdempotencyRecord).values(
+                    event_id=key[0], fingerprint=key[1], response=response, request_hash=digest,
+                    expires_at=now + timedelta(seconds=ttl)
+                ))
+        except IntegrityError:
+            # Another worker stored the same event first
+            pass
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to store idempotency record for {key[0]}: {e}")
+
+def _check_digest(key: Tuple[str, str], stored: Optional[str], digest: Optional[str]):
+    if stored is not None and digest is not None and stored != digest:
+        REQUESTS.inc(result="conflict")
+        raise IdempotencyConflict(key[0])
+
+_cache = IdempotencyCache()
+_metrics.gauge("idempotency_cache_entries", "Responses held in the in-memory idempotency cache", function=lambda: len(_cache))
+
+def configure_idempotency(engine: Engine):
+    """Keep responses in the database too when IDEMPOTENCY_DURABLE is set"""
+    if DURABLE:
+        _cache.engine = engine
+
+def get_idempotency_cache() -> IdempotencyCache:
+    return _cache
@@ -3,11 +3,60 @@ Database initialization script
 Creates tables and optionally seeds with sample data
 """
 import sys
+import logging
+from typing import List
 from sqlalchemy import text, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
 from database import engine, SessionLocal
 from models import Base, Rule, RuleVersion, AuditLog
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# Columns added to tables after they were first released, with the DEFAULT for existing rows.
+# create_all() only creates missing tables, so these are added with ALTER TABLE.
+LATER_COLUMNS = {
+    "rules": {"parameter_keys": None, "decision_table": None},
+    "rule_versions": {"shadow": "FALSE", "sample_rate": None},
+    "idempotency_records": {"request_hash": None},
+}
+
+def upgrade_schema(bind: Engine = engine) -> List[str]:
+    """
+    Add LATER_COLUMNS and the audit_logs indexes to tables created by an earlier release.
+    Returns the columns added. Safe to run on every start.
+
+    audit_logs tables created before partitioning keep their `id` primary key; the model's
+    (id, created_at) key works with them as created_at is always written.
+    """
+    inspector = inspect(bind)
+    tables = set(inspector.get_table_names())
+    added = []
+    for table, columns in LATER_COLUMNS.items():
+        if table not in tables:
+            continue
+        existing = {col['name'] for col in inspector.get_columns(table)}
+        for name, default in columns.items():
+            if name in existing:
+                continue
+            column_type = Base.metadata.tables[table].c[name].type.compile(dialect=bind.dialect)
+            statement = f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"
+            if default is not None:
+                statement += f" DEFAULT {default}"
+            try:
+                with bind.begin() as conn:
+                    conn.execute(text(statement))
+                added.append(f"{table}.{name}")
+                logger.info(f"Added column {table}.{name}")
+            except SQLAlchemyError as e:
+                # e.g. another worker added it first
+                logger.warning(f"Could not add column {table}.{name}: {e}")
+    if "audit_logs" in tables:
+        for index in AuditLog.__table__.indexes:
+            index.create(bind=bind, checkfirst=True)
+    return added
+
 def check_schema_compatibility():
     """Check if existing tables match the current model schema"""
     inspector = inspect(engine)
@@ -41,6 +90,8 @@ def init_database():
     print("Creating database tables...")
     try:
         Base.metadata.create_all(bind=engine)
+        for column in upgrade_schema(engine):
+            print(f"[OK] Added column {column}")
         print("[OK] Tables created successfully!")
         return True
     except Exception as e:
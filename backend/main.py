@@ -1,28 +1,61 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import and_, func, select
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
+import os
 import uuid
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
 
 from database import SessionLocal, engine
-from models import Base, Rule, RuleVersion, AuditLog
+from models import Base, Rule, RuleVersion, AuditLog, AuditRuleMatch, ValueSet, RuleParameter
+from init_db import upgrade_schema
 from schemas import (
     RuleCreate, RuleUpdate, SimulateRequest, EvaluateRequest,
-    EvaluationResponse, RuleResponse
+    EvaluationResponse, RuleResponse, ValueSetCreate, ValueSetResponse,
+    ParameterTableUpdate, BacktestRequest, ShadowCreate
 )
-from evaluator import eval_condition
+from ruleset import EvaluationBudget, get_ruleset, invalidate_ruleset, compile_rule
+from evaluator import validate_condition
+from templates import collect_param_refs, validate_parameter_rows
+from decision_tables import DecisionTable, DecisionTableError, table_from_csv, table_to_csv
+from value_sets import collect_value_set_refs, validate_values
 from kafka_client import get_kafka_producer
+from windows import start_snapshots, stop_snapshots
+from context_providers import configure_from_env as configure_context_providers, enrich_context, provider_key_fields
+from fast_ingest import RawEvaluateRequest, InvalidPayload
+from serialization import FastJSONResponse, stream_json_array, stream_ndjson
+from archive import query_archive
+from shadow import get_shadow_runner, shadow_summary, start_shadow_runner, stop_shadow_runner
+from backtest import get_backtest_jobs, iter_audit_records, prepare_candidates, run_backtest, value_set_snapshot
+from audit_storage import rule_match_rows, start_audit_maintenance, stop_audit_maintenance
+from rule_stats import GRANULARITIES, get_rule_stats, query_rule_stats, query_ruleset_stats, start_stats_flush, stop_stats_flush
+from engine import evaluate_ruleset, simulation_response
+from bulk_rules import BulkImportError, import_rules, make_id, parse_rules, rule_to_dict
+from rule_history import backfill_history, compile_rule_as_of, get_ruleset_as_of, record_rule_change, rule_history, rules_as_of
+from admission import AdmissionMiddleware, get_admission_controller
+from metrics import get_metrics
+from idempotency import IdempotencyConflict, configure_idempotency, get_idempotency_cache, request_hash, ttl_for
+from dispatch import get_action_dispatcher, start_action_dispatch, stop_action_dispatch
+from results import MAX_WAIT_SECONDS, get_async_evaluator, get_result_store, stop_async_evaluator
+from pagination import MAX_PAGE_SIZE, InvalidCursor, cursor_headers, decode_cursor, keyset_after, next_cursor
+
+# Most requests accepted in one POST /evaluate/batch
+BATCH_MAX_EVENTS = int(os.getenv("BATCH_MAX_EVENTS", "1000"))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create tables if they don't exist
+# Create tables if they don't exist, and add columns newer than the existing tables
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
 
 app = FastAPI(
     title="Rules Engine API",
@@ -30,13 +63,45 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Evaluation requests are admitted or shed before they reach the threadpool
+app.add_middleware(AdmissionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # restrict in production
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Retry-After"],
 )
 
+@app.on_event("startup")
+def on_startup():
+    # Restore sliding-window state and snapshot it periodically (WINDOW_SNAPSHOT_PATH)
+    start_snapshots()
+    configure_context_providers()
+    # Create audit partitions ahead of need and apply AUDIT_RETENTION_DAYS
+    start_audit_maintenance(engine)
+    start_stats_flush(engine)
+    start_shadow_runner(engine)
+    configure_idempotency(engine)
+    # Server-side execution of actions with registered handlers (DISPATCH_ENABLED)
+    start_action_dispatch()
+    # Checkpoint rules created before history was recorded
+    db = SessionLocal()
+    try:
+        backfill_history(db)
+    finally:
+        db.close()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    stop_snapshots()
+    stop_audit_maintenance()
+    stop_stats_flush()
+    stop_shadow_runner()
+    stop_async_evaluator()
+    stop_action_dispatch()
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -45,10 +110,6 @@ def get_db():
     finally:
         db.close()
 
-# Helper to normalize id
-def make_id(name: str) -> str:
-    return name.strip().lower().replace(" ", "_").replace("-", "_")[:48]
-
 def create_audit_log(
     db: Session,
     event: dict,
@@ -61,8 +122,10 @@ def create_audit_log(
 ) -> str:
     """Create audit log entry"""
     audit_id = str(uuid.uuid4())
+    created_at = datetime.utcnow()
     audit = AuditLog(
         id=audit_id,
+        created_at=created_at,
         event_id=event_id or str(uuid.uuid4()),
         event_type=event.get("type"),
         event_data=event,
@@ -73,18 +136,50 @@ def create_audit_log(
         evaluation_time_ms=evaluation_time_ms
     )
     db.add(audit)
+    db.add_all(AuditRuleMatch(**row) for row in rule_match_rows(audit_id, created_at, matched_rules))
     db.commit()
     return audit_id
 
+def check_conditions(db: Session, conditions: dict):
+    """Reject malformed conditions and references to value sets which do not exist"""
+    error = validate_condition(conditions)
+    if error:
+        raise HTTPException(status_code=400, detail=f"Invalid {error}")
+    check_value_set_refs(db, conditions)
+
+def check_value_set_refs(db: Session, conditions: dict):
+    """Reject conditions that reference value sets which do not exist"""
+    for name, version in collect_value_set_refs(conditions):
+        query = db.query(ValueSet.id).filter(ValueSet.name == name)
+        if version is not None:
+            query = query.filter(ValueSet.version == version)
+        if query.first() is None:
+            suffix = f" v{version}" if version is not None else ""
+            raise HTTPException(status_code=400, detail=f"Unknown value set: {name}{suffix}")
+
+def check_decision_table(decision_table: dict, parameter_keys: list = None):
+    """Reject decision tables that do not compile"""
+    if not decision_table:
+        return
+    if parameter_keys:
+        raise HTTPException(status_code=400, detail="A rule cannot be both a template and a decision table")
+    try:
+        DecisionTable(decision_table)
+    except DecisionTableError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid decision table: {e}")
+
+def next_version(db: Session, rule_id: str) -> int:
+    """Next version number of a rule (shadow versions take numbers too)"""
+    latest = db.query(func.max(RuleVersion.version)).filter(RuleVersion.rule_id == rule_id).scalar()
+    return (latest or 0) + 1
+
 # ========== RULE CRUD ENDPOINTS ==========
 
-@app.get("/rules", response_model=List[RuleResponse])
-def list_rules(
-    active: bool = None,
-    tag: str = None,
-    db: Session = Depends(get_db)
-):
-    """List all rules with optional filtering"""
+RULE_ORDER = (Rule.priority, Rule.created_at, Rule.id)
+AUDIT_ORDER = (AuditLog.created_at, AuditLog.id)
+
+def rule_query(db: Session, active: bool = None, tag: str = None, cursor: str = None):
+    """Rules in (priority, created_at, id) descending order, optionally after a cursor"""
     query = db.query(Rule)
     
     if active is not None:
@@ -94,26 +189,69 @@ def list_rules(
         # Filter by tag (JSON array contains)
         query = query.filter(Rule.tags.contains([tag]))
     
-    rules = query.order_by(Rule.priority.desc(), Rule.created_at.desc()).all()
+    if cursor:
+        try:
+            query = query.filter(keyset_after(RULE_ORDER, decode_cursor(cursor, len(RULE_ORDER))))
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    return [
-        RuleResponse(
-            id=r.id,
-            name=r.name,
-            priority=r.priority,
-            active=r.active,
-            version=r.version,
-            conditions=r.conditions,
-            actions=r.actions,
-            tags=r.tags or [],
-            stop_on_match=r.stop_on_match,
-            created_by=r.created_by,
-            created_at=r.created_at,
-            updated_at=r.updated_at,
-            description=r.description
-        )
-        for r in rules
-    ]
+    return query.order_by(*(c.desc() for c in RULE_ORDER))
+
+def iter_rules(active: bool = None, tag: str = None, cursor: str = None):
+    """Yield serialized rules in batches; owns its session so it can outlive the request handler"""
+    db = SessionLocal()
+    try:
+        for r in rule_query(db, active, tag, cursor).yield_per(1000):
+            yield rule_to_dict(r)
+    finally:
+        db.close()
+
+@app.get("/rules", response_model=List[RuleResponse])
+def list_rules(
+    active: bool = None,
+    tag: str = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    db: Session = Depends(get_db)
+):
+    """
+    List rules with optional filtering.
+    With `limit`, returns one page and the cursor for the next page in X-Next-Cursor;
+    otherwise every rule is streamed as a JSON array.
+    """
+    if limit is None:
+        # Validate the cursor before the response starts streaming
+        rule_query(db, active, tag, cursor)
+        return stream_json_array(iter_rules(active, tag, cursor))
+    
+    rules = rule_query(db, active, tag, cursor).limit(limit).all()
+    headers = cursor_headers(next_cursor(rules, limit, lambda r: (r.priority, r.created_at, r.id)))
+    return FastJSONResponse([rule_to_dict(r) for r in rules], headers=headers)
+
+@app.get("/rules/export")
+def export_rules(active: bool = None, tag: str = None):
+    """Stream every rule as NDJSON"""
+    return stream_ndjson(iter_rules(active, tag))
+
+def bulk_import_rules(db: Session, body: bytes, created_by: str = None, dry_run: bool = False) -> dict:
+    try:
+        result = import_rules(db, parse_rules(body), created_by, dry_run)
+    except BulkImportError as e:
+        raise HTTPException(status_code=400, detail=e.errors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not dry_run:
+        invalidate_ruleset()
+    return result
+
+@app.post("/rules/bulk")
+async def bulk_rules(request: Request, created_by: str = None, dry_run: bool = False, db: Session = Depends(get_db)):
+    """
+    Upsert many rules from a JSON array or NDJSON body in one transaction.
+    Every rule is validated first; any invalid rule rejects the whole batch.
+    """
+    body = await request.body()
+    return await run_in_threadpool(bulk_import_rules, db, body, created_by, dry_run)
 
 @app.get("/rules/{rule_id}", response_model=RuleResponse)
 def get_rule(rule_id: str, db: Session = Depends(get_db)):
@@ -122,25 +260,13 @@ def get_rule(rule_id: str, db: Session = Depends(get_db)):
     if not rule:
         raise HTTPException(status_code=404, detail="Rule not found")
     
-    return RuleResponse(
-        id=rule.id,
-        name=rule.name,
-        priority=rule.priority,
-        active=rule.active,
-        version=rule.version,
-        conditions=rule.conditions,
-        actions=rule.actions,
-        tags=rule.tags or [],
-        stop_on_match=rule.stop_on_match,
-        created_by=rule.created_by,
-        created_at=rule.created_at,
-        updated_at=rule.updated_at,
-        description=rule.description
-    )
+    return FastJSONResponse(rule_to_dict(rule))
 
 @app.post("/rules", response_model=dict)
 def create_rule(payload: RuleCreate, db: Session = Depends(get_db)):
     """Create a new rule"""
+    check_conditions(db, payload.conditions)
+    check_decision_table(payload.decision_table, payload.parameter_keys)
     rid = make_id(payload.name)
     existing = db.query(Rule).filter(Rule.id == rid).first()
     if existing:
@@ -157,7 +283,9 @@ def create_rule(payload: RuleCreate, db: Session = Depends(get_db)):
         tags=payload.tags or [],
         stop_on_match=payload.stop_on_match,
         created_by=payload.created_by or "system",
-        description=payload.description
+        description=payload.description,
+        parameter_keys=payload.parameter_keys or None,
+        decision_table=payload.decision_table or None
     )
     
     db.add(rule)
@@ -172,7 +300,9 @@ def create_rule(payload: RuleCreate, db: Session = Depends(get_db)):
         created_by=payload.created_by or "system"
     )
     db.add(version)
+    record_rule_change(db, rule)
     db.commit()
+    invalidate_ruleset()
     
     return {
         "id": rule.id,
@@ -194,6 +324,7 @@ def update_rule(rule_id: str, payload: RuleUpdate, db: Session = Depends(get_db)
     if payload.priority is not None:
         rule.priority = payload.priority
     if payload.conditions is not None:
+        check_conditions(db, payload.conditions)
         rule.conditions = payload.conditions
     if payload.actions is not None:
         rule.actions = payload.actions
@@ -205,10 +336,15 @@ def update_rule(rule_id: str, payload: RuleUpdate, db: Session = Depends(get_db)
         rule.stop_on_match = payload.stop_on_match
     if payload.description is not None:
         rule.description = payload.description
+    if payload.parameter_keys is not None:
+        rule.parameter_keys = payload.parameter_keys or None
+    if payload.decision_table is not None:
+        rule.decision_table = payload.decision_table or None
+    check_decision_table(rule.decision_table, rule.parameter_keys)
     
     # Create new version if conditions or actions changed
     if payload.conditions is not None or payload.actions is not None:
-        rule.version += 1
+        rule.version = next_version(db, rule_id)
         version = RuleVersion(
             id=str(uuid.uuid4()),
             rule_id=rule_id,
@@ -220,7 +356,9 @@ def update_rule(rule_id: str, payload: RuleUpdate, db: Session = Depends(get_db)
         db.add(version)
     
     rule.updated_at = datetime.utcnow()
+    record_rule_change(db, rule)
     db.commit()
+    invalidate_ruleset()
     
     return {"id": rule.id, "version": rule.version, "updated_at": rule.updated_at.isoformat()}
 
@@ -231,134 +369,521 @@ def delete_rule(rule_id: str, db: Session = Depends(get_db)):
     if not rule:
         raise HTTPException(status_code=404, detail="Rule not found")
     
+    record_rule_change(db, rule, deleted=True)
+    db.query(RuleParameter).filter(RuleParameter.rule_id == rule_id).delete()
     db.delete(rule)
     db.commit()
+    invalidate_ruleset()
     return {"deleted": True}
 
+# ========== RULE TEMPLATE PARAMETERS ==========
+
+@app.get("/rules/{rule_id}/parameters")
+def get_rule_parameters(rule_id: str, db: Session = Depends(get_db)):
+    """Get the parameter table of a template rule"""
+    rule = db.query(Rule).filter(Rule.id == rule_id).first()
+    if not rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    
+    rows = db.query(RuleParameter).filter(RuleParameter.rule_id == rule_id).all()
+    return {
+        "rule_id": rule_id,
+        "parameter_keys": rule.parameter_keys or [],
+        "rows": [{"id": p.id, "key": p.key, "params": p.params} for p in rows]
+    }
+
+@app.put("/rules/{rule_id}/parameters")
+def replace_rule_parameters(rule_id: str, payload: ParameterTableUpdate, db: Session = Depends(get_db)):
+    """Replace the parameter table of a template rule"""
+    rule = db.query(Rule).filter(Rule.id == rule_id).first()
+    if not rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    if not rule.parameter_keys:
+        raise HTTPException(status_code=400, detail="Rule has no parameter_keys; it is not a template")
+    
+    rows = [row.model_dump() for row in payload.rows]
+    required = collect_param_refs(rule.conditions) | collect_param_refs(rule.actions)
+    error = validate_parameter_rows(rule.parameter_keys, rows, required)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    db.query(RuleParameter).filter(RuleParameter.rule_id == rule_id).delete()
+    db.add_all([
+        RuleParameter(id=str(uuid.uuid4()), rule_id=rule_id, key=row["key"], params=row["params"])
+        for row in rows
+    ])
+    # Touch the rule so every worker reloads its ruleset
+    rule.updated_at = datetime.utcnow()
+    record_rule_change(db, rule)
+    db.commit()
+    invalidate_ruleset()
+    
+    return {"rule_id": rule_id, "rows": len(rows), "updated_at": rule.updated_at.isoformat()}
+
+# ========== DECISION TABLES ==========
+
+@app.get("/rules/{rule_id}/decision-table/csv")
+def export_decision_table(rule_id: str, db: Session = Depends(get_db)):
+    """Export a decision table rule as CSV"""
+    rule = db.query(Rule).filter(Rule.id == rule_id).first()
+    if not rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    if not rule.decision_table:
+        raise HTTPException(status_code=400, detail="Rule is not a decision table")
+    
+    return Response(
+        content=table_to_csv(rule.decision_table),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{rule_id}.csv"'}
+    )
+
+def replace_decision_table(db: Session, rule_id: str, text: str, hit_policy: str = None) -> dict:
+    rule = db.query(Rule).filter(Rule.id == rule_id).first()
+    if not rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    if rule.parameter_keys:
+        raise HTTPException(status_code=400, detail="A rule cannot be both a template and a decision table")
+    
+    hit_policy = hit_policy or (rule.decision_table or {}).get("hit_policy", "first")
+    try:
+        definition = table_from_csv(text, hit_policy)
+    except DecisionTableError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid decision table CSV: {e}")
+    
+    rule.decision_table = definition
+    rule.updated_at = datetime.utcnow()
+    record_rule_change(db, rule)
+    db.commit()
+    invalidate_ruleset()
+    return {"id": rule.id, "rows": len(definition["rows"]), "updated_at": rule.updated_at.isoformat()}
+
+@app.put("/rules/{rule_id}/decision-table/csv")
+async def import_decision_table(rule_id: str, request: Request, hit_policy: str = None, db: Session = Depends(get_db)):
+    """Replace a rule's decision table from a CSV upload"""
+    body = await request.body()
+    return await run_in_threadpool(replace_decision_table, db, rule_id, body.decode("utf-8-sig"), hit_policy)
+
 # ========== EVALUATION ENDPOINTS ==========
 
 @app.post("/evaluate", response_model=EvaluationResponse)
-def evaluate_all(req: EvaluateRequest, db: Session = Depends(get_db)):
+def evaluate_all(req: EvaluateRequest, db: Session = Depends(get_db), x_caller: Optional[str] = Header(None)):
     """
     Evaluate all active rules against an event.
     Returns matched rules, actions, and explanation.
+    Retries with the same event_id replay the first response (see idempotency.py).
     """
     start_time = time.time()
     
-    # If async mode, send to Kafka and return immediately
+    # In async mode, return a ticket at once; the result is fetched from /evaluate/results
     if req.async_mode:
-        producer = get_kafka_producer()
-        if producer:
-            producer.send_event(req.event, req.context, req.event_id)
-            return EvaluationResponse(
-                actions=[],
-                matched_rules=[],
-                explanation=[{"message": "Event sent to Kafka for async processing"}],
-                evaluation_time_ms=0
-            )
-        else:
-            logger.warning("Kafka not available, falling back to sync evaluation")
-    
-    # Get active rules sorted by priority
-    rules = db.query(Rule).filter(Rule.active == True).order_by(Rule.priority.desc()).all()
-    
-    matched_rules = []
-    actions = []
-    all_explanations = []
-    
-    for rule in rules:
-        result, explanation = eval_condition(rule.conditions, req.event, req.context, [])
-        
-        if result:
-            matched_rules.append(rule.id)
-            actions.extend(rule.actions)
-            all_explanations.append({
-                "rule_id": rule.id,
-                "rule_name": rule.name,
-                "matched": True,
-                "explanation": explanation
-            })
-            
-            # Stop if rule says to stop on match
-            if rule.stop_on_match:
-                all_explanations.append({"message": f"Stopped at rule {rule.id} (stop_on_match=True)"})
-                break
-        else:
-            # Log why rule didn't match (optional, can be verbose)
-            pass
+        return submit_async_evaluation(req, x_caller)
+    
+    return evaluation_response(*evaluate_request(db, req, x_caller, start_time))
+
+def evaluate_request(db: Session, req: EvaluateRequest, caller: Optional[str], start_time: float):
+    """(response, replayed) for a synchronous evaluation request"""
+    if req.as_of is not None:
+        return run_historical_evaluation(
+            db, req.event, req.context, req.as_of, start_time, req.chain, req.max_iterations, req.budget_ms
+        ), False
+    
+    return evaluate_once(db, req.event_id, caller, lambda ruleset: run_evaluation(
+        db, req.event, req.context, req.event_id, start_time, chain=req.chain, max_iterations=req.max_iterations,
+        budget_ms=req.budget_ms, ruleset=ruleset
+    ), lambda: request_hash(req.event, req.context, req.chain, req.max_iterations, req.budget_ms))
+
+def evaluation_response(response: dict, replayed: bool) -> FastJSONResponse:
+    return FastJSONResponse(response, headers={"Idempotent-Replay": "true"} if replayed else None)
+
+def submit_async_evaluation(req: EvaluateRequest, caller: Optional[str]) -> FastJSONResponse:
+    return FastJSONResponse(async_submission(req, caller))
+
+def async_submission(req: EvaluateRequest, caller: Optional[str]) -> dict:
+    """Queue the evaluation in the background; the response carries its ticket"""
+    producer = get_kafka_producer()
+    if producer:
+        # Downstream consumers still see the event stream
+        producer.send_event(req.event, req.context, req.event_id)
+
+    def evaluate() -> dict:
+        db = SessionLocal()
+        try:
+            return evaluate_request(db, req, caller, time.time())[0]
+        finally:
+            db.close()
+
+    ticket = get_async_evaluator().submit(evaluate)
+    if ticket is None:
+        raise HTTPException(status_code=503, detail="Too many pending async evaluations", headers={"Retry-After": "1"})
+    return {
+        "actions": [],
+        "matched_rules": [],
+        "explanation": [{"message": f"Accepted for async evaluation; fetch the result from /evaluate/results/{ticket}"}],
+        "evaluation_time_ms": 0,
+        "audit_log_id": None,
+        "ticket": ticket
+    }
+
+def evaluate_once(db: Session, event_id: Optional[str], caller: Optional[str], evaluate, digest, ruleset=None):
+    """
+    (response, replayed): `evaluate(ruleset)`, or the response of an earlier evaluation of
+    this event_id against the same ruleset. `digest()` hashes the request (request_hash); an
+    event_id reused for a different request is a 409.
+    """
+    ruleset = ruleset or get_ruleset(db)
+    ttl = ttl_for(caller)
+    if not event_id or ttl <= 0:
+        return evaluate(ruleset), False
+    try:
+        return get_idempotency_cache().run(event_id, ruleset.fingerprint, ttl, lambda: evaluate(ruleset), digest())
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+def run_historical_evaluation(db: Session, event: dict, context: dict, as_of: datetime, start_time: float,
+                              chain: bool = False, max_iterations: int = None, budget_ms: float = None) -> dict:
+    """
+    Evaluate against the ruleset as it was at `as_of`. Replays are not audited and do not
+    touch window state, rule statistics or shadows.
+    """
+    budget = EvaluationBudget.for_request(budget_ms, start_time)
+    ruleset = get_ruleset_as_of(db, as_of)
+    context = enrich_context(event, context)
+    matched_rules, actions, all_explanations, chain_summary = evaluate_ruleset(
+        ruleset, event, context, chain, max_iterations, record_windows=False, budget=budget
+    )
+    response = {
+        "actions": actions,
+        "matched_rules": matched_rules,
+        "explanation": all_explanations,
+        "evaluation_time_ms": int((time.time() - start_time) * 1000),
+        "audit_log_id": None
+    }
+    if chain_summary is not None:
+        response["chain"] = chain_summary
+    if budget is not None:
+        response["skipped_rules"] = budget.skipped
+    return response
+
+def run_evaluation(
+    db: Session,
+    event: dict,
+    context: dict,
+    event_id: str = None,
+    start_time: float = None,
+    audit_payload=None,
+    chain: bool = False,
+    max_iterations: int = None,
+    budget_ms: float = None,
+    ruleset=None
+) -> dict:
+    """
+    Evaluate the active ruleset and write the audit log.
+    `audit_payload` returns the (event, context) to store when `event`/`context`
+    are partial projections of the request.
+    With `chain`, actions may assert facts that trigger further rules (see chaining.py).
+    `budget_ms` caps the evaluation time; rules skipped when it runs out are listed in the
+    response and the audited explanation (see EvaluationBudget).
+    `ruleset` is the active ruleset when the caller already loaded it.
+    """
+    start_time = start_time or time.time()
+    budget = EvaluationBudget.for_request(budget_ms, start_time)
+    
+    # Active rules sorted by priority, cached until rules change
+    ruleset = ruleset or get_ruleset(db)
+    # Provider-backed context keys are fetched only if a rule reads them
+    context = enrich_context(event, context)
+    matched_rules, actions, all_explanations, chain_summary = evaluate_ruleset(
+        ruleset, event, context, chain, max_iterations, stats=get_rule_stats(), budget=budget
+    )
     
     evaluation_time_ms = int((time.time() - start_time) * 1000)
     
+    audit_event, audit_context = event, dict(context)
+    if audit_payload is not None:
+        full_event, full_context = audit_payload()
+        # Keep provider-fetched keys alongside what the caller sent
+        audit_event, audit_context = full_event, {**audit_context, **full_context}
+    
     # Create audit log
     audit_id = create_audit_log(
         db=db,
-        event=req.event,
-        context=req.context,
+        event=audit_event,
+        context=audit_context,
         matched_rules=matched_rules,
         actions=actions,
         explanation=all_explanations,
         evaluation_time_ms=evaluation_time_ms,
-        event_id=req.event_id
+        event_id=event_id
     )
     
-    return EvaluationResponse(
-        actions=actions,
-        matched_rules=matched_rules,
-        explanation=all_explanations,
-        evaluation_time_ms=evaluation_time_ms,
-        audit_log_id=audit_id
+    # Actions with registered handlers are executed from the outbox, off the response path
+    dispatcher = get_action_dispatcher()
+    if dispatcher is not None and actions:
+        dispatcher.submit(event_id or audit_id, actions)
+    
+    # Sampled shadow versions are evaluated in the background, never on this request's time
+    get_shadow_runner().submit(ruleset, event, context, matched_rules)
+    
+    # Same shape as EvaluationResponse, encoded without re-validation
+    response = {
+        "actions": actions,
+        "matched_rules": matched_rules,
+        "explanation": all_explanations,
+        "evaluation_time_ms": evaluation_time_ms,
+        "audit_log_id": audit_id
+    }
+    if chain_summary is not None:
+        response["chain"] = chain_summary
+    if budget is not None:
+        response["skipped_rules"] = budget.skipped
+    return response
+
+def evaluate_raw_body(body: bytes, db: Session, start_time: float, caller: Optional[str] = None):
+    ruleset = get_ruleset(db)
+    paths = ruleset.referenced_paths | provider_key_fields() | {"event.type"}
+    try:
+        raw = RawEvaluateRequest(body, paths)
+    except InvalidPayload as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    if raw.chain or raw.as_of is not None or raw.max_iterations is not None:
+        # Asserted facts can be read by any rule, so chaining needs the whole request, and
+        # historical replays (as_of) are evaluated against a past ruleset without auditing
+        try:
+            req = EvaluateRequest.model_validate_json(body)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+        return evaluate_all(req, db, caller)
+    if raw.async_mode:
+        req = EvaluateRequest(event=raw.full_event(), context=raw.full_context(), event_id=raw.event_id, async_mode=True)
+        return evaluate_all(req, db, caller)
+    
+    return evaluation_response(*evaluate_once(db, raw.event_id, caller, lambda ruleset: run_evaluation(
+        db, raw.event, raw.context, raw.event_id, start_time,
+        audit_payload=lambda: (raw.full_event(), raw.full_context()),
+        budget_ms=raw.budget_ms, ruleset=ruleset
+    ), lambda: request_hash(raw.full_event(), raw.full_context(), budget_ms=raw.budget_ms), ruleset))
+
+@app.post("/evaluate/raw", response_model=EvaluationResponse)
+async def evaluate_raw(request: Request, db: Session = Depends(get_db)):
+    """
+    Same as /evaluate, but decodes only the fields the active rules reference
+    instead of validating and converting the whole payload.
+    """
+    start_time = time.time()
+    body = await request.body()
+    return await run_in_threadpool(evaluate_raw_body, body, db, start_time, request.headers.get("x-caller"))
+
+@app.post("/evaluate/batch")
+async def evaluate_batch(request: Request, x_caller: Optional[str] = Header(None)):
+    """
+    Evaluate many /evaluate requests sent as NDJSON, one per line. Results are streamed as
+    NDJSON in request order, each line written as soon as its request is evaluated:
+    {"index": n, "status": 200, "result": {...}, "replayed": false} or
+    {"index": n, "status": 4xx/5xx, "detail": ...}.
+    Each request is evaluated, audited and replayed by event_id exactly as by /evaluate.
+    """
+    lines = [line for line in (await request.body()).splitlines() if line.strip()]
+    if len(lines) > BATCH_MAX_EVENTS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_EVENTS} requests per batch")
+    return stream_ndjson(iter_batch_results(lines, x_caller), chunk_size=1)
+
+def iter_batch_results(lines: List[bytes], caller: Optional[str]):
+    """Yield one result per batch line; owns its session so it can outlive the request handler"""
+    db = SessionLocal()
+    try:
+        for index, line in enumerate(lines):
+            yield batch_result(db, index, line, caller)
+    finally:
+        db.close()
+
+def batch_result(db: Session, index: int, line: bytes, caller: Optional[str]) -> dict:
+    start_time = time.time()
+    try:
+        req = EvaluateRequest.model_validate_json(line)
+        if req.async_mode:
+            return {"index": index, "status": 200, "result": async_submission(req, caller), "replayed": False}
+        response, replayed = evaluate_request(db, req, caller, start_time)
+        return {"index": index, "status": 200, "result": response, "replayed": replayed}
+    except ValidationError as e:
+        return {"index": index, "status": 422, "detail": e.errors(include_url=False, include_input=False)}
+    except HTTPException as e:
+        return {"index": index, "status": e.status_code, "detail": e.detail}
+    except Exception as e:
+        # One failed event must not end the stream for the rest of the batch
+        db.rollback()
+        logger.error(f"Batch evaluation {index} failed: {e}")
+        return {"index": index, "status": 500, "detail": "Evaluation failed"}
+
+@app.get("/evaluate/results/stream")
+async def stream_results(tickets: str):
+    """Server-sent events with the result of each ticket (comma-separated) as it completes"""
+    ids = [t for t in (part.strip() for part in tickets.split(",")) if t]
+    if not ids:
+        raise HTTPException(status_code=400, detail="No tickets given")
+    return StreamingResponse(
+        get_result_store().stream(ids),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
+@app.get("/evaluate/results/{ticket}")
+async def get_result(ticket: str, wait: float = 0):
+    """
+    Result of an async evaluation. With `wait`, long-poll up to that many seconds; a ticket
+    still pending then is returned with status 202.
+    """
+    state = await get_result_store().wait(ticket, min(max(wait, 0), MAX_WAIT_SECONDS))
+    if state["status"] == "unknown":
+        raise HTTPException(status_code=404, detail="Unknown or expired ticket")
+    return FastJSONResponse(state, status_code=202 if state["status"] == "pending" else 200)
+
 @app.post("/rules/{rule_id}/simulate")
 def simulate_rule(rule_id: str, req: SimulateRequest, db: Session = Depends(get_db)):
     """Simulate a single rule against an event"""
-    rule = db.query(Rule).filter(Rule.id == rule_id).first()
-    if not rule:
-        raise HTTPException(status_code=404, detail="Rule not found")
+    if req.as_of is not None:
+        historical = compile_rule_as_of(db, rule_id, req.as_of)
+        if historical is None:
+            raise HTTPException(status_code=404, detail=f"Rule did not exist at {req.as_of.isoformat()}")
+        state, compiled = historical
+        rule_name = state["name"]
+    else:
+        rule = db.query(Rule).filter(Rule.id == rule_id).first()
+        if not rule:
+            raise HTTPException(status_code=404, detail="Rule not found")
+        compiled, rule_name = compile_rule(db, rule), rule.name
     
-    result, explanation = eval_condition(rule.conditions, req.event, req.context, [])
+    result = compiled.evaluate(req.event, enrich_context(req.event, req.context))
     
-    return {
-        "matched": result,
-        "rule_id": rule_id,
-        "rule_name": rule.name,
-        "would_execute": rule.actions if result else [],
-        "explanation": explanation
-    }
+    return simulation_response(rule_id, rule_name, result)
+
+# ========== BACKTEST ENDPOINTS ==========
+
+@app.post("/backtests")
+def start_backtest(req: BacktestRequest, db: Session = Depends(get_db)):
+    """
+    Replay stored audit logs through candidate rules in a background job.
+    Poll GET /backtests/{job_id} for progress and the report.
+    """
+    candidates = []
+    for payload in req.rules:
+        check_conditions(db, payload.conditions)
+        check_decision_table(payload.decision_table, payload.parameter_keys)
+        candidates.append({**payload.model_dump(), "id": make_id(payload.name)})
+    
+    try:
+        specs = prepare_candidates(db, candidates, req.rule_id, req.replace_ruleset)
+    except (ValueError, DecisionTableError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    value_sets = value_set_snapshot(db, specs)
+    
+    params = req.model_dump(exclude={"rules"})
+    params["candidate_rules"] = [c["id"] for c in candidates] if req.rule_id is None else [req.rule_id]
+    
+    def run(progress):
+        records = iter_audit_records(engine, req.start, req.end, req.event_type, req.limit)
+        return run_backtest(records, specs, value_sets, req.workers, req.sample_size, progress)
+    
+    job = get_backtest_jobs().start(params, run)
+    return FastJSONResponse(job.to_dict())
+
+@app.get("/backtests/{job_id}")
+def get_backtest(job_id: str):
+    """Status, progress and (when completed) the report of a backtest job"""
+    job = get_backtest_jobs().get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Backtest not found")
+    return FastJSONResponse(job.to_dict())
 
 # ========== AUDIT & VERSIONING ENDPOINTS ==========
 
-@app.get("/audit")
-def get_audit_logs(
-    event_id: str = None,
-    rule_id: str = None,
-    limit: int = 100,
-    db: Session = Depends(get_db)
-):
-    """Get audit logs with optional filtering"""
-    query = db.query(AuditLog)
+def audit_query(db: Session, event_id: str = None, rule_id: str = None, start: datetime = None,
+                end: datetime = None, cursor: str = None):
+    """Audit logs in (created_at, id) descending order, optionally after a cursor"""
+    query = select(AuditLog)
     
     if event_id:
-        query = query.filter(AuditLog.event_id == event_id)
+        query = query.where(AuditLog.event_id == event_id)
     
     if rule_id:
-        # Filter by rule_id in matched_rules JSON array
-        query = query.filter(AuditLog.matched_rules.contains([rule_id]))
+        # Matching on created_at too lets PostgreSQL prune audit_rule_matches partitions
+        query = query.join(AuditRuleMatch, and_(
+            AuditRuleMatch.audit_id == AuditLog.id,
+            AuditRuleMatch.created_at == AuditLog.created_at
+        )).where(AuditRuleMatch.rule_id == rule_id)
     
-    logs = query.order_by(AuditLog.created_at.desc()).limit(limit).all()
+    if start:
+        query = query.where(AuditLog.created_at >= start)
+    if end:
+        query = query.where(AuditLog.created_at < end)
     
-    return [
-        {
-            "id": log.id,
-            "event_id": log.event_id,
-            "event_type": log.event_type,
-            "matched_rules": log.matched_rules,
-            "actions_taken": log.actions_taken,
-            "evaluation_time_ms": log.evaluation_time_ms,
-            "created_at": log.created_at.isoformat()
-        }
-        for log in logs
-    ]
+    if cursor:
+        try:
+            query = query.where(keyset_after(AUDIT_ORDER, decode_cursor(cursor, len(AUDIT_ORDER))))
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    return query.order_by(*(c.desc() for c in AUDIT_ORDER))
+
+def audit_summary(log: AuditLog) -> dict:
+    return {
+        "id": log.id,
+        "event_id": log.event_id,
+        "event_type": log.event_type,
+        "matched_rules": log.matched_rules,
+        "actions_taken": log.actions_taken,
+        "evaluation_time_ms": log.evaluation_time_ms,
+        "created_at": log.created_at.isoformat()
+    }
+
+@app.get("/audit")
+def get_audit_logs(
+    event_id: str = None,
+    rule_id: str = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    db: Session = Depends(get_db)
+):
+    """Get audit logs with optional filtering; the next page's cursor is returned in X-Next-Cursor"""
+    logs = db.execute(audit_query(db, event_id, rule_id, cursor=cursor).limit(limit)).scalars().all()
+    headers = cursor_headers(next_cursor(logs, limit, lambda log: (log.created_at, log.id)))
+    return FastJSONResponse([audit_summary(log) for log in logs], headers=headers)
+
+def iter_audit_export(event_id: str = None, rule_id: str = None, start: datetime = None, end: datetime = None):
+    """Yield full audit rows from a server-side cursor, in constant memory"""
+    db = SessionLocal()
+    try:
+        table_query = audit_query(db, event_id, rule_id, start, end).with_only_columns(*AuditLog.__table__.columns)
+        result = db.execute(table_query.execution_options(stream_results=True, yield_per=1000))
+        for row in result.mappings():
+            yield dict(row)
+    finally:
+        db.close()
+
+@app.get("/audit/export")
+def export_audit_logs(
+    event_id: str = None,
+    rule_id: str = None,
+    start: datetime = None,
+    end: datetime = None,
+    db: Session = Depends(get_db)
+):
+    """Stream full audit log rows as NDJSON (newest first)"""
+    # Validate filters before the response starts streaming
+    audit_query(db, event_id, rule_id, start, end)
+    return stream_ndjson(iter_audit_export(event_id, rule_id, start, end))
+
+@app.get("/audit/archive")
+def query_audit_archive(
+    rule_id: str = None,
+    event_type: str = None,
+    event_id: str = None,
+    start: datetime = None,
+    end: datetime = None,
+    limit: int = None
+):
+    """Stream archived audit logs matching the filters as NDJSON (oldest first), without touching the database"""
+    return stream_ndjson(query_archive(rule_id, event_type, event_id, start, end, limit))
 
 @app.get("/rules/{rule_id}/versions")
 def get_rule_versions(rule_id: str, db: Session = Depends(get_db)):
@@ -376,20 +901,254 @@ def get_rule_versions(rule_id: str, db: Session = Depends(get_db)):
             "conditions": v.conditions,
             "actions": v.actions,
             "created_at": v.created_at.isoformat(),
-            "created_by": v.created_by
+            "created_by": v.created_by,
+            "shadow": bool(v.shadow),
+            "sample_rate": v.sample_rate
         }
         for v in versions
     ]
 
+@app.get("/rules/{rule_id}/history")
+def get_rule_history(rule_id: str, db: Session = Depends(get_db)):
+    """Every recorded state of a rule, oldest first (kept after the rule is deleted)"""
+    history = rule_history(db, rule_id)
+    if not history:
+        raise HTTPException(status_code=404, detail="No history for rule")
+    return FastJSONResponse({"rule_id": rule_id, "changes": history})
+
+@app.get("/ruleset")
+def get_ruleset_state(as_of: datetime = None, db: Session = Depends(get_db)):
+    """Every rule as it was at `as_of` (default now), highest priority first"""
+    as_of = as_of or datetime.utcnow()
+    return FastJSONResponse({"as_of": as_of, "rules": rules_as_of(db, as_of)})
+
+# ========== SHADOW EVALUATION ENDPOINTS ==========
+
+def get_shadow_version(db: Session, rule_id: str) -> RuleVersion:
+    shadow = db.query(RuleVersion).filter(RuleVersion.rule_id == rule_id, RuleVersion.shadow == True).first()
+    if not shadow:
+        raise HTTPException(status_code=404, detail="Rule has no shadow version")
+    return shadow
+
+def shadow_to_dict(db: Session, v: RuleVersion) -> dict:
+    return {
+        "rule_id": v.rule_id,
+        "version": v.version,
+        "sample_rate": v.sample_rate,
+        "conditions": v.conditions,
+        "actions": v.actions,
+        "created_at": v.created_at,
+        "created_by": v.created_by,
+        "stats": shadow_summary(db, v.rule_id, v.version)
+    }
+
+def end_shadow(db: Session, rule: Rule):
+    """Take the rule's current shadow version, if any, out of shadow evaluation"""
+    db.query(RuleVersion).filter(RuleVersion.rule_id == rule.id, RuleVersion.shadow == True).update({RuleVersion.shadow: False})
+    # Touch the rule so the cached ruleset is rebuilt
+    rule.updated_at = datetime.utcnow()
+
+@app.post("/rules/{rule_id}/shadow")
+def create_shadow(rule_id: str, payload: ShadowCreate, db: Session = Depends(get_db)):
+    """
+    Start shadow-evaluating a new version of a rule on a sampled fraction of live traffic.
+    Replaces the rule's previous shadow version.
+    """
+    rule = db.query(Rule).filter(Rule.id == rule_id).first()
+    if not rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    if not 0 < payload.sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate must be in (0, 1]")
+    check_conditions(db, payload.conditions)
+    
+    end_shadow(db, rule)
+    version = RuleVersion(
+        id=str(uuid.uuid4()),
+        rule_id=rule_id,
+        version=next_version(db, rule_id),
+        conditions=payload.conditions,
+        actions=payload.actions if payload.actions is not None else rule.actions,
+        created_by=payload.created_by or "system",
+        shadow=True,
+        sample_rate=payload.sample_rate
+    )
+    db.add(version)
+    db.commit()
+    invalidate_ruleset()
+    return FastJSONResponse(shadow_to_dict(db, version))
+
+@app.get("/rules/{rule_id}/shadow")
+def get_shadow(rule_id: str, db: Session = Depends(get_db)):
+    """The rule's shadow version with agreement and disagreement counts versus the live rule"""
+    return FastJSONResponse(shadow_to_dict(db, get_shadow_version(db, rule_id)))
+
+@app.delete("/rules/{rule_id}/shadow")
+def delete_shadow(rule_id: str, db: Session = Depends(get_db)):
+    """Stop shadow evaluation (the version and its counters are kept)"""
+    shadow = get_shadow_version(db, rule_id)
+    end_shadow(db, db.query(Rule).filter(Rule.id == rule_id).first())
+    db.commit()
+    invalidate_ruleset()
+    return {"rule_id": rule_id, "version": shadow.version, "shadow": False}
+
+@app.post("/rules/{rule_id}/shadow/promote")
+def promote_shadow(rule_id: str, db: Session = Depends(get_db)):
+    """Make the shadow version the live version of the rule"""
+    shadow = get_shadow_version(db, rule_id)
+    rule = db.query(Rule).filter(Rule.id == rule_id).first()
+    check_value_set_refs(db, shadow.conditions)
+    
+    end_shadow(db, rule)
+    rule.conditions = shadow.conditions
+    rule.actions = shadow.actions
+    rule.version = shadow.version
+    record_rule_change(db, rule)
+    db.commit()
+    invalidate_ruleset()
+    return {"id": rule.id, "version": rule.version, "updated_at": rule.updated_at.isoformat()}
+
+@app.get("/shadow")
+def list_shadows(db: Session = Depends(get_db)):
+    """All rules currently being shadow-evaluated"""
+    versions = db.query(RuleVersion).filter(RuleVersion.shadow == True).order_by(RuleVersion.rule_id).all()
+    return FastJSONResponse([shadow_to_dict(db, v) for v in versions])
+
+# ========== STATISTICS ENDPOINTS ==========
+
+def stats_range(start: datetime = None, end: datetime = None):
+    """Default to the last 24 hours"""
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+@app.get("/rules/{rule_id}/stats")
+def get_rule_stats_endpoint(
+    rule_id: str,
+    start: datetime = None,
+    end: datetime = None,
+    granularity: str = "hour",
+    db: Session = Depends(get_db)
+):
+    """Evaluations, matches, actions and latency for a rule, from the per-minute rollups"""
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(GRANULARITIES)}")
+    start, end = stats_range(start, end)
+    return FastJSONResponse(query_rule_stats(db, rule_id, start, end, granularity))
+
+@app.get("/stats/rules")
+def get_ruleset_stats(start: datetime = None, end: datetime = None, db: Session = Depends(get_db)):
+    """Per-rule totals for every rule evaluated in the time range"""
+    start, end = stats_range(start, end)
+    return FastJSONResponse(query_ruleset_stats(db, start, end))
+
+# ========== VALUE SET ENDPOINTS ==========
+
+def store_value_set(db: Session, name: str, values: list, description: str = None, created_by: str = None) -> ValueSet:
+    """Store a new version of a value set"""
+    error = validate_values(values)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    # Deduplicate while keeping upload order
+    values = list(dict.fromkeys(values))
+    latest = db.query(ValueSet).filter(ValueSet.name == name).order_by(ValueSet.version.desc()).first()
+    value_set = ValueSet(
+        id=str(uuid.uuid4()),
+        name=name,
+        version=(latest.version + 1) if latest else 1,
+        values=values,
+        size=len(values),
+        description=description if description is not None else (latest.description if latest else None),
+        created_by=created_by or "system"
+    )
+    db.add(value_set)
+    db.commit()
+    invalidate_ruleset()
+    return value_set
+
+def value_set_response(v: ValueSet) -> ValueSetResponse:
+    return ValueSetResponse(
+        name=v.name,
+        version=v.version,
+        size=v.size,
+        description=v.description,
+        created_by=v.created_by,
+        created_at=v.created_at
+    )
+
+@app.get("/value-sets", response_model=List[ValueSetResponse])
+def list_value_sets(db: Session = Depends(get_db)):
+    """List the latest version of every value set"""
+    sets = db.query(ValueSet).order_by(ValueSet.name, ValueSet.version.desc()).all()
+    latest = {}
+    for v in sets:
+        latest.setdefault(v.name, v)
+    return [value_set_response(v) for v in latest.values()]
+
+@app.get("/value-sets/{name}")
+def get_value_set(name: str, version: int = None, include_values: bool = False, db: Session = Depends(get_db)):
+    """Get a value set (latest version unless `version` is given)"""
+    query = db.query(ValueSet).filter(ValueSet.name == name)
+    if version is not None:
+        query = query.filter(ValueSet.version == version)
+    value_set = query.order_by(ValueSet.version.desc()).first()
+    if not value_set:
+        raise HTTPException(status_code=404, detail="Value set not found")
+    
+    result = value_set_response(value_set).model_dump()
+    if include_values:
+        result["values"] = value_set.values
+    return result
+
+@app.post("/value-sets/{name}", response_model=ValueSetResponse)
+def create_value_set(name: str, payload: ValueSetCreate, db: Session = Depends(get_db)):
+    """Upload a new version of a value set from a JSON list"""
+    value_set = store_value_set(db, name, payload.values, payload.description, payload.created_by)
+    return value_set_response(value_set)
+
+@app.post("/value-sets/{name}/upload", response_model=ValueSetResponse)
+async def upload_value_set(name: str, request: Request, db: Session = Depends(get_db)):
+    """Bulk upload a new version of a value set as plain text, one value per line"""
+    body = await request.body()
+    values = [line.strip() for line in body.decode("utf-8").splitlines() if line.strip()]
+    value_set = await run_in_threadpool(
+        store_value_set, db, name, values, created_by=request.headers.get("X-Created-By")
+    )
+    return value_set_response(value_set)
+
+@app.get("/value-sets/{name}/versions")
+def get_value_set_versions(name: str, db: Session = Depends(get_db)):
+    """Get all versions of a value set"""
+    versions = db.query(ValueSet).filter(ValueSet.name == name).order_by(ValueSet.version.desc()).all()
+    if not versions:
+        raise HTTPException(status_code=404, detail="Value set not found")
+    return [value_set_response(v) for v in versions]
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat(),
-        "kafka_available": get_kafka_producer() is not None
+        "kafka_available": get_kafka_producer() is not None,
+        "admission": get_admission_controller().snapshot()
     }
 
+@app.get("/dispatch")
+def dispatch_status():
+    """Registered action handlers and outbox counts by type and status"""
+    dispatcher = get_action_dispatcher()
+    if dispatcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **dispatcher.stats()}
+
+@app.get("/metrics")
+def metrics():
+    """Process metrics in the Prometheus text format"""
+    return Response(get_metrics().render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, String, Integer, JSON, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, JSON, Boolean, DateTime, Text, ForeignKey, UniqueConstraint
 from datetime import datetime
 
 Base = declarative_base()
@@ -19,6 +19,8 @@ class Rule(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     description = Column(Text, nullable=True)
+    parameter_keys = Column(JSON, nullable=True)  # Set for templates
+    decision_table = Column(JSON, nullable=True)  # Set for decision table rules
 
 class RuleVersion(Base):
     __tablename__ = "rule_versions"
@@ -29,11 +31,16 @@ class RuleVersion(Base):
     actions = Column(JSON, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by = Column(String, default="system")
+    shadow = Column(Boolean, default=False)  # Evaluated on sampled traffic, never returned (see shadow.py)
+    sample_rate = Column(Float, nullable=True)  # Fraction of evaluations that run the shadow version
 
 class AuditLog(Base):
     __tablename__ = "audit_logs"
+    # On PostgreSQL the table is range-partitioned by created_at (see audit_storage.py),
+    # which requires the partition key to be part of the primary key
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
     id = Column(String, primary_key=True)
-    event_id = Column(String, nullable=True)
+    event_id = Column(String, nullable=True, index=True)
     event_type = Column(String, nullable=True)
     event_data = Column(JSON, nullable=True)
     context_data = Column(JSON, nullable=True)
@@ -41,4 +48,74 @@ class AuditLog(Base):
     actions_taken = Column(JSON, default=[])
     explanation = Column(JSON, default=[])
     evaluation_time_ms = Column(Integer, nullable=True)
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow, index=True)
+
+class AuditRuleMatch(Base):
+    """One row per (audit log, matched rule), for rule_id lookups without scanning audit_logs"""
+    __tablename__ = "audit_rule_matches"
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
+    rule_id = Column(String, primary_key=True)
+    created_at = Column(DateTime, primary_key=True)  # Same as the audit log's created_at
+    audit_id = Column(String, primary_key=True)
+
+class ValueSet(Base):
+    __tablename__ = "value_sets"
+    id = Column(String, primary_key=True)
+    name = Column(String, nullable=False, index=True)
+    version = Column(Integer, nullable=False)
+    values = Column(JSON, nullable=False)
+    size = Column(Integer, default=0)
+    description = Column(Text, nullable=True)
+    created_by = Column(String, default="system")
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class RuleParameter(Base):
+    __tablename__ = "rule_parameters"
+    id = Column(String, primary_key=True)
+    rule_id = Column(String, ForeignKey("rules.id", ondelete="CASCADE"), nullable=False, index=True)
+    key = Column(JSON, nullable=True)  # null marks the default row
+    params = Column(JSON, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+class RuleStat(Base):
+    """Per-rule, per-minute evaluation rollup (see rule_stats.py)"""
+    __tablename__ = "rule_stats"
+    rule_id = Column(String, primary_key=True)
+    minute = Column(Integer, primary_key=True)  # Minutes since the Unix epoch (UTC)
+    evaluations = Column(Integer, nullable=False, default=0)
+    matches = Column(Integer, nullable=False, default=0)
+    actions = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Float, nullable=False, default=0.0)  # Sum over all evaluations
+
+class ShadowStat(Base):
+    """Agreement counters of a shadow rule version against the live rule"""
+    __tablename__ = "shadow_stats"
+    rule_id = Column(String, primary_key=True)
+    version = Column(Integer, primary_key=True)
+    evaluated = Column(Integer, nullable=False, default=0)
+    agreed = Column(Integer, nullable=False, default=0)
+    shadow_only = Column(Integer, nullable=False, default=0)  # Shadow matched, live did not
+    live_only = Column(Integer, nullable=False, default=0)  # Live matched, shadow did not
+    errors = Column(Integer, nullable=False, default=0)
+    dropped = Column(Integer, nullable=False, default=0)  # Sampled but skipped (CPU budget or queue full)
+    cpu_ms = Column(Float, nullable=False, default=0.0)
+
+class RuleStateChange(Base):
+    """One committed change to a rule's evaluable state (see rule_history.py)"""
+    __tablename__ = "rule_state_changes"
+    __table_args__ = (UniqueConstraint("rule_id", "seq"),)
+    id = Column(String, primary_key=True)
+    rule_id = Column(String, nullable=False, index=True)
+    seq = Column(Integer, nullable=False)  # Per-rule sequence number
+    kind = Column(String, nullable=False)  # checkpoint | delta | delete
+    state = Column(JSON, nullable=True)  # Full state for checkpoints, changes for deltas
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class IdempotencyRecord(Base):
+    """Response of an evaluation, kept so that retries with the same event_id replay it (see idempotency.py)"""
+    __tablename__ = "idempotency_records"
+    event_id = Column(String, primary_key=True)
+    fingerprint = Column(String, primary_key=True)  # Ruleset the response was computed with
+    response = Column(JSON, nullable=False)
+    request_hash = Column(String)  # Hash of the request body; a reused event_id with another body is a conflict
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,54 @@
+"""
+Keyset (cursor) pagination helpers
+
+A cursor encodes the sort key of the last row on a page. The next page continues strictly
+after that key, so paging stays fast at any depth and is stable while rows are inserted.
+All keysets used here sort every column descending.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Sequence
+
+from sqlalchemy import and_, or_
+
+# Largest `limit` a paginated endpoint accepts
+MAX_PAGE_SIZE = 10000
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor cannot be decoded"""
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    payload = [{"dt": v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values = [datetime.fromisoformat(v["dt"]) if isinstance(v, dict) else v for v in payload]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor("Invalid cursor")
+    if len(values) != size:
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+def keyset_after(columns: Sequence, values: Sequence[Any]):
+    """
+    Filter for rows strictly after `values` in (col1 DESC, col2 DESC, ...) order:
+    c1 < v1 OR (c1 = v1 AND c2 < v2) OR ...
+    """
+    clauses = []
+    for i, (col, value) in enumerate(zip(columns, values)):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*equal, col < value))
+    return or_(*clauses)
+
+def next_cursor(rows: Sequence[Any], limit: Optional[int], key) -> Optional[str]:
+    """Cursor for the page after `rows`, or None when this is the last page"""
+    if not limit or len(rows) < limit:
+        return None
+    return encode_cursor(key(rows[-1]))
+
+def cursor_headers(cursor: Optional[str]) -> dict:
+    return {"X-Next-Cursor": cursor} if cursor else {}
@@ -0,0 +1,233 @@
+"""
+Result delivery for async_mode evaluations
+
+An async submission gets a ticket at once and is evaluated on a small background pool
+(ASYNC_EVALUATION_WORKERS, default 4). Its result is kept in memory for RESULT_TTL seconds
+(default 600) and delivered by:
+
+- GET /evaluate/results/{ticket}?wait=30 - long-poll: returns as soon as the result is ready,
+  or reports the ticket still pending after `wait` seconds
+- GET /evaluate/results/stream?tickets=a,b,c - server-sent events: one `result` event per
+  ticket as it completes, over a single connection, with keep-alive comments in between
+
+Waiting clients hold no thread: a long-poll is an asyncio future, and a stream is an asyncio
+queue, registered on the ticket. Completing a ticket wakes its waiters through their event
+loop. Thousands of clients can wait on one worker. Results are per worker process, so a
+ticket must be fetched from the worker that accepted it.
+"""
+import asyncio
+import os
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import get_metrics
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+RESULT_TTL = float(os.getenv("RESULT_TTL", "600"))
+MAX_TICKETS = int(os.getenv("RESULT_STORE_SIZE", "100000"))
+WORKERS = int(os.getenv("ASYNC_EVALUATION_WORKERS", "4"))
+# Submissions waiting for a worker beyond this are rejected
+MAX_PENDING = int(os.getenv("ASYNC_MAX_PENDING", "10000"))
+MAX_WAIT_SECONDS = 60.0
+HEARTBEAT_SECONDS = 15.0
+
+_metrics = get_metrics()
+SUBMITTED = _metrics.counter("async_evaluations_total", "Async evaluations by outcome (submitted, done, failed, rejected)", ("status",))
+DELIVERY_SECONDS = _metrics.histogram("async_evaluation_seconds", "Time from async submission to result")
+
+Waiter = Tuple[asyncio.AbstractEventLoop, Callable[[Dict], None]]
+
+class _Ticket:
+    __slots__ = ("created", "expires", "state", "waiters")
+
+    def __init__(self, now: float):
+        self.created = now
+        self.expires = now + RESULT_TTL
+        self.state: Dict = {"status": "pending"}
+        self.waiters: List[Waiter] = []
+
+class ResultStore:
+    """Tickets and their results, with waiters woken in their own event loop"""
+
+    def __init__(self, max_tickets: int = MAX_TICKETS):
+        self.max_tickets = max_tickets
+        self._tickets: "OrderedDict[str, _Ticket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def _expire(self, now: float):
+        # Oldest first. Completed tickets live RESULT_TTL past completion, so an expired ticket
+        # can wait behind a live one; the store size bound still holds
+        while self._tickets:
+            ticket, entry = next(iter(self._tickets.items()))
+            if entry.expires > now and len(self._tickets) <= self.max_tickets:
+                break
+            self._tickets.popitem(last=False)
+            for loop, callback in entry.waiters:
+                loop.call_soon_threadsafe(callback, {"ticket": ticket, "status": "expired"})
+
+    def create(self) -> str:
+        ticket = uuid.uuid4().hex
+        now = time.monotonic()
+        with self._lock:
+            self._tickets[ticket] = _Ticket(now)
+            self._expire(now)
+        return ticket
+
+    def complete(self, ticket: str, state: Dict):
+        """Store a ticket's final state ({"status": "done", "result": ...} or failed) and wake its waiters"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tickets.get(ticket)
+            if entry is None:
+                return
+            entry.state = {"ticket": ticket, **state}
+            entry.expires = now + RESULT_TTL
+            waiters, entry.waiters = entry.waiters, []
+            created = entry.created
+        DELIVERY_SECONDS.observe(now - created)
+        for loop, callback in waiters:
+            loop.call_soon_threadsafe(callback, entry.state)
+
+    def get(self, ticket: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._tickets.get(ticket)
+            if entry is None or entry.expires <= time.monotonic():
+                return None
+            return {"ticket": ticket, **entry.state}
+
+    def subscribe(self, ticket: str, callback: Callable[[Dict], None]) -> Optional[Dict]:
+        """
+        Call `callback(state)` in the running event loop when the ticket completes.
+        Returns the state instead if it is already final, or {"status": "unknown"}.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._tickets.get(ticket)
+            if entry is None or entry.expires <= time.monotonic():
+                return {"ticket": ticket, "status": "unknown"}
+            if entry.state["status"] != "pending":
+                return entry.state
+            entry.waiters.append((loop, callback))
+            return None
+
+    def unsubscribe(self, ticket: str, callback: Callable[[Dict], None]):
+        with self._lock:
+            entry = self._tickets.get(ticket)
+            if entry is not None:
+                entry.waiters = [w for w in entry.waiters if w[1] != callback]
+
+    async def wait(self, ticket: str, timeout: float) -> Dict:
+        """The ticket's state once final, or its pending state after `timeout` seconds"""
+        future = asyncio.get_running_loop().create_future()
+
+        def resolve(state: Dict):
+            if not future.done():
+                future.set_result(state)
+
+        state = self.subscribe(ticket, resolve)
+        if state is not None:
+            return state
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return {"ticket": ticket, "status": "pending"}
+        finally:
+            self.unsubscribe(ticket, resolve)
+
+    async def stream(self, tickets: List[str]):
+        """Server-sent events: one `result` event per ticket as it completes"""
+        queue: asyncio.Queue = asyncio.Queue()
+        remaining = set()
+        try:
+            for ticket in dict.fromkeys(tickets):
+                state = self.subscribe(ticket, queue.put_nowait)
+                if state is not None:
+                    queue.put_nowait(state)
+                remaining.add(ticket)
+            while remaining:
+                try:
+                    state = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                remaining.discard(state["ticket"])
+                yield f"id: {state['ticket']}\nevent: result\ndata: {dumps(state).decode('utf-8')}\n\n"
+        finally:
+            # Runs when the stream ends or the client disconnects
+            for ticket in remaining:
+                self.unsubscribe(ticket, queue.put_nowait)
+
+class AsyncEvaluator:
+    """Evaluates async submissions on a background pool and completes their tickets"""
+
+    def __init__(self, store: ResultStore, workers: int = WORKERS, max_pending: int = MAX_PENDING):
+        self.store = store
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="async-eval")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, evaluate: Callable[[], Dict]) -> Optional[str]:
+        """Queue `evaluate()`; returns its ticket, or None when too many submissions are pending"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                SUBMITTED.inc(status="rejected")
+                return None
+            self._pending += 1
+        ticket = self.store.create()
+        SUBMITTED.inc(status="submitted")
+        self._executor.submit(self._run, ticket, evaluate)
+        return ticket
+
+    def _run(self, ticket: str, evaluate: Callable[[], Dict]):
+        try:
+            state = {"status": "done", "result": evaluate()}
+        except Exception as e:
+            logger.error(f"Async evaluation {ticket} failed: {e}")
+            state = {"status": "failed", "error": getattr(e, "detail", None) or str(e)}
+        finally:
+            with self._lock:
+                self._pending -= 1
+        SUBMITTED.inc(status=state["status"])
+        self.store.complete(ticket, state)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+_store = ResultStore()
+_evaluator: Optional[AsyncEvaluator] = None
+_evaluator_lock = threading.Lock()
+_metrics.gauge("async_tickets", "Tickets held in the result store", function=lambda: len(_store))
+
+def get_result_store() -> ResultStore:
+    return _store
+
+def get_async_evaluator() -> AsyncEvaluator:
+    """The async evaluator, started on first use"""
+    global _evaluator
+    if _evaluator is None:
+        with _evaluator_lock:
+            if _evaluator is None:
+                _evaluator = AsyncEvaluator(_store)
+    return _evaluator
+
+def stop_async_evaluator():
+    """Finish queued async evaluations and stop the pool"""
+    global _evaluator
+    if _evaluator is not None:
+        _evaluator.shutdown()
+        _evaluator = None
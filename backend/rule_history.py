@@ -0,0 +1,320 @@
+"""
+Point-in-time rule history
+
+Every committed change to a rule records its complete evaluable state (everything that
+affects evaluation: priority, active, stop_on_match, conditions, actions, template parameters,
+decision table, ...) in `rule_state_changes`. Most changes are stored as deltas against the
+previous state; every RULE_HISTORY_CHECKPOINT_EVERY changes (and on creation) a full
+checkpoint is written instead, so reconstructing a rule never replays more than that many
+deltas.
+
+`get_ruleset_as_of(db, T)` reconstructs every rule as it was at T with one query, pinning value set
+references to the versions that were current at T. Compiled historical rulesets are kept in a
+small LRU cache keyed by the last change at or before T, so repeated replays against the same
+point in history are as fast as live evaluation.
+
+Sliding-window aggregates and context providers are not historical: replays read their
+current state.
+"""
+import copy
+import os
+import threading
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from sqlalchemy import and_, exists, func, insert, select
+from sqlalchemy.orm import Session
+
+from models import Rule, RuleParameter, RuleStateChange, ValueSet
+from ruleset import CompiledRuleset, compile_spec, load_value_sets, rule_spec
+from templates import ParameterRow
+from value_sets import get_value_set_registry
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_EVERY = int(os.getenv("RULE_HISTORY_CHECKPOINT_EVERY", "20"))
+SNAPSHOT_CACHE_SIZE = int(os.getenv("RULE_HISTORY_CACHE_SIZE", "32"))
+
+STATE_FIELDS = ("name", "priority", "active", "version", "conditions", "actions", "tags",
+                "stop_on_match", "description", "parameter_keys", "decision_table")
+
+# ========== DELTAS ==========
+
+def diff_state(old: Any, new: Any, path: Tuple = ()) -> Dict[str, List]:
+    """
+    Delta turning `old` into `new`: {"set": [[path, value], ...], "unset": [path, ...]}.
+    Dicts are compared key by key; any other changed value is replaced whole.
+    """
+    delta = {"set": [], "unset": []}
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            if key not in old:
+                delta["set"].append([list(path + (key,)), value])
+            elif old[key] != value:
+                sub = diff_state(old[key], value, path + (key,))
+                delta["set"].extend(sub["set"])
+                delta["unset"].extend(sub["unset"])
+        for key in old:
+            if key not in new:
+                delta["unset"].append(list(path + (key,)))
+    elif old != new:
+        delta["set"].append([list(path), new])
+    return delta
+
+def apply_delta(state: Dict, delta: Dict) -> Dict:
+    """Apply a delta from diff_state to a copy of `state`"""
+    state = copy.deepcopy(state)
+    for path, value in delta.get("set", []):
+        if not path:
+            return copy.deepcopy(value)
+        target = state
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    for path in delta.get("unset", []):
+        target = state
+        for key in path[:-1]:
+            target = target.get(key, {})
+        target.pop(path[-1], None)
+    return state
+
+# ========== RECORDING ==========
+
+def _field(rule: Union[Rule, Dict], name: str) -> Any:
+    return rule.get(name) if isinstance(rule, dict) else getattr(rule, name)
+
+def rule_state(rule: Union[Rule, Dict], parameter_rows: List[RuleParameter]) -> Dict:
+    """Complete evaluable state of a rule (a row or a dict of its columns), including its template parameter rows"""
+    state = {name: _field(rule, name) for name in STATE_FIELDS}
+    state["tags"] = state["tags"] or []
+    rows = sorted(parameter_rows, key=lambda p: p.id) if state["parameter_keys"] else []
+    state["parameter_rows"] = [{"id": p.id, "key": p.key, "params": p.params} for p in rows]
+    return state
+
+def _replay(changes: List[RuleStateChange]) -> Optional[Dict]:
+    """Fold a checkpoint and the deltas after it into a state (None if the rule was deleted)"""
+    state = None
+    for change in changes:
+        if change.kind == "checkpoint":
+            state = change.state
+        elif change.kind == "delta" and state is not None:
+            state = apply_delta(state, change.state)
+        elif change.kind == "delete":
+            state = None
+    return state
+
+def _rule_id(rule: Union[Rule, Dict]) -> str:
+    return _field(rule, "id")
+
+def _chunks(items: List, size: int = 1000):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _latest_changes(db: Session, rule_ids: List[str]) -> Dict[str, List[RuleStateChange]]:
+    """Changes of each rule since its latest checkpoint (or delete)"""
+    latest = {}
+    for chunk in _chunks(rule_ids):
+        base = (
+            select(RuleStateChange.rule_id, func.max(RuleStateChange.seq).label("base_seq"))
+            .where(RuleStateChange.rule_id.in_(chunk), RuleStateChange.kind.in_(("checkpoint", "delete")))
+            .group_by(RuleStateChange.rule_id)
+            .subquery()
+        )
+        changes = db.execute(
+            select(RuleStateChange)
+            .join(base, and_(RuleStateChange.rule_id == base.c.rule_id, RuleStateChange.seq >= base.c.base_seq))
+            .order_by(RuleStateChange.rule_id, RuleStateChange.seq)
+        ).scalars()
+        for change in changes:
+            latest.setdefault(change.rule_id, []).append(change)
+    return latest
+
+def _parameter_rows(db: Session, rule_ids: List[str]) -> Dict[str, List[RuleParameter]]:
+    rows = {}
+    for chunk in _chunks(rule_ids):
+        for p in db.query(RuleParameter).filter(RuleParameter.rule_id.in_(chunk)):
+            rows.setdefault(p.rule_id, []).append(p)
+    return rows
+
+def record_rule_changes(db: Session, rules: List[Union[Rule, Dict]], changed_at: datetime = None) -> int:
+    """
+    Record the current state of each rule, given as a row or a dict of its columns (call
+    before committing the change). Rules whose evaluable state did not change are skipped;
+    returns the number recorded.
+    """
+    db.flush()
+    ids = [_rule_id(rule) for rule in rules]
+    latest = _latest_changes(db, ids)
+    templates = [_rule_id(rule) for rule in rules if _field(rule, "parameter_keys")]
+    parameter_rows = _parameter_rows(db, templates) if templates else {}
+    changed_at = changed_at or datetime.utcnow()
+
+    records = []
+    for rule_id, rule in zip(ids, rules):
+        changes = latest.get(rule_id, [])
+        previous = _replay(changes)
+        current = rule_state(rule, parameter_rows.get(rule_id, []))
+        if previous == current:
+            continue
+        # Deltas since the last checkpoint are len(changes) - 1
+        if previous is None or len(changes) >= CHECKPOINT_EVERY:
+            kind, state = "checkpoint", current
+        else:
+            kind, state = "delta", diff_state(previous, current)
+        records.append({
+            "id": str(uuid.uuid4()),
+            "rule_id": rule_id,
+            "seq": (changes[-1].seq + 1) if changes else 1,
+            "kind": kind,
+            "state": state,
+            "changed_at": changed_at
+        })
+    if records:
+        db.execute(insert(RuleStateChange), records)
+    return len(records)
+
+def record_rule_change(db: Session, rule: Rule, deleted: bool = False, changed_at: datetime = None):
+    """Record one rule's current state, or its deletion (call before committing the change)"""
+    if not deleted:
+        record_rule_changes(db, [rule], changed_at)
+        return
+    db.flush()
+    changes = _latest_changes(db, [rule.id]).get(rule.id, [])
+    db.add(RuleStateChange(
+        id=str(uuid.uuid4()),
+        rule_id=rule.id,
+        seq=(changes[-1].seq + 1) if changes else 1,
+        kind="delete",
+        state=None,
+        changed_at=changed_at or datetime.utcnow()
+    ))
+
+def backfill_history(db: Session) -> int:
+    """Checkpoint rules that predate history recording, as of their creation time"""
+    missing = db.query(Rule).filter(~exists().where(RuleStateChange.rule_id == Rule.id)).all()
+    for rule in missing:
+        record_rule_changes(db, [rule], changed_at=rule.created_at or datetime.utcnow())
+    db.commit()
+    if missing:
+        # Backfilled checkpoints change history in the past
+        _cache.clear()
+    return len(missing)
+
+# ========== RECONSTRUCTION ==========
+
+def rules_as_of(db: Session, as_of: datetime) -> List[Dict]:
+    """Every rule that existed at `as_of`, as it was then (inactive rules included)"""
+    base = (
+        select(RuleStateChange.rule_id, func.max(RuleStateChange.seq).label("base_seq"))
+        .where(RuleStateChange.kind.in_(("checkpoint", "delete")), RuleStateChange.changed_at <= as_of)
+        .group_by(RuleStateChange.rule_id)
+        .subquery()
+    )
+    changes = db.execute(
+        select(RuleStateChange)
+        .join(base, and_(RuleStateChange.rule_id == base.c.rule_id, RuleStateChange.seq >= base.c.base_seq))
+        .where(RuleStateChange.changed_at <= as_of)
+        .order_by(RuleStateChange.rule_id, RuleStateChange.seq)
+    ).scalars().all()
+
+    states = []
+    start = 0
+    for i in range(1, len(changes) + 1):
+        if i == len(changes) or changes[i].rule_id != changes[start].rule_id:
+            state = _replay(changes[start:i])
+            if state is not None:
+                states.append({"id": changes[start].rule_id, **state})
+            start = i
+    states.sort(key=lambda s: s["priority"], reverse=True)
+    return states
+
+def rule_history(db: Session, rule_id: str) -> List[Dict]:
+    """Every recorded state of a rule, oldest first"""
+    changes = db.query(RuleStateChange).filter(RuleStateChange.rule_id == rule_id).order_by(RuleStateChange.seq).all()
+    history = []
+    state = None
+    for change in changes:
+        state = _replay([change]) if change.kind != "delta" else apply_delta(state or {}, change.state)
+        history.append({"seq": change.seq, "kind": change.kind, "changed_at": change.changed_at, "state": state})
+    return history
+
+def pin_value_sets(condition: Any, versions: Dict[str, int]) -> Any:
+    """Copy of a condition AST with unpinned value set references pinned to `versions`"""
+    if isinstance(condition, list):
+        return [pin_value_sets(c, versions) for c in condition]
+    if not isinstance(condition, dict):
+        return condition
+    pinned = {k: pin_value_sets(v, versions) if k == "clauses" else v for k, v in condition.items()}
+    name = condition.get("value_set")
+    if name is not None and condition.get("value_set_version") is None and name in versions:
+        pinned["value_set_version"] = versions[name]
+    return pinned
+
+def _value_set_versions_as_of(db: Session, as_of: datetime) -> Dict[str, int]:
+    rows = db.query(ValueSet.name, func.max(ValueSet.version)).filter(ValueSet.created_at <= as_of).group_by(ValueSet.name).all()
+    return dict(rows)
+
+def _history_position(db: Session, as_of: datetime) -> Tuple:
+    """Identifies the state of history at `as_of`: equal positions give equal rulesets"""
+    last_change = db.query(func.max(RuleStateChange.changed_at)).filter(RuleStateChange.changed_at <= as_of).scalar()
+    last_set = db.query(func.max(ValueSet.created_at)).filter(ValueSet.created_at <= as_of).scalar()
+    return (last_change, last_set)
+
+def _state_spec(state: Dict, versions: Dict[str, int]) -> Dict:
+    """Compilable spec of a historical rule state, with value sets pinned as of its time"""
+    state = {**state, "conditions": pin_value_sets(state["conditions"], versions)}
+    rows = [ParameterRow(r["id"], r["key"], r["params"]) for r in state["parameter_rows"]]
+    return rule_spec(state, rows)
+
+class HistoricalRulesetCache:
+    """LRU of compiled historical rulesets"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: "OrderedDict[Tuple, Tuple[CompiledRuleset, set]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, as_of: datetime) -> CompiledRuleset:
+        position = _history_position(db, as_of)
+        with self._lock:
+            entry = self._entries.get(position)
+            if entry is not None:
+                self._entries.move_to_end(position)
+                return entry[0]
+
+        versions = _value_set_versions_as_of(db, as_of)
+        specs = [_state_spec(state, versions) for state in rules_as_of(db, as_of) if state["active"]]
+        keys = load_value_sets(db, [s["conditions"] for s in specs])
+        ruleset = CompiledRuleset([compile_spec(s) for s in specs], fingerprint=position)
+
+        with self._lock:
+            self._entries[position] = (ruleset, keys)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            # Keep the value sets of cached snapshots loaded across live ruleset reloads
+            get_value_set_registry().hold("history", set().union(*(k for _, k in self._entries.values())))
+        return ruleset
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            get_value_set_registry().hold("history", set())
+
+# Global cache instance
+_cache = HistoricalRulesetCache(SNAPSHOT_CACHE_SIZE)
+
+def get_ruleset_as_of(db: Session, as_of: datetime) -> CompiledRuleset:
+    """The active ruleset as it was at `as_of`"""
+    return _cache.get(db, as_of)
+
+def compile_rule_as_of(db: Session, rule_id: str, as_of: datetime):
+    """(state, compiled rule) of one rule as it was at `as_of`, active or not; None if it did not exist"""
+    state = next((s for s in rules_as_of(db, as_of) if s["id"] == rule_id), None)
+    if state is None:
+        return None
+    spec = _state_spec(state, _value_set_versions_as_of(db, as_of))
+    load_value_sets(db, [spec["conditions"]])
+    return state, compile_spec(spec)
@@ -0,0 +1,242 @@
+"""
+Per-rule hit-rate rollups
+
+Every live evaluation records, for each rule it evaluated, whether the rule matched, how many
+actions it emitted and how long it took. Counts are accumulated in memory per (rule, minute)
+and flushed every RULE_STATS_FLUSH_INTERVAL seconds (default 10) into the `rule_stats` table,
+adding to any counts other workers already wrote for the same minute. Statistics queries read
+only the rollups, so they stay fast over any time range; they lag live traffic by at most one
+flush interval.
+"""
+import math
+import os
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select, update, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import RuleStat
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {"minute": 1, "hour": 60, "day": 1440}
+
+def to_minute(ts: datetime, round_up: bool = False) -> int:
+    """Minutes since the Unix epoch; naive datetimes are taken as UTC"""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    minutes = ts.timestamp() / 60
+    return math.ceil(minutes) if round_up else math.floor(minutes)
+
+def from_minute(minute: int) -> datetime:
+    return datetime.utcfromtimestamp(minute * 60)
+
+class CounterRecorder:
+    """
+    In-memory counters keyed by the table's key columns, waiting to be flushed.
+    Flushing adds them to whatever is already stored for the same key.
+    """
+
+    def __init__(self, table, key_columns: Tuple[str, ...], counter_columns: Tuple[str, ...]):
+        self.table = table
+        self.key_columns = key_columns
+        self.counter_columns = counter_columns
+        self._pending: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def _counters(self, key: tuple) -> list:
+        """Counters for `key`; call with the lock held"""
+        counters = self._pending.get(key)
+        if counters is None:
+            counters = self._pending[key] = [0] * len(self.counter_columns)
+        return counters
+
+    def add(self, key: tuple, values: Iterable[float]):
+        with self._lock:
+            counters = self._counters(key)
+            for i, value in enumerate(values):
+                counters[i] += value
+
+    def drain(self) -> Dict[tuple, list]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def pending(self, key: tuple) -> Dict[str, float]:
+        """Counters for `key` that have not been flushed yet"""
+        with self._lock:
+            counters = self._pending.get(key) or [0] * len(self.counter_columns)
+            return dict(zip(self.counter_columns, counters))
+
+    def flush(self, engine: Engine) -> int:
+        """Add pending counters to the table; returns the number of rows written"""
+        pending = self.drain()
+        if not pending:
+            return 0
+        rows = [
+            {**dict(zip(self.key_columns, key)), **dict(zip(self.counter_columns, counters))}
+            for key, counters in pending.items()
+        ]
+        try:
+            with engine.begin() as conn:
+                additive_upsert(conn, self.table, self.key_columns, self.counter_columns, rows)
+        except Exception:
+            # Put the counters back so they are retried on the next flush
+            for key, counters in pending.items():
+                self.add(key, counters)
+            raise
+        return len(rows)
+
+class RuleStatsRecorder(CounterRecorder):
+    """Per-(rule, minute) evaluation counters"""
+
+    def __init__(self):
+        super().__init__(RuleStat.__table__, ("rule_id", "minute"), ("evaluations", "matches", "actions", "latency_ms"))
+
+    def record(self, samples: Iterable[Tuple[str, bool, int, float]], now: Optional[float] = None):
+        """Record (rule_id, matched, action_count, seconds) samples from one evaluation"""
+        minute = int((time.time() if now is None else now) // 60)
+        with self._lock:
+            for rule_id, matched, action_count, seconds in samples:
+                counters = self._counters((rule_id, minute))
+                counters[0] += 1
+                if matched:
+                    counters[1] += 1
+                    counters[2] += action_count
+                counters[3] += seconds * 1000
+
+def additive_upsert(conn, table, key_columns: Tuple[str, ...], counter_columns: Tuple[str, ...], rows: List[Dict]):
+    """Insert counter rows, adding to the existing counts of rows with the same key"""
+    if conn.dialect.name in ("postgresql", "sqlite"):
+        if conn.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c[name] for name in key_columns],
+            set_={name: table.c[name] + stmt.excluded[name] for name in counter_columns}
+        )
+        conn.execute(stmt, rows)
+        return
+    for row in rows:
+        result = conn.execute(
+            update(table)
+            .where(*(table.c[name] == row[name] for name in key_columns))
+            .values({name: table.c[name] + row[name] for name in counter_columns})
+        )
+        if result.rowcount == 0:
+            conn.execute(insert(table), row)
+
+def _totals(evaluations: int, matches: int, actions: int, latency_ms: float) -> Dict:
+    evaluations = int(evaluations or 0)
+    matches = int(matches or 0)
+    return {
+        "evaluations": evaluations,
+        "matches": matches,
+        "hit_rate": matches / evaluations if evaluations else 0.0,
+        "actions": int(actions or 0),
+        "avg_latency_ms": (latency_ms or 0.0) / evaluations if evaluations else 0.0
+    }
+
+def _sums():
+    return (
+        func.sum(RuleStat.evaluations),
+        func.sum(RuleStat.matches),
+        func.sum(RuleStat.actions),
+        func.sum(RuleStat.latency_ms)
+    )
+
+def query_rule_stats(db: Session, rule_id: str, start: datetime, end: datetime, granularity: str = "hour") -> Dict:
+    """Totals and a time series for one rule over [start, end)"""
+    step = GRANULARITIES[granularity]
+    # Minutes that overlap [start, end), including a partial current minute
+    first, last = to_minute(start), to_minute(end, round_up=True)
+    in_range = (RuleStat.rule_id == rule_id, RuleStat.minute >= first, RuleStat.minute < last)
+
+    totals = db.execute(select(*_sums()).where(*in_range)).one()
+    bucket = (RuleStat.minute // step) * step if step > 1 else RuleStat.minute
+    series = db.execute(
+        select(bucket.label("bucket"), *_sums()).where(*in_range).group_by(bucket).order_by(bucket)
+    ).all()
+
+    return {
+        "rule_id": rule_id,
+        "start": start,
+        "end": end,
+        "granularity": granularity,
+        "totals": _totals(*totals),
+        "series": [{"start": from_minute(int(row[0])), **_totals(*row[1:])} for row in series]
+    }
+
+def query_ruleset_stats(db: Session, start: datetime, end: datetime) -> Dict:
+    """Totals for every rule with activity in [start, end), most evaluated first"""
+    # Minutes that overlap [start, end), including a partial current minute
+    first, last = to_minute(start), to_minute(end, round_up=True)
+    rows = db.execute(
+        select(RuleStat.rule_id, *_sums())
+        .where(RuleStat.minute >= first, RuleStat.minute < last)
+        .group_by(RuleStat.rule_id)
+        .order_by(func.sum(RuleStat.evaluations).desc())
+    ).all()
+    return {
+        "start": start,
+        "end": end,
+        "rules": [{"rule_id": row[0], **_totals(*row[1:])} for row in rows]
+    }
+
+# Global recorder instance
+_recorder = RuleStatsRecorder()
+
+def get_rule_stats() -> RuleStatsRecorder:
+    """Get the process-wide rule statistics recorder"""
+    return _recorder
+
+class StatsFlusher:
+    """Background thread that periodically flushes a recorder"""
+
+    def __init__(self, recorder: CounterRecorder, engine: Engine, interval: float):
+        self.recorder = recorder
+        self.engine = engine
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rule-stats-flush", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        try:
+            self.recorder.flush(self.engine)
+        except Exception as e:
+            logger.error(f"Failed to flush {self.recorder.table.name}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+_flusher: Optional[StatsFlusher] = None
+
+def start_stats_flush(engine: Engine):
+    """Start flushing rule statistics every RULE_STATS_FLUSH_INTERVAL seconds"""
+    global _flusher
+    if _flusher is not None:
+        return
+    _flusher = StatsFlusher(_recorder, engine, float(os.getenv("RULE_STATS_FLUSH_INTERVAL", "10")))
+    _flusher.start()
+
+def stop_stats_flush():
+    """Write pending statistics and stop the background flusher"""
+    global _flusher
+    if _flusher is not None:
+        _flusher.stop()
+        _flusher = None
@@ -0,0 +1,523 @@
+"""
+Python client for the rules engine API
+
+RulesClient (threads) and AsyncRulesClient (asyncio) keep a pool of keep-alive connections
+and retry failed calls: connection errors, timeouts and 429/502/503/504 responses, with
+exponential backoff or the server's Retry-After. Every evaluation is sent with an event_id,
+generated when the caller gives none, so a retry replays the first response instead of
+evaluating and auditing the event twice (see idempotency.py).
+
+Concurrent evaluate() calls are micro-batched. While `max_in_flight` requests are being
+sent, new calls queue up, and the next request carries all of them (up to `batch_size`) to
+POST /evaluate/batch. The NDJSON response is parsed line by line, so each caller returns as
+soon as its own result arrives. A call with nothing to batch with goes to /evaluate as usual,
+and against a server without /evaluate/batch the client falls back to /evaluate.
+
+    with RulesClient("http://rules:8000", caller="fraud-service") as client:
+        result = client.evaluate({"type": "payment", "amount": 900}, {"country": "US"})
+        for result in client.evaluate_many(events):
+            ...
+
+    async with AsyncRulesClient("http://rules:8000") as client:
+        results = await asyncio.gather(*(client.evaluate(e) for e in events))
+
+To run against the app in-process, pass an httpx transport, or an httpx.Client such as
+FastAPI's TestClient:
+
+    AsyncRulesClient(transport=httpx.ASGITransport(app=main.app))
+    RulesClient(http_client=TestClient(main.app))
+
+The client depends only on httpx (and orjson when installed), so it can be copied into other
+services on its own.
+
+Usage:
+    python rules_client.py bench [--url URL] [--requests N] [--concurrency N] [--no-batching] [--asyncio]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import httpx
+
+# Try to import orjson, but make it optional
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+RETRY_STATUSES = (429, 502, 503, 504)
+JSON_HEADERS = {"Content-Type": "application/json"}
+NDJSON_HEADERS = {"Content-Type": "application/x-ndjson"}
+
+# An event, or an (event, context) or (event, context, event_id) tuple
+EventItem = Union[Dict, Tuple]
+
+def dumps(obj: Any) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def loads(data: Union[bytes, str]) -> Any:
+    return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+
+class RulesEngineError(Exception):
+    """A call the server rejected, or that still failed after the last retry"""
+
+    def __init__(self, status_code: Optional[int], detail: Any):
+        super().__init__(f"{status_code}: {detail}" if status_code else str(detail))
+        self.status_code = status_code
+        self.detail = detail
+
+def evaluate_body(event: Dict, context: Optional[Dict] = None, event_id: Optional[str] = None, **options) -> Dict:
+    """/evaluate request body; the event_id makes retries idempotent"""
+    return {"event": event, "context": context or {}, "event_id": event_id or uuid.uuid4().hex, **options}
+
+def _request_bodies(events: Iterable[EventItem], context: Optional[Dict], options: Dict) -> Iterator[Dict]:
+    for item in events:
+        if isinstance(item, tuple):
+            yield evaluate_body(*item, **options)
+        else:
+            yield evaluate_body(item, context, **options)
+
+def _chunks(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _result(response: httpx.Response) -> Dict:
+    """The response body, or RulesEngineError with the server's detail"""
+    if response.status_code == 200:
+        return loads(response.content)
+    try:
+        detail = loads(response.content).get("detail")
+    except (ValueError, AttributeError):
+        detail = response.text
+    raise RulesEngineError(response.status_code, detail)
+
+def _settle_line(pending: List[Tuple[Dict, Any]], line: Union[bytes, str]):
+    """Resolve the future of one /evaluate/batch result line"""
+    if not line:
+        return
+    item = loads(line)
+    future = pending[item["index"]][1]
+    if future.done():
+        return
+    if item["status"] == 200:
+        future.set_result(item["result"])
+    else:
+        future.set_exception(RulesEngineError(item["status"], item.get("detail")))
+
+class _ClientBase:
+    def __init__(self, base_url: str = "http://localhost:8000", timeout: float = 5.0, connect_timeout: float = 1.0,
+                 retries: int = 2, backoff: float = 0.05, max_backoff: float = 2.0, caller: Optional[str] = None,
+                 max_connections: int = 20, batching: bool = True, batch_size: int = 100,
+                 batch_wait_ms: float = 0, max_in_flight: int = 4):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.caller = caller
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.batching = batching
+        self.batch_size = batch_size
+        # How long a call waits for others to batch with; by default only calls already queued are batched
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_in_flight = max_in_flight
+        # Cleared on the first 404 from /evaluate/batch
+        self.batch_supported = True
+
+    def _client_options(self) -> Dict:
+        return {
+            "base_url": self.base_url,
+            "timeout": self.timeout,
+            "limits": self.limits,
+            "headers": {"X-Caller": self.caller} if self.caller else None
+        }
+
+    def _delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """Seconds before retry `attempt` + 1: the server's Retry-After, else jittered backoff"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+
+    def _retryable(self, attempt: int, response: httpx.Response) -> bool:
+        return response.status_code in RETRY_STATUSES and attempt < self.retries
+
+class RulesClient(_ClientBase):
+    """Thread-safe client; share one instance per process"""
+
+    def __init__(self, base_url: str = "http://localhost:8000", transport: Optional[httpx.BaseTransport] = None,
+                 http_client: Optional[httpx.Client] = None, **settings):
+        super().__init__(base_url, **settings)
+        self._owns_http = http_client is None
+        self._http = http_client or httpx.Client(transport=transport, **self._client_options())
+        if not self._owns_http and self.caller:
+            self._http.headers["X-Caller"] = self.caller
+        self._queue: "queue.Queue[Optional[Tuple[Dict, Future]]]" = queue.Queue()
+        self._slots = threading.Semaphore(self.max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="rules-client")
+        self._batcher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "RulesClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Send queued evaluations, then close the connections"""
+        if self._batcher is not None:
+            self._queue.put(None)
+            self._batcher.join()
+            self._batcher = None
+        self._executor.shutdown(wait=True)
+        if self._owns_http:
+            self._http.close()
+
+    def evaluate(self, event: Dict, context: Optional[Dict] = None, event_id: Optional[str] = None, **options) -> Dict:
+        """POST /evaluate; options are the other request fields (chain, budget_ms, ...)"""
+        body = evaluate_body(event, context, event_id, **options)
+        if not self.batching or not self.batch_supported:
+            return self._post("/evaluate", body)
+        future: Future = Future()
+        self._start_batcher()
+        self._queue.put((body, future))
+        return future.result()
+
+    def evaluate_many(self, events: Iterable[EventItem], context: Optional[Dict] = None, **options) -> Iterator[Dict]:
+        """
+        Results in event order. Events go out `batch_size` at a time with up to
+        `max_in_flight` batches outstanding. A failed event raises RulesEngineError when its
+        result is reached.
+        """
+        outstanding = deque()
+        for chunk in _chunks(_request_bodies(events, context, options), self.batch_size):
+            pending = [(body, Future()) for body in chunk]
+            self._executor.submit(self._send, pending)
+            outstanding.append(pending)
+            if len(outstanding) >= self.max_in_flight:
+                yield from (future.result() for _, future in outstanding.popleft())
+        while outstanding:
+            yield from (future.result() for _, future in outstanding.popleft())
+
+    def simulate(self, rule_id: str, event: Dict, context: Optional[Dict] = None) -> Dict:
+        """POST /rules/{rule_id}/simulate"""
+        return self._post(f"/rules/{rule_id}/simulate", {"event": event, "context": context or {}})
+
+    def _post(self, path: str, body: Dict) -> Dict:
+        content = dumps(body)
+        for attempt in itertools.count():
+            try:
+                response = self._http.post(path, content=content, headers=JSON_HEADERS)
+            except httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+            if not self._retryable(attempt, response):
+                return _result(response)
+            time.sleep(self._delay(attempt, response))
+
+    def _start_batcher(self):
+        if self._batcher is None:
+            with self._lock:
+                if self._batcher is None:
+                    self._batcher = threading.Thread(target=self._batch_loop, name="rules-client-batcher", daemon=True)
+                    self._batcher.start()
+
+    def _batch_loop(self):
+        """Take everything queued (up to batch_size) whenever a send slot is free"""
+        while True:
+            self._slots.acquire()
+            first = self._queue.get()
+            if first is None:
+                return
+            pending = [first]
+            deadline = time.monotonic() + self.batch_wait
+            while len(pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                pending.append(item)
+            self._executor.submit(self._send_and_release, pending)
+
+    def _send_and_release(self, pending: List[Tuple[Dict, Future]]):
+        try:
+            self._send(pending)
+        finally:
+            self._slots.release()
+
+    def _send(self, pending: List[Tuple[Dict, Future]]):
+        """Evaluate and resolve every future, as a batch when there is more than one"""
+        try:
+            if len(pending) > 1 and self.batch_supported:
+                self._post_batch(pending)
+            for body, future in pending:
+                if not future.done():
+                    future.set_result(self._post("/evaluate", body))
+        except BaseException as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _post_batch(self, pending: List[Tuple[Dict, Future]]):
+        """POST /evaluate/batch, resending only the events still unresolved on a retry"""
+        for attempt in itertools.count():
+            retry_response = None
+            try:
+                content = b"\n".join(dumps(body) for body, _ in pending)
+                with self._http.stream("POST", "/evaluate/batch", content=content, headers=NDJSON_HEADERS) as response:
+                    if response.status_code in (404, 405):
+                        # Older server: the caller sends each event to /evaluate
+                        self.batch_supported = False
+                        return
+                    if response.status_code == 200:
+                        for line in response.iter_lines():
+                            _settle_line(pending, line)
+                        pending = [item for item in pending if not item[1].done()]
+                        if not pending:
+                            return
+                    else:
+                        response.read()
+                        if not self._retryable(attempt, response):
+                            _result(response)
+                        retry_response = response
+            except httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+            if attempt >= self.retries:
+                raise RulesEngineError(None, "Batch response ended before every result was received")
+            time.sleep(self._delay(attempt, retry_response))
+
+class AsyncRulesClient(_ClientBase):
+    """asyncio client; share one instance per event loop"""
+
+    def __init__(self, base_url: str = "http://localhost:8000", transport: Optional[httpx.AsyncBaseTransport] = None,
+                 http_client: Optional[httpx.AsyncClient] = None, **settings):
+        super().__init__(base_url, **settings)
+        self._owns_http = http_client is None
+        self._http = http_client or httpx.AsyncClient(transport=transport, **self._client_options())
+        if not self._owns_http and self.caller:
+            self._http.headers["X-Caller"] = self.caller
+        # Created in the running loop on first use
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._sends = set()
+
+    async def __aenter__(self) -> "AsyncRulesClient":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Finish batches being sent, fail calls still queued, then close the connections"""
+        if self._batcher is not None:
+            self._batcher.cancel()
+            self._batcher = None
+            while not self._queue.empty():
+                _, future = self._queue.get_nowait()
+                future.set_exception(RulesEngineError(None, "Client closed"))
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+        if self._owns_http:
+            await self._http.aclose()
+
+    async def evaluate(self, event: Dict, context: Optional[Dict] = None, event_id: Optional[str] = None, **options) -> Dict:
+        """POST /evaluate; options are the other request fields (chain, budget_ms, ...)"""
+        body = evaluate_body(event, context, event_id, **options)
+        if not self.batching or not self.batch_supported:
+            return await self._post("/evaluate", body)
+        if self._batcher is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._batcher = asyncio.create_task(self._batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((body, future))
+        return await future
+
+    async def evaluate_many(self, events: Iterable[EventItem], context: Optional[Dict] = None, **options) -> AsyncIterator[Dict]:
+        """Results in event order, with up to `max_in_flight` batches outstanding (see RulesClient)"""
+        loop = asyncio.get_running_loop()
+        outstanding = deque()
+        try:
+            for chunk in _chunks(_request_bodies(events, context, options), self.batch_size):
+                pending = [(body, loop.create_future()) for body in chunk]
+                outstanding.append((pending, asyncio.create_task(self._send(pending))))
+                if len(outstanding) >= self.max_in_flight:
+                    for _, future in outstanding.popleft()[0]:
+                        yield await future
+            while outstanding:
+                for _, future in outstanding.popleft()[0]:
+                    yield await future
+        finally:
+            for _, task in outstanding:
+                task.cancel()
+
+    async def simulate(self, rule_id: str, event: Dict, context: Optional[Dict] = None) -> Dict:
+        """POST /rules/{rule_id}/simulate"""
+        return await self._post(f"/rules/{rule_id}/simulate", {"event": event, "context": context or {}})
+
+    async def _post(self, path: str, body: Dict) -> Dict:
+        content = dumps(body)
+        for attempt in itertools.count():
+            try:
+                response = await self._http.post(path, content=content, headers=JSON_HEADERS)
+            except httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                continue
+            if not self._retryable(attempt, response):
+                return _result(response)
+            await asyncio.sleep(self._delay(attempt, response))
+
+    async def _batch_loop(self):
+        """Take everything queued (up to batch_size) whenever a send slot is free"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            pending = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(pending) < self.batch_size:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        pending.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    pending.append(self._queue.get_nowait())
+            task = asyncio.create_task(self._send_and_release(pending))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send_and_release(self, pending: List[Tuple[Dict, asyncio.Future]]):
+        try:
+            await self._send(pending)
+        finally:
+            self._slots.release()
+
+    async def _send(self, pending: List[Tuple[Dict, asyncio.Future]]):
+        try:
+            if len(pending) > 1 and self.batch_supported:
+                await self._post_batch(pending)
+            for body, future in pending:
+                if not future.done():
+                    future.set_result(await self._post("/evaluate", body))
+        except BaseException as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+    async def _post_batch(self, pending: List[Tuple[Dict, asyncio.Future]]):
+        for attempt in itertools.count():
+            retry_response = None
+            try:
+                content = b"\n".join(dumps(body) for body, _ in pending)
+                async with self._http.stream("POST", "/evaluate/batch", content=content, headers=NDJSON_HEADERS) as response:
+                    if response.status_code in (404, 405):
+                        self.batch_supported = False
+                        return
+                    if response.status_code == 200:
+                        async for line in response.aiter_lines():
+                            _settle_line(pending, line)
+                        pending = [item for item in pending if not item[1].done()]
+                        if not pending:
+                            return
+                    else:
+                        await response.aread()
+                        if not self._retryable(attempt, response):
+                            _result(response)
+                        retry_response = response
+            except httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+            if attempt >= self.retries:
+                raise RulesEngineError(None, "Batch response ended before every result was received")
+            await asyncio.sleep(self._delay(attempt, retry_response))
+
+# ========== BENCHMARK ==========
+
+def _bench_event(i: int) -> Dict:
+    return {"type": "bench", "amount": i % 1000, "merchant_id": f"m{i % 50}"}
+
+def bench_threads(client: RulesClient, requests: int, concurrency: int) -> float:
+    """Evaluations per second from `concurrency` threads calling evaluate()"""
+    counter = itertools.count()
+
+    def worker():
+        while next(counter) < requests:
+            client.evaluate(_bench_event(random.randrange(1 << 30)))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return requests / (time.perf_counter() - started)
+
+async def bench_asyncio(client: AsyncRulesClient, requests: int, concurrency: int) -> float:
+    """Evaluations per second with `concurrency` evaluate() calls in flight"""
+    counter = itertools.count()
+
+    async def worker():
+        while next(counter) < requests:
+            await client.evaluate(_bench_event(random.randrange(1 << 30)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests / (time.perf_counter() - started)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rules engine client")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench", help="Measure evaluation throughput against a running server")
+    bench.add_argument("--url", default="http://localhost:8000")
+    bench.add_argument("--requests", type=int, default=5000)
+    bench.add_argument("--concurrency", type=int, default=64)
+    bench.add_argument("--no-batching", action="store_true", help="Send every call to /evaluate")
+    bench.add_argument("--asyncio", action="store_true", help="Use AsyncRulesClient instead of threads")
+    args = parser.parse_args()
+
+    settings = {"batching": not args.no_batching, "max_connections": args.concurrency, "timeout": 30.0}
+    if args.asyncio:
+        async def run() -> float:
+            async with AsyncRulesClient(args.url, **settings) as client:
+                return await bench_asyncio(client, args.requests, args.concurrency)
+        rate = asyncio.run(run())
+    else:
+        with RulesClient(args.url, **settings) as client:
+            rate = bench_threads(client, args.requests, args.concurrency)
+    mode = "unbatched" if args.no_batching else "batched"
+    print(f"{args.requests} evaluations, concurrency {args.concurrency}, {mode}: {rate:.0f}/s")
@@ -0,0 +1,440 @@
+"""
+In-process cache of the active ruleset
+
+The active rules are loaded once, together with the value sets they reference,
+and reused across evaluations until the rules or value sets change.
+"""
+import os
+import threading
+import time
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models import Rule, RuleParameter, RuleVersion, ValueSet
+from evaluator import ClauseMemo, ClauseTable, eval_condition, get_nested_value
+from decision_tables import DecisionTable
+from templates import ParameterRow, ParameterTable, resolve_params
+from value_sets import collect_value_set_refs, get_value_set_registry
+from geo import GeofenceIndex, collect_geofences
+from windows import WindowSpec, collect_window_specs, get_window_store
+
+logger = logging.getLogger(__name__)
+
+# Default per-request evaluation time budget in ms (0 = no budget)
+BUDGET_MS = float(os.getenv("EVALUATION_BUDGET_MS", "0"))
+# Rules at or above this priority are evaluated even when the budget has run out
+BUDGET_PROTECTED_PRIORITY = int(os.getenv("EVALUATION_BUDGET_PROTECTED_PRIORITY", "100"))
+
+class EvaluationBudget:
+    """
+    Time allowed for one evaluation, counted from `started` (time.time(), default now) so that
+    context enrichment spends it too. Once it runs out, the remaining rules below the protected
+    priority are skipped and listed in `skipped`.
+    """
+    __slots__ = ("ms", "deadline", "protected_priority", "skipped")
+
+    def __init__(self, ms: float, started: Optional[float] = None, protected_priority: int = BUDGET_PROTECTED_PRIORITY):
+        self.ms = ms
+        self.deadline = (started or time.time()) + ms / 1000
+        self.protected_priority = protected_priority
+        self.skipped: List[str] = []
+
+    @classmethod
+    def for_request(cls, ms: Optional[float], started: Optional[float] = None) -> Optional["EvaluationBudget"]:
+        """A budget of `ms`, or EVALUATION_BUDGET_MS when it is None; None when the budget is 0"""
+        ms = BUDGET_MS if ms is None else ms
+        return cls(ms, started) if ms and ms > 0 else None
+
+    def skips(self, rule: "CompiledRule") -> bool:
+        """Whether to skip `rule`: the budget has run out and the rule is not protected"""
+        return rule.priority < self.protected_priority and time.time() >= self.deadline
+
+    def explanation(self) -> Dict:
+        return {
+            "message": f"Evaluation budget of {self.ms:g} ms exhausted; {len(self.skipped)} lower-priority rule(s) skipped",
+            "skipped_rules": self.skipped
+        }
+
+class RuleResult:
+    """Outcome of evaluating a single rule"""
+    __slots__ = ("matched", "explanation", "actions", "details")
+
+    def __init__(self, matched: bool, explanation: List, actions: List, details: Optional[Dict] = None):
+        self.matched = matched
+        self.explanation = explanation
+        self.actions = actions
+        self.details = details or {}
+
+class CompiledRule:
+    """Detached snapshot of a rule row used for evaluation"""
+    __slots__ = ("id", "name", "priority", "version", "conditions", "actions", "stop_on_match", "tags",
+                 "parameters", "decision_table")
+
+    def __init__(self, id: str, name: str, priority: int, version: int, conditions: Dict,
+                 actions: List, stop_on_match: bool = False, tags: Optional[List] = None,
+                 parameters: Optional[ParameterTable] = None, decision_table: Optional[DecisionTable] = None):
+        self.id = id
+        self.name = name
+        self.priority = priority
+        self.version = version
+        self.conditions = conditions
+        self.actions = actions
+        self.stop_on_match = stop_on_match
+        self.tags = tags or []
+        self.parameters = parameters
+        self.decision_table = decision_table
+
+    @classmethod
+    def from_model(cls, rule: Rule, parameter_rows: Optional[List[RuleParameter]] = None) -> "CompiledRule":
+        parameters = None
+        if rule.parameter_keys:
+            parameters = ParameterTable(
+                rule.parameter_keys,
+                [ParameterRow(p.id, p.key, p.params) for p in parameter_rows or []]
+            )
+        return cls(
+            id=rule.id,
+            name=rule.name,
+            priority=rule.priority,
+            version=rule.version,
+            conditions=rule.conditions,
+            actions=rule.actions,
+            stop_on_match=rule.stop_on_match,
+            tags=rule.tags,
+            parameters=parameters,
+            decision_table=DecisionTable(rule.decision_table) if rule.decision_table else None
+        )
+
+    def evaluate(self, event: Dict, context: Dict, memo: Optional[ClauseMemo] = None) -> RuleResult:
+        """Evaluate this rule, resolving template parameters first"""
+        if self.decision_table is not None:
+            return self._evaluate_decision_table(event, context, memo)
+        if self.parameters is None:
+            result, explanation = eval_condition(self.conditions, event, context, [], memo=memo)
+            return RuleResult(result, explanation, self.actions if result else [])
+
+        # Templates: one hash lookup picks the effective parameter row
+        key, row = self.parameters.lookup(event, context)
+        key_explanation = dict(zip(self.parameters.keys, key))
+        if row is None:
+            explanation = [{"parameters": {"key": key_explanation, "row_id": None}, "error": "No parameter row for key"}]
+            return RuleResult(False, explanation, [])
+
+        details = {"parameter_row": {"row_id": row.id, "key": key_explanation, "default": row.key is None, "params": row.params}}
+        result, explanation = eval_condition(self.conditions, event, context, [], row.params, memo)
+        actions = resolve_params(self.actions, row.params) if result else []
+        return RuleResult(result, explanation, actions, details)
+
+    def _evaluate_decision_table(self, event: Dict, context: Dict, memo: Optional[ClauseMemo] = None) -> RuleResult:
+        """Conditions gate the table; matched rows add their actions to the rule's own"""
+        result, explanation = eval_condition(self.conditions, event, context, [], memo=memo)
+        if not result:
+            return RuleResult(False, explanation, [])
+
+        row_actions, table_explanation = self.decision_table.evaluate(event, context)
+        details = {"decision_table": table_explanation}
+        if not table_explanation["matched_rows"]:
+            return RuleResult(False, explanation, [], details)
+        return RuleResult(True, explanation, list(self.actions) + row_actions, details)
+
+class ShadowRule:
+    """A shadow version of a live rule: the live rule with the shadow version's conditions and actions"""
+    __slots__ = ("rule", "version", "sample_rate")
+
+    def __init__(self, rule: CompiledRule, version: int, sample_rate: float):
+        self.rule = rule
+        self.version = version
+        self.sample_rate = sample_rate
+
+def rule_spec(rule: Dict, parameter_rows: Optional[List] = None) -> Dict:
+    """Plain, picklable description of a rule (for worker processes and historical snapshots)"""
+    return {
+        "id": rule["id"],
+        "name": rule["name"],
+        "priority": rule.get("priority", 100),
+        "version": rule.get("version", 1),
+        "conditions": rule["conditions"],
+        "actions": rule["actions"],
+        "stop_on_match": rule.get("stop_on_match", False),
+        "tags": rule.get("tags") or [],
+        "parameter_keys": rule.get("parameter_keys"),
+        "parameter_rows": [(p.id, p.key, p.params) for p in parameter_rows or []],
+        "decision_table": rule.get("decision_table")
+    }
+
+def compile_spec(spec: Dict) -> CompiledRule:
+    """Compile a rule spec built by rule_spec()"""
+    parameters = None
+    if spec["parameter_keys"]:
+        parameters = ParameterTable(spec["parameter_keys"], [ParameterRow(*row) for row in spec["parameter_rows"]])
+    return CompiledRule(
+        id=spec["id"],
+        name=spec["name"],
+        priority=spec["priority"],
+        version=spec["version"],
+        conditions=spec["conditions"],
+        actions=spec["actions"],
+        stop_on_match=spec["stop_on_match"],
+        tags=spec["tags"],
+        parameters=parameters,
+        decision_table=DecisionTable(spec["decision_table"]) if spec["decision_table"] else None
+    )
+
+class CompiledRuleset:
+    """Active rules sorted by priority (highest first)"""
+
+    def __init__(self, rules: List[CompiledRule], fingerprint: Any = None, shadows: Optional[List[ShadowRule]] = None):
+        self.rules = rules
+        self.fingerprint = fingerprint
+        self.shadows = shadows or []
+        self.positions = {rule.id: i for i, rule in enumerate(rules)}
+        specs: Dict[str, WindowSpec] = {}
+        paths = set()
+        # Shadow versions need their fields decoded and their windows fed like live rules
+        for rule in rules + [s.rule for s in self.shadows]:
+            collect_window_specs(rule.conditions, specs)
+            collect_field_paths(rule.conditions, paths)
+            if rule.parameters is not None:
+                paths.update(rule.parameters.keys)
+            if rule.decision_table is not None:
+                paths.update(rule.decision_table.fields)
+        self.window_specs = list(specs.values())
+        # Every field any rule can read, used to decode only what is needed
+        self.referenced_paths = paths
+        # Clauses shared by several rules are evaluated once per event
+        self.clauses = ClauseTable([rule.conditions for rule in rules])
+        # Every geofence in the ruleset, probed once per event point
+        fences = []
+        for rule in rules:
+            collect_geofences(rule.conditions, fences)
+        self.geofences = GeofenceIndex(fences) if fences else None
+        # Field path -> rules reading it, built on the first chained evaluation (chaining.py)
+        self.dependency_index = None
+
+    def new_memo(self) -> Optional[ClauseMemo]:
+        """Per-event memo of shared clause results and geofence probes (None if nothing is shared)"""
+        if self.clauses.size or self.geofences is not None:
+            return ClauseMemo(self.clauses, self.geofences)
+        return None
+
+    def observe_windows(self, event: Dict, context: Dict):
+        """Record the event in every sliding window the ruleset uses"""
+        merged = {"event": event, "context": context}
+        observations = []
+        for spec in self.window_specs:
+            key = get_nested_value(merged, spec.key_field)
+            if key is None:
+                continue
+            value = None
+            if spec.value_field:
+                value = get_nested_value(merged, spec.value_field)
+                if value is None:
+                    continue
+            observations.append((spec, key, value))
+        get_window_store().observe(observations)
+
+    def evaluate(self, event: Dict, context: Dict, record_windows: bool = True, stats=None,
+                 budget: Optional[EvaluationBudget] = None) -> Tuple[List[str], List[Dict], List[Dict]]:
+        """
+        Evaluate all rules against an event.
+        With record_windows the event is first counted in the sliding windows.
+        With a `stats` recorder (rule_stats.RuleStatsRecorder) each rule's outcome and latency is recorded.
+        With a `budget`, rules left when it runs out are skipped (see EvaluationBudget).
+        Returns (matched_rules, actions, explanation)
+        """
+        if record_windows and self.window_specs:
+            self.observe_windows(event, context)
+
+        matched_rules = []
+        actions = []
+        all_explanations = []
+        samples = [] if stats is not None else None
+        memo = self.new_memo()
+
+        for position, rule in enumerate(self.rules):
+            if budget is not None and budget.skips(rule):
+                # Rules are sorted by priority, so everything left is lower priority too
+                budget.skipped.extend(r.id for r in self.rules[position:])
+                all_explanations.append(budget.explanation())
+                break
+
+            if samples is not None:
+                started = time.perf_counter()
+                result = rule.evaluate(event, context, memo)
+                samples.append((rule.id, result.matched, len(result.actions), time.perf_counter() - started))
+            else:
+                result = rule.evaluate(event, context, memo)
+
+            if result.matched:
+                matched_rules.append(rule.id)
+                actions.extend(result.actions)
+                all_explanations.append({
+                    "rule_id": rule.id,
+                    "rule_name": rule.name,
+                    "matched": True,
+                    "explanation": result.explanation,
+                    **result.details
+                })
+
+                # Stop if rule says to stop on match
+                if rule.stop_on_match:
+                    all_explanations.append({"message": f"Stopped at rule {rule.id} (stop_on_match=True)"})
+                    break
+            elif "error" in result.details.get("decision_table", {}):
+                # A violated hit policy selects no row; say so rather than report a plain miss
+                all_explanations.append({
+                    "rule_id": rule.id,
+                    "rule_name": rule.name,
+                    "matched": False,
+                    "explanation": result.explanation,
+                    **result.details
+                })
+
+        if samples:
+            stats.record(samples)
+
+        return matched_rules, actions, all_explanations
+
+def collect_field_paths(condition: Any, paths: Optional[set] = None) -> set:
+    """Collect the event/context paths a condition AST reads"""
+    if paths is None:
+        paths = set()
+    if isinstance(condition, dict):
+        field = condition.get("field")
+        if isinstance(field, str):
+            paths.add(field)
+        for arg in condition.get("args", []) or []:
+            if isinstance(arg, str) and arg.startswith(("event.", "context.")):
+                paths.add(arg)
+        value = condition.get("value")
+        if condition.get("op") == "distance_gt" and isinstance(value, dict) and isinstance(value.get("from"), str):
+            paths.add(value["from"])
+        for clause in condition.get("clauses", []) or []:
+            collect_field_paths(clause, paths)
+    return paths
+
+def ruleset_fingerprint(db: Session) -> Tuple:
+    """Cheap aggregate that changes whenever a rule or value set is written"""
+    rule_count, rules_updated = db.query(func.count(Rule.id), func.max(Rule.updated_at)).one()
+    set_count, sets_created = db.query(func.count(ValueSet.id), func.max(ValueSet.created_at)).one()
+    return (rule_count, rules_updated, set_count, sets_created)
+
+def load_value_sets(db: Session, conditions_list: List[Dict]) -> set:
+    """
+    Make sure every value set referenced by the conditions is loaded.
+    Returns the set of (name, version) keys in use.
+    """
+    registry = get_value_set_registry()
+    keys = set()
+    latest = {}
+    for conditions in conditions_list:
+        for name, version in collect_value_set_refs(conditions):
+            if version is None:
+                if name not in latest:
+                    latest[name] = db.query(func.max(ValueSet.version)).filter(ValueSet.name == name).scalar()
+                version = latest[name]
+                if version is None:
+                    logger.warning(f"Rule references unknown value set {name}")
+                    continue
+            if not registry.contains(name, version):
+                row = db.query(ValueSet).filter(ValueSet.name == name, ValueSet.version == version).first()
+                if row is None:
+                    logger.warning(f"Rule references unknown value set {name} v{version}")
+                    continue
+                registry.put(name, version, row.values)
+            keys.add((name, version))
+
+    # Point unpinned references at the newest version
+    for name, version in latest.items():
+        if version is not None:
+            registry.set_latest(name, version)
+    return keys
+
+def load_parameter_rows(db: Session, rule_ids: List[str]) -> Dict[str, List[RuleParameter]]:
+    """Load parameter tables for template rules, grouped by rule id"""
+    grouped: Dict[str, List[RuleParameter]] = {rid: [] for rid in rule_ids}
+    if rule_ids:
+        for p in db.query(RuleParameter).filter(RuleParameter.rule_id.in_(rule_ids)).all():
+            grouped[p.rule_id].append(p)
+    return grouped
+
+def compile_rule(db: Session, rule: Rule) -> CompiledRule:
+    """Compile a single rule row, loading anything it references"""
+    rows = load_parameter_rows(db, [rule.id]).get(rule.id) if rule.parameter_keys else None
+    load_value_sets(db, [rule.conditions])
+    return CompiledRule.from_model(rule, rows)
+
+def load_shadows(db: Session, rules: List[CompiledRule]) -> List[ShadowRule]:
+    """Shadow versions of the given live rules"""
+    live = {rule.id: rule for rule in rules}
+    if not live:
+        return []
+    versions = db.query(RuleVersion).filter(RuleVersion.shadow == True, RuleVersion.rule_id.in_(list(live))).all()
+    shadows = []
+    for v in versions:
+        rule = live[v.rule_id]
+        candidate = CompiledRule(
+            id=rule.id,
+            name=rule.name,
+            priority=rule.priority,
+            version=v.version,
+            conditions=v.conditions,
+            actions=v.actions,
+            stop_on_match=rule.stop_on_match,
+            tags=rule.tags,
+            parameters=rule.parameters,
+            decision_table=rule.decision_table
+        )
+        shadows.append(ShadowRule(candidate, v.version, v.sample_rate or 0.0))
+    return shadows
+
+def build_ruleset(db: Session, fingerprint: Any = None) -> CompiledRuleset:
+    """Load active rules sorted by priority, their shadow versions and the value sets they need"""
+    # Ties run newest first, in the order of GET /rules/export, so an exported ruleset
+    # evaluates the same way in an embedded RulesEngine
+    rows = db.query(Rule).filter(Rule.active == True).order_by(
+        Rule.priority.desc(), Rule.created_at.desc(), Rule.id.desc()
+    ).all()
+    parameter_rows = load_parameter_rows(db, [r.id for r in rows if r.parameter_keys])
+    rules = [CompiledRule.from_model(r, parameter_rows.get(r.id)) for r in rows]
+    shadows = load_shadows(db, rules)
+    keys = load_value_sets(db, [r.conditions for r in rules] + [s.rule.conditions for s in shadows])
+    get_value_set_registry().retain(keys)
+    return CompiledRuleset(rules, fingerprint, shadows)
+
+class RulesetCache:
+    """Rebuilds the compiled ruleset only when the database fingerprint changes"""
+
+    def __init__(self):
+        self._ruleset: Optional[CompiledRuleset] = None
+        self._lock = threading.Lock()
+
+    def get(self, db: Session) -> CompiledRuleset:
+        fingerprint = ruleset_fingerprint(db)
+        ruleset = self._ruleset
+        if ruleset is not None and ruleset.fingerprint == fingerprint:
+            return ruleset
+        with self._lock:
+            ruleset = self._ruleset
+            if ruleset is None or ruleset.fingerprint != fingerprint:
+                ruleset = build_ruleset(db, fingerprint)
+                self._ruleset = ruleset
+                logger.info(f"Loaded ruleset with {len(ruleset.rules)} active rules ({ruleset.clauses.size} shared clauses)")
+            return ruleset
+
+    def invalidate(self):
+        self._ruleset = None
+
+# Global cache instance
+_cache = RulesetCache()
+
+def get_ruleset(db: Session) -> CompiledRuleset:
+    """Get the active ruleset, reloading it if rules changed"""
+    return _cache.get(db)
+
+def invalidate_ruleset():
+    """Force a reload on the next evaluation"""
+    _cache.invalidate()
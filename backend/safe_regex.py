@@ -0,0 +1,250 @@
+"""
+Regex safety for `regex` clauses
+
+Patterns are checked when rules are saved and compiled once per process. When google-re2 is
+installed, patterns are compiled with it: RE2 matches in linear time, so no pattern can
+backtrack catastrophically. Otherwise Python's `re` is used and patterns with constructs
+that can backtrack exponentially are rejected:
+
+- a variable-length quantifier inside a group repeated more than once, e.g. `(a+)+`,
+  `(\\w*x?)*`, `(.*a){12}`
+- alternatives inside such a group that can match the same text, e.g. `(a|a)+`, `(a|aa)*`
+- unbounded quantifiers in sequence that can match the same text, with nothing between
+  them that the first could not also match, e.g. `a*a*b`, `.*.*=`, `.*=.*;`, `\w+\s*\w+!`;
+  these backtrack polynomially (cubic for three such quantifiers)
+- backreferences and conditional groups
+
+The check is conservative, so some harmless patterns (such as `(\\d{1,3}\\.){3}`) are only
+accepted with RE2. With REGEX_REQUIRE_RE2=true, regex clauses are rejected altogether
+unless google-re2 is installed.
+
+Even a pattern that passes these checks can take time quadratic in the input length (an
+unanchored `\d+-\d+` is retried from every position), so inputs longer than REGEX_MAX_INPUT
+characters (default 1024) do not match; a clause can lower or raise its own limit with
+"max_length". A running `re` match cannot be interrupted by the request budget, so set
+REGEX_REQUIRE_RE2=true where tail latency must be guaranteed.
+"""
+import os
+import re
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+# google-re2 is optional: it guarantees linear-time matching
+try:
+    import re2
+    RE2_AVAILABLE = True
+except ImportError:
+    RE2_AVAILABLE = False
+
+MAX_PATTERN_LENGTH = int(os.getenv("REGEX_MAX_PATTERN", "1000"))
+MAX_INPUT_LENGTH = int(os.getenv("REGEX_MAX_INPUT", "1024"))
+REQUIRE_RE2 = os.getenv("REGEX_REQUIRE_RE2", "false").lower() in ("1", "true", "yes")
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+_POSSESSIVE = getattr(sre_constants, "POSSESSIVE_REPEAT", None)
+_ZERO_WIDTH = {sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT}
+
+# First characters are compared over this range; classes that can also match characters
+# beyond it (negations, \w, .) are assumed to overlap each other there
+_DOMAIN = range(0x300)
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: lambda ch: ch.isdecimal(),
+    sre_constants.CATEGORY_NOT_DIGIT: lambda ch: not ch.isdecimal(),
+    sre_constants.CATEGORY_SPACE: lambda ch: ch.isspace(),
+    sre_constants.CATEGORY_NOT_SPACE: lambda ch: not ch.isspace(),
+    sre_constants.CATEGORY_WORD: lambda ch: ch.isalnum() or ch == "_",
+    sre_constants.CATEGORY_NOT_WORD: lambda ch: not (ch.isalnum() or ch == "_"),
+}
+_WIDE_CATEGORIES = {sre_constants.CATEGORY_NOT_DIGIT, sre_constants.CATEGORY_NOT_SPACE,
+                    sre_constants.CATEGORY_WORD, sre_constants.CATEGORY_NOT_WORD}
+
+class _First:
+    """Characters a subpattern can start with, and whether it can match the empty string"""
+    __slots__ = ("chars", "beyond", "nullable")
+
+    def __init__(self, chars: frozenset = frozenset(), beyond: bool = False, nullable: bool = False):
+        self.chars = chars
+        self.beyond = beyond
+        self.nullable = nullable
+
+    def union(self, other: "_First", nullable: bool) -> "_First":
+        return _First(self.chars | other.chars, self.beyond or other.beyond, nullable)
+
+    def overlaps(self, other: "_First") -> bool:
+        return bool(self.chars & other.chars) or (self.beyond and other.beyond) or (self.nullable and other.nullable)
+
+_ANY = _First(frozenset(_DOMAIN), True)
+_EMPTY = _First(nullable=True)
+
+def _class_first(items: List) -> _First:
+    negate = False
+    matches = []
+    beyond = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            matches.append(lambda ch, c=chr(av): ch == c)
+        elif op == sre_constants.RANGE:
+            matches.append(lambda ch, lo=av[0], hi=av[1]: lo <= ord(ch) <= hi)
+        elif op == sre_constants.CATEGORY and av in _CATEGORIES:
+            matches.append(_CATEGORIES[av])
+            beyond = beyond or av in _WIDE_CATEGORIES
+        else:
+            return _ANY
+    chars = frozenset(c for c in _DOMAIN if any(m(chr(c)) for m in matches) != negate)
+    return _First(chars, beyond or negate)
+
+def _first(items: Any, follow: _First = _EMPTY) -> _First:
+    """First characters of a sequence, followed by whatever `follow` describes"""
+    result = _First()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            item = _First(frozenset([av]))
+        elif op == sre_constants.IN:
+            item = _class_first(av)
+        elif op == sre_constants.SUBPATTERN:
+            item = _first(av[3])
+        elif op == sre_constants.BRANCH:
+            item = _First(nullable=False)
+            for branch in av[1]:
+                branch_first = _first(branch)
+                item = item.union(branch_first, item.nullable or branch_first.nullable)
+        elif op in _REPEATS or op == _POSSESSIVE:
+            body = _first(av[2])
+            item = _First(body.chars, body.beyond, av[0] == 0 or body.nullable)
+        elif op in _ZERO_WIDTH:
+            continue
+        else:
+            item = _ANY
+        result = result.union(item, item.nullable)
+        if not item.nullable:
+            return result
+    return result.union(follow, follow.nullable)
+
+def _fold(first: _First) -> _First:
+    chars = set(first.chars)
+    for c in first.chars:
+        chars.update(ord(x) for x in (chr(c).lower(), chr(c).upper()) if len(x) == 1)
+    return _First(frozenset(chars), first.beyond, first.nullable)
+
+def _variable(av: Tuple) -> bool:
+    low, high = av[0], av[1]
+    return high == sre_constants.MAXREPEAT or high != low
+
+def _inline(items: Any) -> List:
+    """A sequence with its plain groups replaced by their contents"""
+    out = []
+    for op, av in items:
+        if op == sre_constants.SUBPATTERN:
+            out.extend(_inline(av[3]))
+        else:
+            out.append((op, av))
+    return out
+
+def _unbounded_body(op: Any, av: Any) -> Optional[_First]:
+    """First characters of the body of an unbounded backtracking repeat"""
+    if op in _REPEATS and av[1] == sre_constants.MAXREPEAT:
+        return _first(av[2])
+    return None
+
+def _chars_overlap(a: _First, b: _First) -> bool:
+    return bool(a.chars & b.chars) or (a.beyond and b.beyond)
+
+def _sequence_error(items: Any, ignore_case: bool) -> Optional[str]:
+    """
+    Two unbounded repeats in a sequence that can match the same text, where the first can
+    also match everything between them: each way of splitting the text between them is
+    tried, so matching time grows polynomially with the input.
+    """
+    items = _inline(items)
+    fold = _fold if ignore_case else (lambda f: f)
+    for i, (op, av) in enumerate(items):
+        body = _unbounded_body(op, av)
+        if body is None:
+            continue
+        body = fold(body)
+        for next_op, next_av in items[i + 1:]:
+            next_body = _unbounded_body(next_op, next_av)
+            if next_body is not None and _chars_overlap(body, fold(next_body)):
+                return "quantifiers in sequence can match the same text"
+            # Optional and zero-width items can be skipped; others must be matchable by the first repeat
+            first = fold(_first([(next_op, next_av)]))
+            if not first.nullable and not _chars_overlap(body, first):
+                break
+    return None
+
+def _check(items: Any, in_repeat: bool, follow: _First, ignore_case: bool) -> Optional[str]:
+    """
+    `in_repeat`: inside a repeat that can match more than once, where any ambiguity
+    multiplies. `follow` describes what can come after `items` there.
+    """
+    items = list(items)
+    error = _sequence_error(items, ignore_case)
+    if error:
+        return error
+    for i, (op, av) in enumerate(items):
+        rest = _first(items[i + 1:], follow) if in_repeat else _EMPTY
+        if op in _REPEATS:
+            if in_repeat and _variable(av):
+                return "nested quantifiers can backtrack catastrophically"
+            repeats = av[1] == sre_constants.MAXREPEAT or av[1] > 1
+            body_follow = _first(av[2]).union(rest, True) if repeats else rest
+            error = _check(av[2], in_repeat or repeats, body_follow, ignore_case)
+        elif op == _POSSESSIVE:
+            # Possessive repeats never backtrack into their body
+            error = _check(av[2], False, _EMPTY, ignore_case)
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return "backreferences are not allowed"
+        elif op == sre_constants.SUBPATTERN:
+            error = _check(av[3], in_repeat, rest, ignore_case)
+        elif op == sre_constants.BRANCH:
+            if in_repeat:
+                firsts = [_first(branch, rest) for branch in av[1]]
+                if ignore_case:
+                    firsts = [_fold(f) for f in firsts]
+                if any(a.overlaps(b) for j, a in enumerate(firsts) for b in firsts[j + 1:]):
+                    return "alternatives inside a repeat can match the same text"
+            error = next((e for e in (_check(branch, in_repeat, rest, ignore_case) for branch in av[1]) if e), None)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            error = _check(av[1], in_repeat, _EMPTY, ignore_case)
+        else:
+            error = None
+        if error:
+            return error
+    return None
+
+def regex_error(pattern: Any) -> Optional[str]:
+    """Why a pattern cannot be used in a regex clause, or None"""
+    if not isinstance(pattern, str):
+        return "regex value must be a string"
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        return f"regex is longer than {MAX_PATTERN_LENGTH} characters"
+    if RE2_AVAILABLE:
+        try:
+            re2.compile(pattern)
+        except re2.error as e:
+            return f"invalid regex (RE2): {e}"
+        return None
+    if REQUIRE_RE2:
+        return "regex clauses need google-re2 (REGEX_REQUIRE_RE2 is set)"
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error as e:
+        return f"invalid regex: {e}"
+    error = _check(parsed, False, _EMPTY, bool(parsed.state.flags & re.IGNORECASE))
+    return f"unsafe regex: {error}" if error else None
+
+@lru_cache(maxsize=4096)
+def compile_regex(pattern: str):
+    """(compiled pattern, None) or (None, error) for a regex clause value, compiled once"""
+    error = regex_error(pattern)
+    if error:
+        return None, error
+    return (re2 if RE2_AVAILABLE else re).compile(pattern), None
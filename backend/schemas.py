@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+import os
+
+from pydantic import BaseModel, Field
 from typing import Any, Dict, List, Optional
 from datetime import datetime
 
@@ -15,6 +17,13 @@ class RuleCreate(BaseModel):
     stop_on_match: bool = False
     description: Optional[str] = None
     created_by: Optional[str] = "system"
+    parameter_keys: Optional[List[str]] = None
+    decision_table: Optional[Dict[str, Any]] = None
+
+class BulkRule(RuleCreate):
+    """One rule in a bulk import; exported rules can be imported as they are"""
+    id: Optional[str] = None  # Defaults to an id derived from the name
+    active: Optional[bool] = None  # New rules default to active; existing rules keep their state
 
 class RuleUpdate(BaseModel):
     name: Optional[str] = None
@@ -25,17 +34,24 @@ class RuleUpdate(BaseModel):
     active: Optional[bool] = None
     stop_on_match: Optional[bool] = None
     description: Optional[str] = None
+    parameter_keys: Optional[List[str]] = None
+    decision_table: Optional[Dict[str, Any]] = None
 
 class SimulateRequest(BaseModel):
     event: Dict[str, Any]
     context: Dict[str, Any] = {}
     event_id: Optional[str] = None
+    as_of: Optional[datetime] = None  # Simulate the rule as it was at this time
 
 class EvaluateRequest(BaseModel):
     event: Dict[str, Any]
     context: Dict[str, Any] = {}
     event_id: Optional[str] = None
-    async_mode: bool = False  # If True, send to Kafka instead of evaluating immediately
+    async_mode: bool = False  # If True, evaluate in the background and return a ticket
+    as_of: Optional[datetime] = None  # Replay against the ruleset as it was at this time (not audited)
+    chain: bool = False  # Forward chaining: actions may assert facts that trigger further rules
+    max_iterations: Optional[int] = None  # Re-evaluation cap in chaining mode (default CHAIN_MAX_ITERATIONS)
+    budget_ms: Optional[float] = None  # Evaluation time budget (default EVALUATION_BUDGET_MS, 0 = none)
 
 class EvaluationResponse(BaseModel):
     actions: List[Dict[str, Any]]
@@ -43,6 +59,9 @@ class EvaluationResponse(BaseModel):
     explanation: List[Dict[str, Any]]
     evaluation_time_ms: Optional[int] = None
     audit_log_id: Optional[str] = None
+    chain: Optional[Dict[str, Any]] = None  # Chaining mode only: re-evaluations, asserted facts, cycles
+    skipped_rules: Optional[List[str]] = None  # With a time budget: rules not evaluated because it ran out
+    ticket: Optional[str] = None  # async_mode only: fetch the result from /evaluate/results/{ticket}
 
 class RuleResponse(BaseModel):
     id: str
@@ -58,3 +77,43 @@ class RuleResponse(BaseModel):
     created_at: datetime
     updated_at: datetime
     description: Optional[str] = None
+    parameter_keys: Optional[List[str]] = None
+    decision_table: Optional[Dict[str, Any]] = None
+
+class ValueSetCreate(BaseModel):
+    values: List[Any]
+    description: Optional[str] = None
+    created_by: Optional[str] = "system"
+
+class ValueSetResponse(BaseModel):
+    name: str
+    version: int
+    size: int
+    description: Optional[str] = None
+    created_by: str
+    created_at: datetime
+
+class ParameterRowSchema(BaseModel):
+    key: Optional[List[Any]] = None  # None for the default row
+    params: Dict[str, Any]
+
+class ParameterTableUpdate(BaseModel):
+    rows: List[ParameterRowSchema]
+
+class BacktestRequest(BaseModel):
+    rules: List[RuleCreate]  # Candidate rules
+    rule_id: Optional[str] = None  # Replace this rule with the single candidate
+    replace_ruleset: bool = False  # Candidates are the whole ruleset
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    event_type: Optional[str] = None
+    limit: Optional[int] = None
+    sample_size: int = 5
+    # Processes spawned for the replay; at most one per CPU
+    workers: Optional[int] = Field(None, ge=1, le=os.cpu_count() or 1)
+
+class ShadowCreate(BaseModel):
+    conditions: Dict[str, Any]
+    actions: Optional[List[Dict[str, Any]]] = None  # Defaults to the live rule's actions
+    sample_rate: float = 0.1
+    created_by: Optional[str] = "system"
@@ -0,0 +1,72 @@
+"""
+Fast response serialization
+
+Endpoints that return trusted internal data build plain dicts and return them through
+FastJSONResponse, which skips FastAPI's second pydantic validation against
+`response_model` and encodes with orjson when it is installed. Large lists are streamed
+as a JSON array (or NDJSON) in chunks instead of being encoded in one piece.
+"""
+import json
+from datetime import date, datetime
+from typing import Any, Iterable, Iterator
+
+from fastapi.responses import Response, StreamingResponse
+
+# Try to import orjson, but make it optional
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(obj: Any) -> bytes:
+    """Encode to JSON bytes using the fastest available encoder"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    """JSON response that encodes already-trusted content without re-validation"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def iter_json_array(items: Iterable[Any], chunk_size: int = 500) -> Iterator[bytes]:
+    """Encode an iterable as a JSON array, yielding one chunk per `chunk_size` items"""
+    yield b"["
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(dumps(item))
+        if len(buffer) >= chunk_size:
+            yield (b"" if first else b",") + b",".join(buffer)
+            first = False
+            buffer = []
+    if buffer:
+        yield (b"" if first else b",") + b",".join(buffer)
+    yield b"]"
+
+def iter_ndjson(items: Iterable[Any], chunk_size: int = 500) -> Iterator[bytes]:
+    """Encode an iterable as newline-delimited JSON"""
+    buffer = []
+    for item in items:
+        buffer.append(dumps(item))
+        if len(buffer) >= chunk_size:
+            yield b"\n".join(buffer) + b"\n"
+            buffer = []
+    if buffer:
+        yield b"\n".join(buffer) + b"\n"
+
+def stream_json_array(items: Iterable[Any], headers: dict = None) -> StreamingResponse:
+    return StreamingResponse(iter_json_array(items), media_type="application/json", headers=headers)
+
+def stream_ndjson(items: Iterable[Any], headers: dict = None, chunk_size: int = 500) -> StreamingResponse:
+    return StreamingResponse(iter_ndjson(items, chunk_size), media_type="application/x-ndjson", headers=headers)
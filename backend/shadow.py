@@ -0,0 +1,179 @@
+"""
+Shadow evaluation of candidate rule versions
+
+A shadow version is a RuleVersion with `shadow=True`: the live rule with different conditions
+and actions. After each live evaluation, every shadow is sampled with its `sample_rate`;
+sampled shadows are evaluated on a single background thread and compared with whether the
+live rule matched. Shadow actions are never returned.
+
+The request path only draws the samples and enqueues the event. The background thread is
+held to SHADOW_CPU_BUDGET (a fraction of one core, default 0.05) with a token bucket refilled
+by wall-clock time and drained by the thread's measured CPU time. Samples taken while the
+budget is exhausted, or while the queue (SHADOW_QUEUE_SIZE) is full, are dropped and counted.
+
+Shadows are only sampled when the live rule was actually evaluated, i.e. not after an
+earlier stop_on_match rule matched.
+"""
+import os
+import queue
+import random
+import threading
+import time
+import logging
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import ShadowStat
+from rule_stats import CounterRecorder, StatsFlusher
+from ruleset import CompiledRuleset, ShadowRule
+
+logger = logging.getLogger(__name__)
+
+CPU_BUDGET = float(os.getenv("SHADOW_CPU_BUDGET", "0.05"))
+QUEUE_SIZE = int(os.getenv("SHADOW_QUEUE_SIZE", "1000"))
+# Seconds of CPU time the budget can accumulate while idle
+BURST_SECONDS = 1.0
+MAX_DISAGREEMENTS = 20
+
+COUNTERS = ("evaluated", "agreed", "shadow_only", "live_only", "errors", "dropped", "cpu_ms")
+
+class ShadowStatsRecorder(CounterRecorder):
+    """Per-(rule, shadow version) agreement counters, plus recent disagreements in memory"""
+
+    def __init__(self):
+        super().__init__(ShadowStat.__table__, ("rule_id", "version"), COUNTERS)
+        self.disagreements: Dict[Tuple[str, int], deque] = {}
+
+    def record(self, shadow: ShadowRule, live_matched: bool, shadow_matched: bool, cpu_seconds: float, event: Dict):
+        key = (shadow.rule.id, shadow.version)
+        agreed = live_matched == shadow_matched
+        self.add(key, (1, int(agreed), int(shadow_matched and not live_matched), int(live_matched and not shadow_matched), 0, 0, cpu_seconds * 1000))
+        if not agreed:
+            recent = self.disagreements.setdefault(key, deque(maxlen=MAX_DISAGREEMENTS))
+            recent.append({"live_matched": live_matched, "shadow_matched": shadow_matched, "event": event})
+
+    def record_error(self, shadow: ShadowRule, cpu_seconds: float):
+        self.add((shadow.rule.id, shadow.version), (1, 0, 0, 0, 1, 0, cpu_seconds * 1000))
+
+    def record_dropped(self, shadows: List[ShadowRule]):
+        for shadow in shadows:
+            self.add((shadow.rule.id, shadow.version), (0, 0, 0, 0, 0, 1, 0))
+
+class ShadowRunner:
+    """Evaluates sampled shadow rules on a background thread within a CPU budget"""
+
+    def __init__(self, recorder: ShadowStatsRecorder, cpu_budget: float = CPU_BUDGET, queue_size: int = QUEUE_SIZE):
+        self.recorder = recorder
+        self.cpu_budget = cpu_budget
+        self.burst = cpu_budget * BURST_SECONDS
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="shadow-evaluation", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _refill(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.cpu_budget)
+            self._refilled_at = now
+            return self._tokens
+
+    def _charge(self, cpu_seconds: float):
+        with self._lock:
+            self._tokens -= cpu_seconds
+
+    def submit(self, ruleset: CompiledRuleset, event: Dict, context: Dict, matched_rules: List[str]):
+        """Sample the ruleset's shadows for one live evaluation; never blocks"""
+        if not ruleset.shadows or self._thread is None:
+            return
+        sampled = [s for s in ruleset.shadows if random.random() < s.sample_rate]
+        if not sampled:
+            return
+
+        # Skip shadows whose live rule was never reached because of stop_on_match
+        if matched_rules:
+            last = ruleset.positions.get(matched_rules[-1])
+            if last is not None and ruleset.rules[last].stop_on_match:
+                sampled = [s for s in sampled if ruleset.positions.get(s.rule.id, last) <= last]
+                if not sampled:
+                    return
+
+        if self._refill() <= 0:
+            self.recorder.record_dropped(sampled)
+            return
+        try:
+            self._queue.put_nowait((sampled, event, context, set(matched_rules)))
+        except queue.Full:
+            self.recorder.record_dropped(sampled)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            sampled, event, context, live_matched = item
+            for i, shadow in enumerate(sampled):
+                if self._refill() <= 0:
+                    self.recorder.record_dropped(sampled[i:])
+                    break
+                started = time.thread_time()
+                try:
+                    result = shadow.rule.evaluate(event, context)
+                except Exception as e:
+                    cost = time.thread_time() - started
+                    logger.warning(f"Shadow {shadow.rule.id} v{shadow.version} failed: {e}")
+                    self.recorder.record_error(shadow, cost)
+                else:
+                    cost = time.thread_time() - started
+                    self.recorder.record(shadow, shadow.rule.id in live_matched, result.matched, cost, event)
+                self._charge(cost)
+
+def shadow_summary(db: Session, rule_id: str, version: int) -> Dict:
+    """Stored counters plus this worker's unflushed counters and recent disagreements"""
+    row = db.query(ShadowStat).filter(ShadowStat.rule_id == rule_id, ShadowStat.version == version).first()
+    counts = {name: (getattr(row, name) or 0) if row else 0 for name in COUNTERS}
+    for name, value in _recorder.pending((rule_id, version)).items():
+        counts[name] += value
+    evaluated = counts["evaluated"] - counts["errors"]
+    counts["agreement_rate"] = counts["agreed"] / evaluated if evaluated > 0 else None
+    counts["recent_disagreements"] = list(_recorder.disagreements.get((rule_id, version), ()))
+    return counts
+
+# Global instances
+_recorder = ShadowStatsRecorder()
+_runner = ShadowRunner(_recorder)
+_flusher: Optional[StatsFlusher] = None
+
+def get_shadow_runner() -> ShadowRunner:
+    """Get the process-wide shadow runner"""
+    return _runner
+
+def start_shadow_runner(engine: Engine):
+    """Start the shadow evaluation thread and flush its counters every RULE_STATS_FLUSH_INTERVAL seconds"""
+    global _flusher
+    _runner.start()
+    if _flusher is None:
+        _flusher = StatsFlusher(_recorder, engine, float(os.getenv("RULE_STATS_FLUSH_INTERVAL", "10")))
+        _flusher.start()
+
+def stop_shadow_runner():
+    global _flusher
+    _runner.stop()
+    if _flusher is not None:
+        _flusher.stop()
+        _flusher = None
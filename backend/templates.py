@@ -0,0 +1,101 @@
+"""
+Parameterized rule templates
+
+A template is a rule with `parameter_keys` (field paths such as "event.merchant_id").
+Its conditions use {"param": name} in place of "value", and its action payloads may
+contain {"param": name} placeholders. Each parameter row maps one key tuple to a set
+of parameter values, so one template replaces thousands of cloned rules and costs a
+single hash lookup per event.
+"""
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from evaluator import get_nested_value
+
+class ParameterRow:
+    """One row of a template's parameter table"""
+    __slots__ = ("id", "key", "params")
+
+    def __init__(self, id: str, key: Optional[List[Any]], params: Dict[str, Any]):
+        self.id = id
+        self.key = key
+        self.params = params
+
+class ParameterTable:
+    """Hash index from key tuples to parameter rows, with an optional default row"""
+
+    def __init__(self, keys: List[str], rows: List[ParameterRow]):
+        self.keys = keys
+        self.rows: Dict[Tuple, ParameterRow] = {}
+        self.default: Optional[ParameterRow] = None
+        for row in rows:
+            if row.key is None:
+                self.default = row
+            else:
+                self.rows[tuple(row.key)] = row
+
+    def lookup_key(self, event: Dict, context: Dict) -> Tuple:
+        merged = {"event": event, "context": context}
+        return tuple(get_nested_value(merged, path) for path in self.keys)
+
+    def lookup(self, event: Dict, context: Dict) -> Tuple[Tuple, Optional[ParameterRow]]:
+        """Return (key, row) for the event; falls back to the default row"""
+        key = self.lookup_key(event, context)
+        try:
+            row = self.rows.get(key)
+        except TypeError:
+            # Unhashable key values (lists/dicts) never match a row
+            row = None
+        return key, row if row is not None else self.default
+
+    def __len__(self) -> int:
+        return len(self.rows) + (1 if self.default else 0)
+
+def collect_param_refs(obj: Any, refs: Optional[Set[str]] = None) -> Set[str]:
+    """Collect parameter names referenced by conditions or actions"""
+    if refs is None:
+        refs = set()
+    if isinstance(obj, dict):
+        if isinstance(obj.get("param"), str):
+            refs.add(obj["param"])
+        for v in obj.values():
+            collect_param_refs(v, refs)
+    elif isinstance(obj, list):
+        for v in obj:
+            collect_param_refs(v, refs)
+    return refs
+
+def resolve_params(obj: Any, params: Dict[str, Any]) -> Any:
+    """Replace {"param": name} placeholders in action payloads"""
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "param" in obj and obj["param"] in params:
+            return params[obj["param"]]
+        return {k: resolve_params(v, params) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [resolve_params(v, params) for v in obj]
+    return obj
+
+def validate_parameter_rows(keys: List[str], rows: List[Dict], required: Set[str]) -> Optional[str]:
+    """Return an error message if the rows do not form a valid parameter table"""
+    seen = set()
+    default = None
+    for i, row in enumerate(rows):
+        key = row.get("key")
+        if key is None:
+            if default is not None:
+                return "Only one default row (key=null) is allowed"
+            default = row
+            continue
+        if len(key) != len(keys):
+            return f"Row {i}: key has {len(key)} values, expected {len(keys)} ({', '.join(keys)})"
+        if any(isinstance(k, (list, dict)) for k in key):
+            return f"Row {i}: key values must be scalars"
+        if tuple(key) in seen:
+            return f"Row {i}: duplicate key {key}"
+        seen.add(tuple(key))
+
+    defaults = set((default or {}).get("params", {}))
+    for i, row in enumerate(rows):
+        missing = required - set(row.get("params", {})) - defaults
+        if missing:
+            return f"Row {i}: missing parameters {', '.join(sorted(missing))}"
+    return None
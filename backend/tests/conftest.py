@@ -0,0 +1,55 @@
+"""
+Tests run against a throwaway SQLite database: DATABASE_URL is set before any backend
+module is imported, and every test starts from empty tables.
+"""
+import os
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+_tmp = tempfile.mkdtemp(prefix="rules-engine-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+
+import pytest
+
+@pytest.fixture
+def db_engine():
+    from database import engine
+    from models import Base
+    from ruleset import invalidate_ruleset
+    from idempotency import get_idempotency_cache
+    from rule_history import _cache as history_cache
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    invalidate_ruleset()
+    history_cache.clear()
+    cache = get_idempotency_cache()
+    cache._entries.clear()
+    yield engine
+
+@pytest.fixture
+def db(db_engine):
+    from database import SessionLocal
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+@pytest.fixture
+def client(db_engine):
+    from fastapi.testclient import TestClient
+    import main
+    return TestClient(main.app)
+
+@pytest.fixture
+def make_rule(client):
+    """POST /rules and return the new rule's id"""
+    def make(name, conditions, actions=None, **fields):
+        response = client.post("/rules", json={"name": name, "conditions": conditions,
+                                               "actions": actions or [{"type": "flag"}], **fields})
+        assert response.status_code == 200, response.text
+        return response.json()["id"]
+    return make
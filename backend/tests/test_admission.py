@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Rejected
+
+WAITS = {"critical": 1000, "default": 1000, "batch": 1000}
+
+def controller(limit, queue_size=10, batch_share=0.5, max_wait_ms=None):
+    return AdmissionController(initial_limit=limit, min_limit=1, max_limit=limit, queue_size=queue_size,
+                               batch_share=batch_share, max_wait_ms=max_wait_ms or WAITS)
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_full_queue_rejects_and_higher_classes_evict():
+    async def run():
+        admission = controller(1, queue_size=2)
+        await admission.acquire("default")
+        waiters = [asyncio.create_task(admission.acquire("default")) for _ in range(2)]
+        await settle()
+        assert admission.queued == 2
+
+        with pytest.raises(Rejected) as full:
+            await admission.acquire("default")
+        assert (full.value.status, full.value.reason) == (429, "queue_full")
+
+        # A critical request pushes out the newest default waiter
+        critical = asyncio.create_task(admission.acquire("critical"))
+        await settle()
+        with pytest.raises(Rejected) as evicted:
+            await waiters[1]
+        assert (evicted.value.status, evicted.value.reason) == (503, "evicted")
+        assert admission.queued == 2
+
+        # Critical goes first, then the remaining default waiter
+        admission.release("default", None)
+        await critical
+        assert not waiters[0].done()
+        admission.release("critical", None)
+        await waiters[0]
+        admission.release("default", None)
+        assert (admission.in_flight, admission.queued) == (0, 0)
+
+    asyncio.run(run())
+
+def test_waiters_time_out_and_are_skipped_lazily():
+    async def run():
+        admission = controller(1, max_wait_ms={**WAITS, "batch": 20})
+        await admission.acquire("default")
+        with pytest.raises(Rejected) as timeout:
+            await admission.acquire("batch")
+        assert (timeout.value.status, timeout.value.reason) == (503, "timeout")
+        assert admission.queued == 0
+        # The timed-out entry is still in the heap; releasing must not hand it the slot
+        admission.release("default", None)
+        assert (admission.in_flight, admission.queued) == (0, 0)
+        assert await admission.acquire("default") == 0.0
+        assert admission.in_flight == 1
+
+    asyncio.run(run())
+
+def test_batch_requests_only_use_their_share():
+    async def run():
+        admission = controller(3, batch_share=0.5)
+        await admission.acquire("batch")
+        await admission.acquire("default")
+        second_batch = asyncio.create_task(admission.acquire("batch"))
+        await settle()
+        assert admission.queued == 1 and admission.in_flight == 2
+
+        # Other classes still get the capacity the batch share leaves
+        assert await admission.acquire("default") == 0.0
+        assert admission.in_flight == 3
+
+        # A free slot is not given to a batch waiter while the share is used up
+        admission.release("default", None)
+        await settle()
+        assert not second_batch.done()
+        assert (admission.in_flight, admission.batch_in_flight, admission.queued) == (2, 1, 1)
+
+        admission.release("batch", None)
+        await second_batch
+        assert (admission.in_flight, admission.batch_in_flight, admission.queued) == (2, 1, 0)
+
+    asyncio.run(run())
+
+def test_cancelled_waiters_do_not_leak_slots():
+    async def run():
+        admission = controller(1)
+        await admission.acquire("default")
+
+        # Cancelled while still queued
+        queued = asyncio.create_task(admission.acquire("default"))
+        await settle()
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert admission.queued == 0
+
+        # Cancelled after the slot was granted but before the waiter resumed
+        granted = asyncio.create_task(admission.acquire("default"))
+        await settle()
+        admission.release("default", None)
+        assert admission.in_flight == 1
+        granted.cancel()
+        try:
+            await granted
+            holds_slot = True
+        except asyncio.CancelledError:
+            holds_slot = False
+        assert admission.in_flight == (1 if holds_slot else 0)
+        if holds_slot:
+            admission.release("default", None)
+        assert (admission.in_flight, admission.queued) == (0, 0)
+
+    asyncio.run(run())
+
+def test_limit_shrinks_when_latency_rises():
+    admission = AdmissionController(initial_limit=20, min_limit=4, max_limit=200, queue_size=10)
+    admission.in_flight = 20
+    for _ in range(50):
+        admission._update_limit(0.01)
+    steady = admission.limit
+    for _ in range(50):
+        admission._update_limit(0.2)
+    assert admission.limit < steady
+    assert admission.limit >= 4
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+import archive
+import audit_storage
+from archive import archive_period, load_manifest, query_archive
+from models import AuditLog, AuditRuleMatch
+
+START = datetime(2024, 1, 1)
+END = datetime(2024, 2, 1)
+
+def add_logs(db, ids, day=1):
+    for audit_id in ids:
+        at = START + timedelta(days=day)
+        db.add(AuditLog(id=audit_id, event_id=audit_id, matched_rules=["r1"], created_at=at))
+        db.add(AuditRuleMatch(rule_id="r1", created_at=at, audit_id=audit_id))
+    db.commit()
+
+def remaining(db):
+    return db.execute(select(func.count()).select_from(AuditLog)).scalar()
+
+def archived_ids(tmp_path):
+    return sorted(row["id"] for row in query_archive(archive_dir=str(tmp_path)))
+
+def test_archive_period_moves_rows_to_files(db_engine, db, tmp_path):
+    add_logs(db, ["a", "b"])
+    add_logs(db, ["next-month"], day=40)
+    result = archive_period(db_engine, START, END, str(tmp_path))
+    assert result["deleted_rows"] == 2
+    assert archived_ids(tmp_path) == ["a", "b"]
+    assert remaining(db) == 1
+    assert db.execute(select(func.count()).select_from(AuditRuleMatch)).scalar() == 1
+
+def test_late_rows_are_archived_before_they_are_purged(db_engine, db, tmp_path):
+    add_logs(db, ["a"])
+    archive_period(db_engine, START, END, str(tmp_path))
+    # Written into the period after it was archived
+    add_logs(db, ["late"])
+    result = archive_period(db_engine, START, END, str(tmp_path))
+    assert result["deleted_rows"] == 1
+    assert archived_ids(tmp_path) == ["a", "late"]
+    assert remaining(db) == 0
+    manifest = load_manifest(str(tmp_path))
+    assert [e["file"] for e in manifest["files"]] == ["audit_20240101_0001.jsonl.gz", "audit_20240101_0002.jsonl.gz"]
+    assert manifest["periods"] == [START.isoformat()]
+
+def test_rows_not_in_the_archive_are_kept(db_engine, db, tmp_path, monkeypatch):
+    add_logs(db, ["a"])
+    real_ids = archive._archived_ids
+
+    def ids_then_late_write(archive_dir, entries):
+        # A row lands in the period between archiving and purging
+        add_logs(db, ["late"])
+        return real_ids(archive_dir, entries)
+
+    monkeypatch.setattr(archive, "_archived_ids", ids_then_late_write)
+    archive_period(db_engine, START, END, str(tmp_path))
+    monkeypatch.undo()
+    assert remaining(db) == 1
+    assert archived_ids(tmp_path) == ["a"]
+
+def test_an_interrupted_purge_does_not_archive_rows_twice(db_engine, db, tmp_path, monkeypatch):
+    add_logs(db, ["a", "b"])
+    monkeypatch.setattr(archive, "purge_ids", lambda *args: {"dropped_partitions": [], "deleted_rows": 0})
+    archive_period(db_engine, START, END, str(tmp_path))
+    monkeypatch.undo()
+    result = archive_period(db_engine, START, END, str(tmp_path))
+    assert result["deleted_rows"] == 2
+    assert archived_ids(tmp_path) == ["a", "b"]
+    assert len(load_manifest(str(tmp_path))["files"]) == 1
+
+def test_maintenance_start_only_creates_partitions(db_engine, monkeypatch):
+    calls = []
+    monkeypatch.setattr(audit_storage, "create_partitions", lambda engine: calls.append("partitions") or [])
+    monkeypatch.setattr(audit_storage, "maintain", lambda engine: calls.append("maintain"))
+    maintenance = audit_storage.AuditMaintenance(db_engine, interval=3600)
+    monkeypatch.setattr(maintenance._thread, "start", lambda: calls.append("thread"))
+    maintenance.start()
+    assert calls == ["partitions", "thread"]
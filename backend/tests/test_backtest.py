@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import backtest
+from backtest import run_backtest
+from ruleset import rule_spec
+from value_sets import get_value_set_registry
+from windows import WindowSpec, get_window_store
+
+VELOCITY = {"fn": "count_over", "args": ["event.card", "10m"], "op": ">=", "value": 3}
+START = datetime(2024, 1, 1)
+
+def spec(rule_id, conditions):
+    return rule_spec({"id": rule_id, "name": rule_id, "conditions": conditions, "actions": []})
+
+def records(times):
+    """Backtest records for card "c1" at the given minutes"""
+    return [({"event_id": f"e{i}"}, {"card": "c1", "amount": 10 * i}, {}, [],
+             backtest._timestamp(START + timedelta(minutes=m)))
+            for i, m in enumerate(times)]
+
+def replay(times, **options):
+    return run_backtest(records(times), [spec("velocity", VELOCITY)], [], sample_size=10, **options)
+
+def test_windows_are_replayed_in_event_time():
+    # The 3rd and 4th events are within 10 minutes of two earlier ones; the 5th is not
+    report = replay([0, 1, 2, 5, 30])
+    assert report["rules"]["velocity"]["matched"] == 2
+    assert [e["event_id"] for e in report["examples"]["velocity"]["newly_matched"]] == ["e2", "e3"]
+
+def test_window_results_do_not_depend_on_workers_or_live_state():
+    live = WindowSpec("count_over", "event.card", None, "10m")
+    for _ in range(5):
+        get_window_store().observe([(live, "c1", None)])
+    before = get_window_store().query(live, "c1")
+
+    one = replay([0, 1, 2, 5, 30], workers=1)
+    four = replay([0, 1, 2, 5, 30], workers=4)
+    assert one["rules"] == four["rules"] and one["examples"] == four["examples"]
+    assert get_window_store().query(live, "c1") == before
+
+def test_in_process_backtest_does_not_share_worker_state(monkeypatch):
+    monkeypatch.setattr(backtest, "_worker_ruleset", None)
+    report = run_backtest(
+        records([0, 1]),
+        [spec("big", {"field": "event.amount", "op": ">=", "value": 10})], [], workers=1
+    )
+    assert report["rules"]["big"]["matched"] == 1
+    assert backtest._worker_ruleset is None
+
+def test_worker_pool_matches_in_process_replay(monkeypatch):
+    monkeypatch.setattr(backtest, "CHUNK_SIZE", 7)
+    specs = [spec("big", {"field": "event.amount", "op": ">=", "value": 20})]
+    items = records(range(50))
+    pooled = run_backtest(items, specs, [], workers=2, sample_size=0)
+    local = run_backtest(items, specs, [], workers=1, sample_size=0)
+    assert pooled["rules"] == local["rules"] == {"big": {"matched": 48, "baseline_matched": 0, "newly_matched": 48, "no_longer_matched": 0}}
+
+def test_value_sets_survive_a_live_reload_during_the_run(monkeypatch):
+    monkeypatch.setattr(backtest, "CHUNK_SIZE", 3)
+    registry = get_value_set_registry()
+    registry.put("risky", 1, ["old"])
+    registry.set_latest("risky", 1)
+    condition = {"field": "event.merchant", "op": "in", "value_set": "risky"}
+    items = [({"event_id": f"e{i}"}, {"merchant": "r"}, {}, [], None) for i in range(10)]
+    # The live ruleset is rebuilt in this process after every chunk
+    report = run_backtest(items, [spec("risky", condition)], [("risky", 2, ["r"], True)],
+                          workers=1, progress=lambda _: registry.retain({("risky", 1)}))
+    assert report["rules"]["risky"]["matched"] == 10
+    # Live unpinned references still see the live version, and the run's hold is released
+    assert registry.get("risky").version == 1
+    registry.retain({("risky", 1)})
+    assert not registry.contains("risky", 2)
+
+def test_workers_are_bounded(client):
+    response = client.post("/backtests", json={"rules": [], "workers": 10_000})
+    assert response.status_code == 422
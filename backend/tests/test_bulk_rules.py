@@ -0,0 +1,27 @@
+import json
+
+from models import Rule
+
+def table(rows):
+    return {"hit_policy": "priority", "inputs": [{"field": "event.amount", "match": "range"}], "rows": rows}
+
+def test_malformed_decision_tables_are_listed_in_the_batch_error(client, db):
+    rules = [
+        {"name": "ok", "conditions": {"field": "event.amount", "op": ">", "value": 1}, "actions": []},
+        {"name": "bad priority", "conditions": {}, "actions": [],
+         "decision_table": table([{"when": ["-"], "priority": "high"}])},
+        {"name": "row not an object", "conditions": {}, "actions": [], "decision_table": table(["-"])},
+        {"name": "mixed bounds", "conditions": {}, "actions": [],
+         "decision_table": table([{"when": [{"min": 0, "max": "z"}]}])},
+    ]
+    body = "\n".join(json.dumps(rule) for rule in rules)
+    response = client.post("/rules/bulk", content=body)
+    assert response.status_code == 400
+    errors = response.json()["detail"]
+    assert [(e["index"], e["id"]) for e in errors] == [(1, "bad_priority"), (2, "row_not_an_object"), (3, "mixed_bounds")]
+    assert all(e["error"].startswith("Invalid decision table") for e in errors)
+    assert db.query(Rule).count() == 0
+
+    response = client.post("/rules/bulk", content=json.dumps(rules[:1]))
+    assert response.status_code == 200
+    assert db.query(Rule).count() == 1
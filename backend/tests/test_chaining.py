@@ -0,0 +1,27 @@
+from chaining import apply_assertions
+from engine import RulesEngine
+
+def test_retracting_a_null_fact_is_a_change():
+    memory = {"event": {}, "context": {"account": {"review": None}}}
+    changes, errors = apply_assertions(memory, [{"retract": ["context.account.review", "context.account.missing"]}])
+    assert changes == {"context.account.review": None} and errors == []
+    assert memory["context"]["account"] == {}
+
+def test_retraction_of_null_fact_is_reported():
+    engine = RulesEngine.from_rules([
+        {"id": "clear", "name": "clear", "conditions": {"field": "event.ok", "op": "==", "value": True},
+         "actions": [{"type": "clear", "retract": ["context.hold"]}]},
+    ], record_windows=False)
+    result = engine.evaluate({"ok": True}, {"hold": None}, chain=True)
+    assert result["chain"]["facts"] == {"context.hold": None}
+    assert result["explanation"][0]["asserted"] == {"context.hold": None}
+
+def test_cycle_message():
+    engine = RulesEngine.from_rules([
+        {"id": "bump", "name": "bump", "conditions": {"field": "context.n", "op": ">=", "value": 0},
+         "actions": [{"type": "bump", "assert": {"context.n": 1}}]},
+    ], record_windows=False)
+    result = engine.evaluate({}, {"n": 0}, chain=True)
+    assert result["chain"]["cycles"] == ["bump"]
+    (message,) = [e["message"] for e in result["explanation"] if "message" in e]
+    assert "already fired for this event" in message
@@ -0,0 +1,40 @@
+import threading
+import time
+
+from context_providers import InMemorySharedCache, LocalCache, ProviderRegistry, TwoTierCache
+
+def test_waiting_requests_give_up_after_the_provider_timeout():
+    registry = ProviderRegistry()
+    registry.cache = TwoTierCache(LocalCache())
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch(user_id):
+        calls.append(user_id)
+        release.wait(5)
+        return {"tier": "gold"}
+
+    registry.register("user", slow_fetch, "event.user_id", timeout=0.1)
+    provider = registry.providers["user"]
+    results = []
+    leader = threading.Thread(target=lambda: results.append(registry.load(provider, {"user_id": 1}, {})))
+    leader.start()
+    while not calls:
+        time.sleep(0.01)
+
+    started = time.monotonic()
+    assert registry.load(provider, {"user_id": 1}, {}) is None
+    assert time.monotonic() - started < 1
+    release.set()
+    leader.join()
+    assert results == [{"tier": "gold"}] and calls == [1]
+    assert registry.load(provider, {"user_id": 1}, {}) == {"tier": "gold"}
+
+def test_in_memory_shared_cache_is_bounded():
+    cache = InMemorySharedCache(max_entries=2)
+    for key in "abc":
+        cache.set(key, key.upper(), ttl=60)
+    assert cache.get("a") is None
+    assert (cache.get("b"), cache.get("c")) == ("B", "C")
+    cache.set("d", "D", ttl=-1)
+    assert cache.get("d") is None
@@ -0,0 +1,133 @@
+import random
+import time
+
+import pytest
+
+from decision_tables import DecisionTable, DecisionTableError, Interval, IntervalIndex, table_from_csv, table_to_csv
+
+def random_interval(rng):
+    lo = rng.choice([None, rng.randint(0, 50)])
+    hi = rng.choice([None, rng.randint(0, 50)])
+    return Interval(lo, hi, rng.random() < 0.5, rng.random() < 0.5)
+
+def test_interval_lookup_matches_a_scan():
+    rng = random.Random(7)
+    intervals = [(r, None if rng.random() < 0.1 else random_interval(rng)) for r in range(200)]
+    index = IntervalIndex(intervals)
+    for value in [x / 2 for x in range(-4, 110)]:
+        expected = tuple(r for r, iv in intervals if iv is None or iv.contains(value))
+        assert index.lookup(value) == expected, value
+
+def test_interval_lookup_of_unordered_value():
+    index = IntervalIndex([(0, Interval(0, 10)), (1, None)])
+    assert index.lookup("ten") == ()
+    assert index.lookup(None) == ()
+
+def test_interval_index_builds_large_tables_quickly():
+    intervals = [(r, Interval(r, r + 10)) for r in range(5000)]
+    started = time.perf_counter()
+    index = IntervalIndex(intervals)
+    assert time.perf_counter() - started < 1.0
+    assert index.lookup(100) == tuple(range(91, 101))
+    assert index.lookup(5008.5) == (4999,)
+
+TABLE = {
+    "hit_policy": "collect",
+    "inputs": [
+        {"field": "event.mcc"},
+        {"field": "event.note"},
+        {"field": "event.amount", "match": "range"}
+    ],
+    "rows": [
+        {"id": "grocery", "when": ["5411", "null", {"min": 0, "max": 100}], "actions": [{"type": "approve"}]},
+        {"id": "numeric", "when": [5411, "-", {"min": 100, "max_inclusive": True, "max": 500}], "actions": []},
+        {"id": "listed", "when": [["5411", "true", "a,b"], "say \"hi\"", "-"], "actions": [], "priority": 3},
+        {"id": "falsy", "when": [False, 0, {"min": 1.5, "min_inclusive": False}], "actions": []}
+    ]
+}
+
+def test_csv_round_trip_keeps_cell_types():
+    definition = table_from_csv(table_to_csv(TABLE), "collect")
+    assert [row["when"] for row in definition["rows"]] == [
+        ["5411", "null", {"min": 0, "min_inclusive": True, "max": 100, "max_inclusive": False}],
+        [5411, "-", {"min": 100, "min_inclusive": True, "max": 500, "max_inclusive": True}],
+        [["5411", "true", "a,b"], "say \"hi\"", "-"],
+        [False, 0, {"min": 1.5, "min_inclusive": False}]
+    ]
+    assert [row["id"] for row in definition["rows"]] == ["grocery", "numeric", "listed", "falsy"]
+    assert definition["rows"][2]["priority"] == 3
+
+    table = DecisionTable(definition)
+    rows, _, _ = table.lookup({"mcc": "5411", "note": "null", "amount": 50}, {})
+    assert [table.row_ids[r] for r in rows] == ["grocery"]
+    rows, _, _ = table.lookup({"mcc": "a,b", "note": "say \"hi\"", "amount": 50}, {})
+    assert [table.row_ids[r] for r in rows] == ["listed"]
+    rows, _, _ = table.lookup({"mcc": 5411, "note": None, "amount": 500}, {})
+    assert [table.row_ids[r] for r in rows] == ["numeric"]
+
+def test_csv_import_of_unquoted_text():
+    definition = table_from_csv("event.country,event.amount:range,id\nUS,[0..10),a\n-,,b\n")
+    assert definition["rows"][0]["when"] == ["US", {"min": 0, "min_inclusive": True, "max": 10, "max_inclusive": False}]
+    assert definition["rows"][1]["when"] == ["-", "-"]
+
+def test_unique_violation_is_explained(client, make_rule):
+    make_rule("unique_table", {}, [], decision_table={
+        "hit_policy": "unique",
+        "inputs": [{"field": "event.amount", "match": "range"}],
+        "rows": [
+            {"id": "low", "when": [{"max": 100}], "actions": [{"type": "a"}]},
+            {"id": "any", "when": ["-"], "actions": [{"type": "b"}]}
+        ]
+    })
+    body = client.post("/evaluate", json={"event": {"amount": 5}, "context": {}}).json()
+    assert body["actions"] == [] and body["matched_rules"] == []
+    (explanation,) = body["explanation"]
+    assert explanation["matched"] is False
+    assert "'unique' violated" in explanation["decision_table"]["error"]
+
+@pytest.mark.parametrize("rows, message", [
+    (["grocery"], "Row 0 must be an object"),
+    ([{"when": "5411"}], "when must be a list"),
+    ([{"when": [1], "priority": "high"}], "priority must be an integer"),
+    ([{"when": [1], "priority": True}], "priority must be an integer"),
+    ([{"when": [1], "actions": {"type": "flag"}}], "actions must be a list"),
+])
+def test_malformed_rows_are_rejected(rows, message):
+    with pytest.raises(DecisionTableError, match=message):
+        DecisionTable({"inputs": [{"field": "event.mcc"}], "rows": rows})
+
+@pytest.mark.parametrize("definition", [
+    {"inputs": 5, "rows": []},
+    {"inputs": {"field": "event.mcc"}, "rows": []},
+    {"inputs": [{"field": ["event", "mcc"]}], "rows": []},
+    {"inputs": [{"field": "event.mcc"}], "rows": {"0": {"when": [1]}}},
+])
+def test_malformed_inputs_are_rejected(definition):
+    with pytest.raises(DecisionTableError):
+        DecisionTable(definition)
+
+@pytest.mark.parametrize("cells", [
+    [{"min": 0, "max": "z"}],
+    [{"min": [1]}],
+    [{"min": {"a": 1}}],
+    [{"max": float("nan")}],
+    [{"min": True}],
+    [{"min": 0, "min_inclusive": "yes"}],
+    [{"min": 0}, {"max": "m"}],
+])
+def test_range_bounds_must_be_comparable_scalars_of_one_type(cells):
+    rows = [{"when": [cell]} for cell in cells]
+    with pytest.raises(DecisionTableError):
+        DecisionTable({"inputs": [{"field": "event.amount", "match": "range"}], "rows": rows})
+
+def test_bad_priority_is_rejected_and_evaluation_keeps_working(client, make_rule):
+    make_rule("big", {"field": "event.amount", "op": ">", "value": 100})
+    response = client.post("/rules", json={"name": "bad_table", "conditions": {}, "actions": [], "decision_table": {
+        "hit_policy": "priority",
+        "inputs": [{"field": "event.amount", "match": "range"}],
+        "rows": [{"id": "any", "when": ["-"], "actions": [{"type": "a"}], "priority": "high"}]
+    }})
+    assert response.status_code == 400
+    assert "priority must be an integer" in response.json()["detail"]
+    response = client.post("/evaluate", json={"event": {"amount": 500}, "context": {}})
+    assert response.status_code == 200 and response.json()["matched_rules"] == ["big"]
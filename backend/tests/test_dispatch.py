@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import dispatch
+from dispatch import ActionDispatcher, ActionHandler, connect_outbox
+
+class Recorder:
+    """Handler that records actions and fails the first `failures` calls"""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.seen = []
+        self._lock = threading.Lock()
+
+    def __call__(self, action):
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("downstream unavailable")
+            self.seen.append(action["payload"]["n"])
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(dispatch, "BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr(dispatch, "ERROR_BACKOFF_SECONDS", 0.01)
+
+@pytest.fixture
+def outbox(tmp_path):
+    return str(tmp_path / "outbox.db")
+
+def start(outbox, handler, **options):
+    dispatcher = ActionDispatcher(outbox, {"alert": ActionHandler("alert", handler, **options)})
+    dispatcher.start()
+    return dispatcher
+
+def rows(outbox):
+    conn = connect_outbox(outbox)
+    try:
+        return conn.execute("SELECT status, attempts, last_error FROM outbox ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+def alert(n):
+    return {"type": "alert", "payload": {"n": n}}
+
+def test_same_action_for_an_event_is_dispatched_once(outbox):
+    recorder = Recorder()
+    dispatcher = start(outbox, recorder)
+    dispatcher.submit("e1", [alert(1), alert(1), {"type": "unhandled"}])
+    dispatcher.submit("e1", [alert(1)])
+    dispatcher.submit("e2", [alert(1)])
+    assert dispatcher.wait_idle(10)
+    dispatcher.stop()
+    assert recorder.seen == [1, 1]
+    assert dispatcher.stats()["outbox"] == {"alert": {"done": 2}}
+
+def test_failed_actions_are_retried_then_dead(outbox):
+    flaky = Recorder(failures=2)
+    dispatcher = start(outbox, flaky, max_attempts=3)
+    dispatcher.submit("e1", [alert(1)])
+    assert dispatcher.wait_idle(10)
+    dispatcher.stop()
+    assert flaky.seen == [1]
+    assert rows(outbox) == [("done", 3, "RuntimeError: downstream unavailable")]
+
+    broken = Recorder(failures=10)
+    dispatcher = start(outbox, broken, max_attempts=2, batch_size=10)
+    dispatcher.submit("e2", [alert(2)])
+    assert dispatcher.wait_idle(10)
+    dispatcher.stop()
+    assert rows(outbox)[1][:2] == ("dead", 2)
+
+def test_dispatchers_sharing_an_outbox_claim_each_action_once(outbox):
+    recorder = Recorder()
+    first, second = start(outbox, recorder), start(outbox, recorder)
+    for n in range(300):
+        (first if n % 2 else second).submit(f"e{n}", [alert(n)])
+    assert first.wait_idle(20) and second.wait_idle(20)
+    first.stop()
+    second.stop()
+    assert sorted(recorder.seen) == list(range(300))
+
+def test_restart_leaves_live_leases_and_reclaims_expired_ones(outbox):
+    conn = connect_outbox(outbox)
+    now = time.time()
+    conn.executemany(
+        "INSERT INTO outbox (dedup_key, type, action, attempts, next_attempt, status, updated_at, owner, lease_until) "
+        "VALUES (?, 'alert', ?, 1, ?, 'running', ?, ?, ?)",
+        [("live", '{"type": "alert", "payload": {"n": 1}}', now, now, "other-worker", now + 60),
+         ("crashed", '{"type": "alert", "payload": {"n": 2}}', now, now, "dead-worker", now - 1)]
+    )
+    conn.commit()
+    conn.close()
+
+    recorder = Recorder()
+    dispatcher = start(outbox, recorder)
+    deadline = time.monotonic() + 10
+    while not recorder.seen and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    dispatcher.stop()
+    assert recorder.seen == [2]
+    assert [r[0] for r in rows(outbox)] == ["running", "done"]
+
+def test_outbox_errors_do_not_stop_the_dispatcher(outbox, monkeypatch):
+    recorder = Recorder()
+    dispatcher = ActionDispatcher(outbox, {"alert": ActionHandler("alert", recorder)})
+    schedule = dispatcher._schedule
+    errors = [sqlite3.OperationalError("database is locked")] * 3
+
+    def flaky_schedule(conn):
+        if errors:
+            raise errors.pop()
+        schedule(conn)
+
+    monkeypatch.setattr(dispatcher, "_schedule", flaky_schedule)
+    dispatcher.start()
+    dispatcher.submit("e1", [alert(1)])
+    assert dispatcher.wait_idle(10)
+    dispatcher.stop()
+    assert recorder.seen == [1] and not errors
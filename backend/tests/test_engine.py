@@ -0,0 +1,117 @@
+import json
+
+import pytest
+
+from bulk_rules import BulkImportError
+from engine import RulesEngine
+from value_sets import get_value_set_registry
+
+BLOCKED = ["c-1", "c-2"]
+EVENTS = [
+    {"card": "c-1", "amount": 5, "merchant": "m1", "country": "US"},
+    {"card": "c-9", "amount": 700, "merchant": "m1", "country": "FR"},
+    {"card": "c-9", "amount": 120, "merchant": "m2", "country": "US"},
+    {"card": "c-2", "amount": 50, "merchant": "m3", "country": "DE"},
+]
+
+def comparable(response):
+    return {**response, "evaluation_time_ms": None, "audit_log_id": None}
+
+@pytest.fixture
+def served_rules(client, make_rule):
+    """Rules of each kind created through the API; returns them as exported, with parameter tables"""
+    assert client.post("/value-sets/blocked_cards", json={"values": BLOCKED}).status_code == 200
+    make_rule("blocked", {"field": "event.card", "op": "in", "value_set": "blocked_cards"},
+              [{"type": "block"}], priority=10)
+    template = make_rule("merchant_limit", {"field": "event.amount", "op": ">", "param": "limit"},
+                         [{"type": "review", "limit": {"param": "limit"}}], parameter_keys=["event.merchant"])
+    rows = [{"key": ["m1"], "params": {"limit": 500}}, {"key": None, "params": {"limit": 100}}]
+    assert client.put(f"/rules/{template}/parameters", json={"rows": rows}).status_code == 200
+    make_rule("country_bands", {}, [], decision_table={
+        "hit_policy": "first",
+        "inputs": [{"field": "event.country"}, {"field": "event.amount", "match": "range"}],
+        "rows": [
+            {"id": "us_small", "when": ["US", {"max": 10}], "actions": [{"type": "allow"}]},
+            {"id": "foreign", "when": ["-", {"min": 100}], "actions": [{"type": "hold"}]},
+        ],
+    })
+    dormant = make_rule("dormant", {"field": "event.amount", "op": ">", "value": 0})
+    assert client.put(f"/rules/{dormant}", json={"active": False}).status_code == 200
+
+    rules = [json.loads(line) for line in client.get("/rules/export").text.splitlines() if line]
+    for rule in rules:
+        if rule.get("parameter_keys"):
+            rule["parameters"] = client.get(f"/rules/{rule['id']}/parameters").json()["rows"]
+    return rules
+
+def test_from_rules_matches_the_server(client, served_rules):
+    engine = RulesEngine.from_rules(served_rules, {"blocked_cards": BLOCKED}, record_windows=False)
+    try:
+        assert len(engine) == 3
+        for event in EVENTS:
+            served = client.post("/evaluate", json={"event": event, "context": {}}).json()
+            assert comparable(engine.evaluate(event)) == comparable(served), event
+        assert any(engine.evaluate(event)["matched_rules"] for event in EVENTS)
+    finally:
+        engine.close()
+
+def test_inactive_rules_are_simulated_but_not_evaluated():
+    engine = RulesEngine.from_rules([
+        {"id": "dormant", "name": "dormant", "active": False,
+         "conditions": {"field": "event.amount", "op": ">", "value": 10}, "actions": [{"type": "flag"}]}
+    ])
+    assert len(engine) == 0
+    assert engine.evaluate({"amount": 50})["matched_rules"] == []
+    simulated = engine.simulate("dormant", {"amount": 50})
+    assert (simulated["matched"], simulated["rule_name"], simulated["would_execute"]) == (True, "dormant", [{"type": "flag"}])
+    with pytest.raises(KeyError):
+        engine.simulate("missing", {})
+
+def test_invalid_rules_are_all_reported():
+    rules = [
+        {"name": "ok", "conditions": {"field": "event.amount", "op": ">", "value": 1}, "actions": []},
+        {"name": "bad op", "conditions": {"field": "event.amount", "op": "~~", "value": 1}, "actions": []},
+        {"name": "missing limit", "conditions": {"field": "event.amount", "op": ">", "param": "limit"}, "actions": [],
+         "parameter_keys": ["event.merchant"], "parameters": [{"key": ["m1"], "params": {}}]},
+        {"name": "bad rows", "conditions": {"field": "event.amount", "op": ">", "param": "limit"}, "actions": [],
+         "parameter_keys": ["event.merchant"], "parameters": [{"key": "m1", "params": {"limit": 1}}]},
+    ]
+    with pytest.raises(BulkImportError) as error:
+        RulesEngine.from_rules(rules)
+    # Parameter tables are checked in the same pass as the rules themselves
+    assert [(e["index"], e["error"]) for e in error.value.errors] == [
+        (1, error.value.errors[0]["error"]),
+        (2, "Row 0: missing parameters limit"),
+        (3, "Row 0: must be an object with a key list (or null) and a params object"),
+    ]
+
+def test_audit_sinks_receive_records_and_supply_the_id():
+    records = []
+
+    def silent(record):
+        records.append(record)
+
+    engine = RulesEngine.from_rules([
+        {"id": "big", "name": "big", "conditions": {"field": "event.amount", "op": ">", "value": 100}, "actions": []}
+    ], audit_sinks=[silent])
+    assert engine.evaluate({"amount": 500})["audit_log_id"] is None
+
+    engine.add_audit_sink(lambda record: "first")
+    engine.add_audit_sink(lambda record: "second")
+    response = engine.evaluate({"amount": 500}, {"country": "US"}, event_id="evt-1")
+    assert response["audit_log_id"] == "first"
+    assert len(records) == 2
+    assert (records[1]["event_id"], records[1]["matched_rules"]) == ("evt-1", ["big"])
+    assert records[1]["context"]["country"] == "US"
+
+def test_close_releases_the_engine_value_sets():
+    registry = get_value_set_registry()
+    engine = RulesEngine.from_rules([
+        {"name": "listed", "conditions": {"field": "event.card", "op": "in", "value_set": "engine_only"}, "actions": []}
+    ], {"engine_only": {3: ["x"]}})
+    assert engine.evaluate({"card": "x"})["matched_rules"]
+    registry.retain(set())
+    assert registry.get("engine_only", 3) is not None
+    engine.close()
+    registry.retain(set())
+    assert registry.get("engine_only", 3) is None
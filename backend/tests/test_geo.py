@@ -0,0 +1,39 @@
+import pytest
+
+import geo
+from geo import GeofenceIndex, compile_fence
+
+FIJI = [[-15, 178], [-15, -178], [-20, -178], [-20, 178]]
+
+def index(*fences):
+    return GeofenceIndex([({}, compile_fence(op, value)) for op, value in fences])
+
+def test_polygon_crossing_the_antimeridian():
+    fences = index(("within_polygon", FIJI))
+    for point in ((-17, 179.5), (-17, -179.5), (-17, 180), (-15.5, -178.5)):
+        assert len(fences.probe(point)) == 1, point
+    for point in ((-17, 0), (-17, 177), (-17, -177), (-21, 179)):
+        assert fences.probe(point) == set(), point
+
+def test_radius_crossing_the_antimeridian():
+    fences = index(("within_radius", {"center": [0, 179.9], "km": 50}))
+    assert len(fences.probe((0, -179.9))) == 1
+    assert len(fences.probe((0, 179.6))) == 1
+    assert fences.probe((0, -179)) == set()
+
+def test_large_fences_are_tested_on_every_probe(monkeypatch):
+    monkeypatch.setattr(geo, "MAX_CELLS_PER_FENCE", 16)
+    large = ("within_radius", {"center": [48.85, 2.35], "km": 1000})
+    small = ("within_radius", {"center": [48.85, 2.35], "km": 10})
+    fences = index(large, small)
+    assert fences._large and len(fences._large) == 1
+    assert fences.probe((48.85, 2.35)) == set(fences.fences)
+    # Berlin is about 880 km from Paris
+    assert fences.probe((52.52, 13.40)) == {geo.fence_key(*large)}
+    assert fences.probe((40.71, -74.0)) == set()
+
+@pytest.mark.parametrize("point, matched", [({"lat": -17, "lon": -179.5}, True), ([-17, 10], False)])
+def test_antimeridian_fence_in_a_rule(client, make_rule, point, matched):
+    make_rule("fiji", {"field": "event.location", "op": "within_polygon", "value": FIJI})
+    body = client.post("/evaluate", json={"event": {"location": point}, "context": {}}).json()
+    assert body["matched_rules"] == (["fiji"] if matched else [])
@@ -0,0 +1,123 @@
+import json
+import threading
+
+import pytest
+
+import idempotency
+from idempotency import IdempotencyCache, IdempotencyConflict
+from models import AuditLog
+
+def test_retry_replays_the_first_response(client, db, make_rule):
+    make_rule("big", {"field": "event.amount", "op": ">", "value": 100})
+    request = {"event": {"amount": 500}, "context": {}, "event_id": "evt-1"}
+    first = client.post("/evaluate", json=request)
+    retry = client.post("/evaluate", json=request)
+    assert first.json()["matched_rules"] == ["big"]
+    assert retry.json() == first.json()
+    assert "Idempotent-Replay" not in first.headers and retry.headers["Idempotent-Replay"] == "true"
+    assert db.query(AuditLog).count() == 1
+
+def test_rule_changes_and_missing_event_ids_evaluate_again(client, db, make_rule):
+    rule_id = make_rule("big", {"field": "event.amount", "op": ">", "value": 100})
+    request = {"event": {"amount": 500}, "context": {}, "event_id": "evt-1"}
+    first = client.post("/evaluate", json=request).json()
+    client.put(f"/rules/{rule_id}", json={"conditions": {"field": "event.amount", "op": ">", "value": 1000}})
+    after_change = client.post("/evaluate", json=request).json()
+    assert after_change["matched_rules"] == [] and after_change["audit_log_id"] != first["audit_log_id"]
+
+    anonymous = {"event": {"amount": 500}, "context": {}}
+    client.post("/evaluate", json=anonymous)
+    client.post("/evaluate", json=anonymous)
+    assert db.query(AuditLog).count() == 4
+
+def test_zero_caller_ttl_turns_idempotency_off(client, db, make_rule, monkeypatch):
+    monkeypatch.setitem(idempotency.CALLER_TTLS, "loadtest", 0)
+    make_rule("any", {})
+    request = {"event": {}, "context": {}, "event_id": "evt-1"}
+    for _ in range(2):
+        response = client.post("/evaluate", json=request, headers={"X-Caller": "loadtest"})
+        assert "Idempotent-Replay" not in response.headers
+    assert db.query(AuditLog).count() == 2
+
+def test_concurrent_retries_share_one_evaluation():
+    cache = IdempotencyCache()
+    release = threading.Event()
+    started = threading.Event()
+    calls = []
+
+    def evaluate():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"audit_log_id": "a1"}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.run("e1", "fp", 60, evaluate)))]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=lambda: results.append(cache.run("e1", "fp", 60, evaluate))) for _ in range(5)]
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(replayed for _, replayed in results) == [False] + [True] * 5
+    assert all(response == {"audit_log_id": "a1"} for response, _ in results)
+
+def test_failed_evaluation_is_not_stored():
+    cache = IdempotencyCache()
+
+    def fail():
+        raise RuntimeError("db down")
+
+    with pytest.raises(RuntimeError):
+        cache.run("e1", "fp", 60, fail)
+    assert cache.run("e1", "fp", 60, lambda: {"ok": True}) == ({"ok": True}, False)
+    # A different ruleset fingerprint is a different evaluation
+    assert cache.run("e1", "other", 60, lambda: {"ok": False}) == ({"ok": False}, False)
+
+def test_durable_records_survive_a_restart(db_engine):
+    IdempotencyCache(engine=db_engine).run("e1", "fp", 60, lambda: {"audit_log_id": "a1"})
+    restarted = IdempotencyCache(engine=db_engine)
+    assert restarted.run("e1", "fp", 60, lambda: pytest.fail("evaluated again")) == ({"audit_log_id": "a1"}, True)
+
+def test_reused_event_id_with_another_request_is_a_conflict(client, db, make_rule):
+    make_rule("big", {"field": "event.amount", "op": ">", "value": 100})
+    request = {"event": {"amount": 500}, "context": {}, "event_id": "evt-1"}
+    first = client.post("/evaluate", json=request).json()
+    for changed in ({"event": {"amount": 5}}, {"context": {"country": "US"}}, {"chain": True},
+                    {"budget_ms": 50}, {"max_iterations": 3}):
+        response = client.post("/evaluate", json={**request, **changed})
+        assert response.status_code == 409, changed
+        assert "evt-1" in response.json()["detail"]
+    # The same request through the raw endpoint or a batch is still a replay
+    raw = client.post("/evaluate/raw", json=request)
+    assert raw.headers["Idempotent-Replay"] == "true" and raw.json() == first
+    lines = client.post("/evaluate/batch", content=json.dumps(request) + "\n" + json.dumps({**request, "context": {"a": 1}}))
+    replay, conflict = [json.loads(line) for line in lines.text.splitlines()]
+    assert replay["replayed"] is True and conflict["status"] == 409
+    assert db.query(AuditLog).count() == 1
+
+def test_conflict_with_in_flight_and_durable_requests(db_engine):
+    cache = IdempotencyCache(engine=db_engine)
+    cache.run("e1", "fp", 60, lambda: {"audit_log_id": "a1"}, "digest-a")
+    with pytest.raises(IdempotencyConflict):
+        cache.run("e1", "fp", 60, lambda: pytest.fail("evaluated again"), "digest-b")
+    restarted = IdempotencyCache(engine=db_engine)
+    with pytest.raises(IdempotencyConflict):
+        restarted.run("e1", "fp", 60, lambda: pytest.fail("evaluated again"), "digest-b")
+    assert restarted.run("e1", "fp", 60, lambda: pytest.fail("evaluated again"), "digest-a") == ({"audit_log_id": "a1"}, True)
+
+    release = threading.Event()
+    started = threading.Event()
+    leader = threading.Thread(target=lambda: cache.run("e2", "fp", 60, lambda: started.set() or release.wait(5) and {}, "digest-a"))
+    leader.start()
+    started.wait(5)
+    try:
+        with pytest.raises(IdempotencyConflict):
+            cache.run("e2", "fp", 60, lambda: pytest.fail("evaluated twice"), "digest-b")
+    finally:
+        release.set()
+        leader.join()
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import threading
+import time
+
+from results import AsyncEvaluator, ResultStore, get_result_store
+
+def test_wait_times_out_while_pending():
+    async def run():
+        store = ResultStore()
+        ticket = store.create()
+        started = time.monotonic()
+        state = await store.wait(ticket, 0.05)
+        assert state == {"ticket": ticket, "status": "pending"}
+        assert time.monotonic() - started >= 0.05
+        # The timed-out waiter is removed from the ticket
+        assert store._tickets[ticket].waiters == []
+        assert (await store.wait("missing", 1))["status"] == "unknown"
+
+    asyncio.run(run())
+
+def test_wait_returns_when_a_worker_completes():
+    release = threading.Event()
+    evaluator = AsyncEvaluator(ResultStore(), workers=2)
+
+    async def run():
+        ticket = evaluator.submit(lambda: release.wait(5) and {"matched_rules": ["a"]})
+        waiting = asyncio.create_task(evaluator.store.wait(ticket, 5))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        started = time.monotonic()
+        release.set()
+        state = await waiting
+        assert time.monotonic() - started < 1
+        assert state == {"ticket": ticket, "status": "done", "result": {"matched_rules": ["a"]}}
+        # A finished ticket answers at once
+        assert await evaluator.store.wait(ticket, 0) == state
+
+    try:
+        asyncio.run(run())
+    finally:
+        evaluator.shutdown()
+
+def test_failed_evaluation_is_reported():
+    evaluator = AsyncEvaluator(ResultStore(), workers=1)
+
+    def fail():
+        raise ValueError("bad event")
+
+    async def run():
+        ticket = evaluator.submit(fail)
+        return ticket, await evaluator.store.wait(ticket, 5)
+
+    try:
+        ticket, state = asyncio.run(run())
+    finally:
+        evaluator.shutdown()
+    assert state == {"ticket": ticket, "status": "failed", "error": "bad event"}
+
+def test_pending_submissions_are_bounded():
+    release = threading.Event()
+    evaluator = AsyncEvaluator(ResultStore(), workers=1, max_pending=2)
+    try:
+        assert evaluator.submit(lambda: release.wait(5)) is not None
+        assert evaluator.submit(lambda: release.wait(5)) is not None
+        assert evaluator.submit(lambda: {}) is None
+    finally:
+        release.set()
+        evaluator.shutdown()
+    assert evaluator.pending == 0
+
+def events(chunks):
+    return [json.loads(chunk.split("data: ", 1)[1]) for chunk in chunks if chunk.startswith("id: ")]
+
+def test_stream_sends_each_ticket_as_it_completes():
+    store = ResultStore()
+    first, second, third = store.create(), store.create(), store.create()
+    store.complete(first, {"status": "done", "result": 1})
+
+    async def run():
+        received = []
+        stream = store.stream([first, second, "missing", third, second])
+        # Tickets already final or unknown are sent at once
+        received.append(await stream.__anext__())
+        received.append(await stream.__anext__())
+        # The rest in completion order, finished from other threads
+        threading.Timer(0.02, store.complete, (third, {"status": "done", "result": 3})).start()
+        threading.Timer(0.08, store.complete, (second, {"status": "failed", "error": "x"})).start()
+        received.extend([chunk async for chunk in stream])
+        return received
+
+    received = events(asyncio.run(run()))
+    assert [(e["ticket"], e["status"]) for e in received] == [
+        (first, "done"), ("missing", "unknown"), (third, "done"), (second, "failed")]
+    assert store._tickets[second].waiters == [] and store._tickets[third].waiters == []
+
+def test_async_mode_over_http(client, make_rule):
+    rule_id = make_rule("big", {"field": "event.amount", "op": ">", "value": 100})
+    tickets = []
+    for amount in (500, 5):
+        response = client.post("/evaluate", json={"event": {"amount": amount}, "context": {}, "async_mode": True})
+        assert response.status_code == 200
+        tickets.append(response.json()["ticket"])
+
+    polled = client.get(f"/evaluate/results/{tickets[0]}", params={"wait": 5})
+    assert polled.status_code == 200
+    assert polled.json()["result"]["matched_rules"] == [rule_id]
+
+    streamed = client.get("/evaluate/results/stream", params={"tickets": ",".join(tickets)})
+    assert streamed.headers["content-type"].startswith("text/event-stream")
+    results = {e["ticket"]: e["result"]["matched_rules"] for e in events(streamed.text.split("\n\n"))}
+    assert results == {tickets[0]: [rule_id], tickets[1]: []}
+
+    assert client.get("/evaluate/results/missing").status_code == 404
+    assert client.get("/evaluate/results/stream", params={"tickets": " , "}).status_code == 400
+
+def test_long_poll_of_a_pending_ticket_is_202(client):
+    ticket = get_result_store().create()
+    response = client.get(f"/evaluate/results/{ticket}", params={"wait": 0.05})
+    assert response.status_code == 202
+    assert response.json() == {"ticket": ticket, "status": "pending"}
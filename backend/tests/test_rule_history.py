@@ -0,0 +1,81 @@
+import random
+from datetime import datetime
+
+import rule_history
+from models import AuditLog, RuleStateChange
+from rule_history import apply_delta, diff_state
+
+def random_state(rng, depth=0):
+    state = {}
+    for key in rng.sample("abcdef", rng.randint(0, 4)):
+        kind = rng.random()
+        if kind < 0.3 and depth < 3:
+            state[key] = random_state(rng, depth + 1)
+        elif kind < 0.5:
+            state[key] = [rng.randint(0, 3) for _ in range(rng.randint(0, 3))]
+        elif kind < 0.6:
+            state[key] = None
+        else:
+            state[key] = rng.choice([0, 1, "x", True, 2.5])
+    return state
+
+def test_delta_turns_old_state_into_new():
+    rng = random.Random(3)
+    for _ in range(500):
+        old, new = random_state(rng), random_state(rng)
+        assert apply_delta(old, diff_state(old, new)) == new
+
+def test_delta_only_carries_changed_paths():
+    old = {"conditions": {"field": "event.amount", "op": ">", "value": 1}, "priority": 5, "tags": ["a"]}
+    new = {"conditions": {"field": "event.amount", "op": ">", "value": 2}, "priority": 5}
+    assert diff_state(old, new) == {"set": [[["conditions", "value"], 2]], "unset": [["tags"]]}
+
+def changes(db, rule_id):
+    return [c.kind for c in db.query(RuleStateChange).filter(RuleStateChange.rule_id == rule_id).order_by(RuleStateChange.seq)]
+
+def test_history_checkpoints_periodically(client, db, make_rule, monkeypatch):
+    monkeypatch.setattr(rule_history, "CHECKPOINT_EVERY", 3)
+    rule_id = make_rule("limit", {"field": "event.amount", "op": ">", "value": 0})
+    for value in range(1, 6):
+        assert client.put(f"/rules/{rule_id}", json={"conditions": {"field": "event.amount", "op": ">", "value": value}}).status_code == 200
+    # Unchanged states are not recorded
+    client.put(f"/rules/{rule_id}", json={"tags": []})
+    assert changes(db, rule_id) == ["checkpoint", "delta", "delta", "checkpoint", "delta", "delta"]
+
+    history = client.get(f"/rules/{rule_id}/history").json()["changes"]
+    assert [c["state"]["conditions"]["value"] for c in history] == [0, 1, 2, 3, 4, 5]
+
+def test_ruleset_and_evaluation_as_of(client, make_rule, monkeypatch):
+    monkeypatch.setattr(rule_history, "CHECKPOINT_EVERY", 2)
+    event = {"event": {"amount": 50}, "context": {}}
+    rule_id = make_rule("limit", {"field": "event.amount", "op": ">", "value": 10})
+    points = [datetime.utcnow()]
+    for value in (100, 20, 200):
+        client.put(f"/rules/{rule_id}", json={"conditions": {"field": "event.amount", "op": ">", "value": value}})
+        points.append(datetime.utcnow())
+    assert client.delete(f"/rules/{rule_id}").status_code == 200
+    points.append(datetime.utcnow())
+
+    values = []
+    for at in points:
+        rules = client.get("/ruleset", params={"as_of": at.isoformat()}).json()["rules"]
+        values.append([r["conditions"]["value"] for r in rules])
+    assert values == [[10], [100], [20], [200], []]
+
+    matched = [client.post("/evaluate", json={**event, "as_of": at.isoformat()}).json()["matched_rules"] for at in points]
+    assert matched == [[rule_id], [], [rule_id], [], []]
+
+def test_raw_evaluation_as_of_replays_without_auditing(client, db, make_rule):
+    rule_id = make_rule("limit", {"field": "event.amount", "op": ">", "value": 10})
+    before = datetime.utcnow()
+    client.put(f"/rules/{rule_id}", json={"conditions": {"field": "event.amount", "op": ">", "value": 100}})
+    audited = db.query(AuditLog).count()
+
+    request = {"event": {"amount": 50}, "context": {}, "as_of": before.isoformat()}
+    response = client.post("/evaluate/raw", json=request)
+    assert response.status_code == 200
+    expected = client.post("/evaluate", json=request).json()
+    assert {**response.json(), "evaluation_time_ms": None} == {**expected, "evaluation_time_ms": None}
+    assert response.json()["matched_rules"] == [rule_id]
+    assert db.query(AuditLog).count() == audited
+    assert client.post("/evaluate/raw", json={**request, "as_of": "yesterday"}).status_code == 422
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import main
+from models import AuditLog
+from rules_client import AsyncRulesClient, RulesClient, RulesEngineError
+
+class RecordingTransport(httpx.BaseTransport):
+    """Sends requests to the app in-process, recording paths; `responses` overrides the next answers for a path"""
+
+    def __init__(self, inner: httpx.BaseTransport):
+        self.inner = inner
+        self.paths = []
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.paths.append(request.url.path)
+            canned = self.responses.get(request.url.path)
+            response = canned.pop(0) if canned else None
+        return response or self.inner.handle_request(request)
+
+@pytest.fixture
+def transport(client):
+    return RecordingTransport(client._transport)
+
+def rules_client(transport, **settings):
+    return RulesClient("http://testserver", transport=transport, **settings)
+
+@pytest.fixture
+def big_rule(make_rule):
+    make_rule("big", {"field": "event.amount", "op": ">", "value": 100})
+
+def test_concurrent_calls_are_batched(transport, big_rule):
+    results = {}
+    with rules_client(transport, batch_wait_ms=50, max_in_flight=1) as rules:
+        def call(amount):
+            results[amount] = rules.evaluate({"amount": amount})
+        threads = [threading.Thread(target=call, args=(amount,)) for amount in range(90, 110)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert {amount: result["matched_rules"] for amount, result in results.items()} == {
+        amount: ["big"] if amount > 100 else [] for amount in range(90, 110)}
+    assert "/evaluate/batch" in transport.paths
+    assert len(transport.paths) < len(threads)
+
+def test_evaluate_many_keeps_event_order(transport, big_rule):
+    events = [{"amount": amount} for amount in range(80, 130)]
+    with rules_client(transport, batch_size=7, max_in_flight=2) as rules:
+        results = list(rules.evaluate_many(events))
+    assert [r["matched_rules"] for r in results] == [["big"] if e["amount"] > 100 else [] for e in events]
+    # The last chunk is a single event, sent to /evaluate
+    assert transport.paths == ["/evaluate/batch"] * 7 + ["/evaluate"]
+
+def test_failed_event_raises_when_its_result_is_reached(transport, big_rule):
+    events = [{"amount": 500}, ({"amount": 1}, "not a context"), {"amount": 5}]
+    with rules_client(transport) as rules:
+        results = rules.evaluate_many(events)
+        assert next(results)["matched_rules"] == ["big"]
+        with pytest.raises(RulesEngineError) as error:
+            next(results)
+    assert error.value.status_code == 422
+
+def test_falls_back_to_evaluate_without_batch_endpoint(transport, big_rule):
+    transport.responses["/evaluate/batch"] = [httpx.Response(404, json={"detail": "Not Found"})]
+    events = [{"amount": 50}, {"amount": 500}, {"amount": 5000}]
+    with rules_client(transport) as rules:
+        assert [r["matched_rules"] for r in rules.evaluate_many(events)] == [[], ["big"], ["big"]]
+        assert rules.batch_supported is False
+        assert rules.evaluate({"amount": 500})["matched_rules"] == ["big"]
+    assert transport.paths == ["/evaluate/batch"] + ["/evaluate"] * 4
+
+def test_retry_after_503_replays_by_event_id(transport, db, big_rule):
+    with rules_client(transport, batching=False, backoff=0) as rules:
+        first = rules.evaluate({"amount": 500}, event_id="evt-1")
+        transport.responses["/evaluate"] = [httpx.Response(503, headers={"Retry-After": "0"})]
+        retried = rules.evaluate({"amount": 500}, event_id="evt-1")
+    assert retried == first
+    assert transport.paths == ["/evaluate"] * 3
+    assert db.query(AuditLog).count() == 1
+
+def test_batch_retry_resends_only_unresolved_events(transport, db, big_rule):
+    truncated = transport.inner.handle_request(httpx.Request(
+        "POST", "http://testserver/evaluate/batch",
+        content=b'{"event":{"amount":500},"context":{},"event_id":"evt-0"}'))
+    truncated.read()
+    transport.responses["/evaluate/batch"] = [httpx.Response(200, content=truncated.content)]
+    events = [({"amount": 500}, {}, "evt-0"), ({"amount": 1}, {}, "evt-1")]
+    with rules_client(transport, backoff=0) as rules:
+        results = list(rules.evaluate_many(events))
+    assert [r["matched_rules"] for r in results] == [["big"], []]
+    assert transport.paths == ["/evaluate/batch"] * 2
+    assert db.query(AuditLog).count() == 2
+
+def test_non_retryable_error_is_raised(transport):
+    with rules_client(transport, batching=False) as rules:
+        with pytest.raises(RulesEngineError) as error:
+            rules.simulate("missing", {"amount": 1})
+    assert error.value.status_code == 404
+
+def test_async_client_batches_gathered_calls(client, big_rule):
+    paths = []
+
+    async def record(request):
+        paths.append(request.url.path)
+
+    async def run():
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://testserver",
+                                 event_hooks={"request": [record]})
+        async with AsyncRulesClient(http_client=http, max_in_flight=1) as rules:
+            results = await asyncio.gather(*(rules.evaluate({"amount": amount}) for amount in range(95, 105)))
+            ordered = [r async for r in rules.evaluate_many([{"amount": 500}, {"amount": 5}])]
+        await http.aclose()
+        return results, ordered
+
+    results, ordered = asyncio.run(run())
+    assert [r["matched_rules"] for r in results] == [["big"] if a > 100 else [] for a in range(95, 105)]
+    assert [r["matched_rules"] for r in ordered] == [["big"], []]
+    assert "/evaluate/batch" in paths and len(paths) < 11
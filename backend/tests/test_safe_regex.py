@@ -0,0 +1,89 @@
+import re
+import time
+
+import pytest
+
+import safe_regex
+from safe_regex import compile_regex, regex_error
+
+CATASTROPHIC = [
+    r"(.*a){12}$",
+    r"(a|a)+$",
+    r"(a|aa)+$",
+    r"(a+)+$",
+    r"(\w*x?)*",
+    r"(x+x+)+y",
+    r"(a|b|ab)*c",
+    r"(\d+|x)+",
+    r"^(\w+\s?)*$",
+]
+
+POLYNOMIAL = [
+    r".*.*=.*",
+    r"a*a*a*b",
+    r".*=.*;",
+    r"\w+\s*\w+!",
+    r"(.*)(.*)x",
+    r"(?i)A*a*b",
+]
+
+SAFE = [
+    r"^[a-z]+@[a-z]+\.com$",
+    r"(a|b)+",
+    r"(ab|ac)+$",
+    r"(a|ab)+$",
+    r"(foo|bar)*baz",
+    r"^\d{3}-\d{4}$",
+    r"^(https?://)?[\w.-]+$",
+    r"(?:ab)+c",
+    r"\d+-\d+;",
+    r"^.*foo$",
+    r"\w+\s\w+!",
+]
+
+@pytest.fixture(autouse=True)
+def python_re(monkeypatch):
+    # The checks below are what protects the `re` fallback
+    monkeypatch.setattr(safe_regex, "RE2_AVAILABLE", False)
+    compile_regex.cache_clear()
+    yield
+    compile_regex.cache_clear()
+
+@pytest.mark.parametrize("pattern", CATASTROPHIC)
+def test_catastrophic_patterns_are_rejected(pattern):
+    assert regex_error(pattern) is not None
+    compiled, error = compile_regex(pattern)
+    assert compiled is None and error.startswith("unsafe regex")
+
+@pytest.mark.parametrize("pattern", POLYNOMIAL)
+def test_polynomial_patterns_are_rejected(pattern):
+    assert "quantifiers in sequence" in regex_error(pattern)
+
+@pytest.mark.parametrize("pattern", SAFE)
+def test_safe_patterns_are_accepted_and_stay_fast(pattern):
+    assert regex_error(pattern) is None
+    compiled, _ = compile_regex(pattern)
+    for text in ("a" * 40 + "!", "ab" * 30 + "!", "foobar" * 20 + "x", "1-" * 500, "a " * 500):
+        started = time.perf_counter()
+        compiled.search(text)
+        assert time.perf_counter() - started < 0.05
+
+def test_backreferences_are_rejected():
+    assert "backreferences" in regex_error(r"(a)\1")
+
+def test_invalid_and_oversized_patterns():
+    assert regex_error("(").startswith("invalid regex")
+    assert regex_error(5) == "regex value must be a string"
+    assert "longer than" in regex_error("a" * (safe_regex.MAX_PATTERN_LENGTH + 1))
+
+def test_require_re2(monkeypatch):
+    monkeypatch.setattr(safe_regex, "REQUIRE_RE2", True)
+    assert "google-re2" in regex_error("abc")
+
+def test_rule_with_unsafe_regex_is_refused(client):
+    response = client.post("/rules", json={
+        "name": "redos", "actions": [],
+        "conditions": {"field": "event.text", "op": "regex", "value": "(.*a){12}$"}
+    })
+    assert response.status_code == 400
+    assert "unsafe regex" in response.text
@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import Session
+
+from init_db import upgrade_schema
+from models import AuditLog, Base, Rule, RuleVersion
+
+# Tables as created by the first release
+FIRST_RELEASE = [
+    """CREATE TABLE rules (id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, priority INTEGER, active BOOLEAN,
+       version INTEGER, conditions JSON NOT NULL, actions JSON NOT NULL, tags JSON, stop_on_match BOOLEAN,
+       created_by VARCHAR, created_at DATETIME, updated_at DATETIME, description TEXT)""",
+    """CREATE TABLE rule_versions (id VARCHAR PRIMARY KEY, rule_id VARCHAR NOT NULL REFERENCES rules(id),
+       version INTEGER NOT NULL, conditions JSON NOT NULL, actions JSON NOT NULL, created_at DATETIME,
+       created_by VARCHAR)""",
+    """CREATE TABLE audit_logs (id VARCHAR PRIMARY KEY, event_id VARCHAR, event_type VARCHAR, event_data JSON,
+       context_data JSON, matched_rules JSON, actions_taken JSON, explanation JSON, evaluation_time_ms INTEGER,
+       created_at DATETIME)""",
+    """INSERT INTO rules (id, name, priority, active, version, conditions, actions)
+       VALUES ('old', 'old', 100, 1, 1, '{}', '[]')""",
+    """INSERT INTO rule_versions (id, rule_id, version, conditions, actions) VALUES ('old_v1', 'old', 1, '{}', '[]')""",
+]
+
+def test_tables_of_the_first_release_are_upgraded():
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'old.db')}")
+    with engine.begin() as conn:
+        for statement in FIRST_RELEASE:
+            conn.execute(text(statement))
+
+    Base.metadata.create_all(bind=engine)
+    assert set(upgrade_schema(engine)) == {"rules.parameter_keys", "rules.decision_table",
+                                            "rule_versions.shadow", "rule_versions.sample_rate"}
+    assert upgrade_schema(engine) == []
+    indexes = {index["name"] for index in inspect(engine).get_indexes("audit_logs")}
+    assert {index.name for index in AuditLog.__table__.indexes} <= indexes
+
+    with Session(engine) as db:
+        rule = db.query(Rule).one()
+        assert rule.parameter_keys is None and rule.decision_table is None
+        assert db.query(RuleVersion).filter(RuleVersion.shadow == True).count() == 0
+        assert db.query(RuleVersion).filter(RuleVersion.shadow == False).count() == 1
+        db.add(AuditLog(id="a1", event_data={}))
+        db.commit()
+        assert db.query(AuditLog).one().created_at is not None
@@ -0,0 +1,44 @@
+import math
+import time
+
+import pytest
+
+import windows
+from windows import DistinctTracker, parse_duration
+
+def test_distinct_tracker_evicts_stalest_value_at_cap(monkeypatch):
+    monkeypatch.setattr(windows, "MAX_DISTINCT_PER_KEY", 3)
+    tracker = DistinctTracker()
+    for value, ts in (("a", 1), ("b", 2), ("c", 3), ("a", 4), ("d", 5)):
+        tracker.add(value, ts)
+    assert list(tracker.seen) == ["c", "a", "d"]
+    assert tracker.count(cutoff=3) == 2
+    assert tracker.count(cutoff=5) == 0
+
+def test_distinct_tracker_keeps_latest_sighting():
+    tracker = DistinctTracker()
+    tracker.add("a", 10)
+    tracker.add("a", 5)
+    assert tracker.seen["a"] == 10 and tracker.last_seen == 10
+
+def test_distinct_tracker_stays_fast_at_cap(monkeypatch):
+    monkeypatch.setattr(windows, "MAX_DISTINCT_PER_KEY", 10000)
+    tracker = DistinctTracker()
+    started = time.perf_counter()
+    for i in range(50000):
+        tracker.add(i, float(i))
+    assert time.perf_counter() - started < 1.0
+    assert len(tracker.seen) == 10000 and next(iter(tracker.seen)) == 40000
+
+def test_durations():
+    assert [parse_duration(v) for v in ("30s", "10m", "1.5h", "7d", 45, 0.5)] == [30, 600, 5400, 604800, 45, 0.5]
+
+@pytest.mark.parametrize("value", ["nanm", "infm", "-infh", "0s", "-5m", "10", "10w", "", math.nan, math.inf, 0, True, None])
+def test_invalid_durations_are_rejected(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+def test_rules_with_non_finite_windows_are_rejected(client):
+    response = client.post("/rules", json={"name": "velocity", "actions": [], "conditions": {
+        "fn": "count_over", "args": ["event.card", "nanm"], "op": ">=", "value": 3}})
+    assert response.status_code == 400
@@ -0,0 +1,123 @@
+"""
+Shared value sets for large `in` / `not_in` membership clauses
+
+Rules reference a set by name instead of inlining the values:
+    {"field": "event.card_id", "op": "in", "value_set": "blocked_cards"}
+    {"field": "event.card_id", "op": "in", "value_set": "blocked_cards", "value_set_version": 3}
+
+Each (name, version) is loaded once into a frozenset and shared by every rule
+that references it, so membership is O(1) and memory is paid once per set.
+"""
+import threading
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_OPS = ("in", "not_in")
+
+class MembershipSet:
+    """An immutable, loaded version of a named value set"""
+    __slots__ = ("name", "version", "members")
+
+    def __init__(self, name: str, version: int, values: Iterable[Any]):
+        self.name = name
+        self.version = version
+        self.members = frozenset(values)
+
+    def __contains__(self, item: Any) -> bool:
+        return item in self.members
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+class ValueSetRegistry:
+    """Process-wide cache of loaded value sets keyed by (name, version)"""
+
+    def __init__(self):
+        self._sets: Dict[Tuple[str, int], MembershipSet] = {}
+        self._latest: Dict[str, int] = {}
+        self._held: Dict[str, Set[Tuple[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, version: Optional[int] = None) -> Optional[MembershipSet]:
+        """Return a loaded set; without a version the latest loaded one is used"""
+        if version is None:
+            version = self._latest.get(name)
+            if version is None:
+                return None
+        return self._sets.get((name, version))
+
+    def contains(self, name: str, version: Optional[int] = None) -> bool:
+        return self.get(name, version) is not None
+
+    def put(self, name: str, version: int, values: Iterable[Any]) -> MembershipSet:
+        """Register a set version, reusing the existing frozenset if already loaded"""
+        with self._lock:
+            loaded = self._sets.get((name, version))
+            if loaded is None:
+                loaded = MembershipSet(name, version, values)
+                self._sets[(name, version)] = loaded
+                logger.info(f"Loaded value set {name} v{version} ({len(loaded)} values)")
+            return loaded
+
+    def set_latest(self, name: str, version: int):
+        """Point unpinned references to `name` at a loaded version"""
+        with self._lock:
+            if (name, version) in self._sets:
+                self._latest[name] = version
+
+    def export(self, keys: Set[Tuple[str, int]]) -> List[Tuple[str, int, List[Any], bool]]:
+        """(name, version, values, is_latest) for loaded sets, for rebuilding the registry in another process"""
+        with self._lock:
+            return [
+                (name, version, list(self._sets[(name, version)].members), self._latest.get(name) == version)
+                for name, version in keys if (name, version) in self._sets
+            ]
+
+    def hold(self, owner: str, keys: Set[Tuple[str, int]]):
+        """Keep `keys` loaded across retain() calls on behalf of `owner` (replacing its previous hold)"""
+        with self._lock:
+            self._held[owner] = set(keys)
+
+    def retain(self, keys: Set[Tuple[str, int]]):
+        """Drop loaded sets that are no longer referenced by the active ruleset or held"""
+        with self._lock:
+            keys = set(keys).union(*self._held.values())
+            for key in list(self._sets):
+                if key not in keys:
+                    del self._sets[key]
+            for name, version in list(self._latest.items()):
+                if (name, version) not in self._sets:
+                    del self._latest[name]
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+            self._latest.clear()
+
+def collect_value_set_refs(condition: Dict, refs: Optional[List] = None) -> List[Tuple[str, Optional[int]]]:
+    """Collect (name, version) references to value sets from a condition AST"""
+    if refs is None:
+        refs = []
+    if not isinstance(condition, dict):
+        return refs
+    for clause in condition.get("clauses", []) or []:
+        collect_value_set_refs(clause, refs)
+    if "value_set" in condition:
+        refs.append((condition["value_set"], condition.get("value_set_version")))
+    return refs
+
+def validate_values(values: List[Any]) -> Optional[str]:
+    """Return an error message if the values cannot be stored in a value set"""
+    for v in values:
+        if isinstance(v, (list, dict)):
+            return f"Value set members must be scalars, got {type(v).__name__}"
+    return None
+
+# Global registry instance
+_registry = ValueSetRegistry()
+
+def get_value_set_registry() -> ValueSetRegistry:
+    """Get the process-wide value set registry"""
+    return _registry
@@ -0,0 +1,352 @@
+"""
+Sliding-window aggregate functions for velocity rules
+
+    {"fn": "count_over", "args": ["event.card_id", "10m"], "op": ">", "value": 5}
+    {"fn": "sum_over", "args": ["event.card_id", "event.amount", "1h"], "op": ">", "value": 10000}
+    {"fn": "distinct_count_over", "args": ["event.card_id", "event.country", "1d"], "op": ">=", "value": 3}
+
+Every evaluated event is recorded in the windows referenced by the active ruleset, in the
+same pass that evaluates it, so the aggregates include the current event. Counts and sums
+are kept in a per-key ring of time buckets; distinct counts keep the last time each value
+was seen. Keys expire once their window has passed and each window keeps at most
+WINDOW_MAX_KEYS keys (least recently updated keys are evicted first).
+
+State lives in process memory and can be snapshotted to WINDOW_SNAPSHOT_PATH.
+"""
+import json
+import math
+import os
+import threading
+import time
+import logging
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WINDOW_FUNCTIONS = ("count_over", "sum_over", "distinct_count_over")
+BUCKETS_PER_WINDOW = int(os.getenv("WINDOW_BUCKETS", "60"))
+MAX_KEYS_PER_WINDOW = int(os.getenv("WINDOW_MAX_KEYS", "100000"))
+MAX_DISTINCT_PER_KEY = int(os.getenv("WINDOW_MAX_DISTINCT", "10000"))
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(value: Any) -> float:
+    """Parse "30s", "10m", "1h", "7d" or a number of seconds"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = float(value)
+    elif isinstance(value, str) and value[-1:] in _UNITS:
+        seconds = float(value[:-1]) * _UNITS[value[-1]]
+    else:
+        raise ValueError(f"Invalid window: {value!r}")
+    # float() accepts "nan" and "inf", which would make windows that never expire or never match
+    if not math.isfinite(seconds):
+        raise ValueError(f"Invalid window: {value!r}")
+    if seconds <= 0:
+        raise ValueError(f"Window must be positive: {value!r}")
+    return seconds
+
+class WindowSpec:
+    """One windowed aggregate: function, key field, optional value field and window size"""
+    __slots__ = ("fn", "key_field", "value_field", "window", "seconds", "id")
+
+    def __init__(self, fn: str, key_field: str, value_field: Optional[str], window: Any):
+        self.fn = fn
+        self.key_field = key_field
+        self.value_field = value_field
+        self.window = window
+        self.seconds = parse_duration(window)
+        self.id = f"{fn}:{key_field}:{value_field or ''}:{self.seconds:g}"
+
+    @classmethod
+    def from_condition(cls, condition: Dict) -> "WindowSpec":
+        fn = condition.get("fn")
+        args = condition.get("args", [])
+        if fn == "count_over":
+            if len(args) != 2:
+                raise ValueError("count_over requires (key_field, window)")
+            return cls(fn, args[0], None, args[1])
+        if fn in ("sum_over", "distinct_count_over"):
+            if len(args) != 3:
+                raise ValueError(f"{fn} requires (key_field, value_field, window)")
+            return cls(fn, args[0], args[1], args[2])
+        raise ValueError(f"Not a window function: {fn}")
+
+class BucketRing:
+    """Fixed ring of time buckets holding counts or sums"""
+    __slots__ = ("epochs", "totals", "last_seen")
+
+    def __init__(self, size: int):
+        self.epochs = array("q", [-1] * size)
+        self.totals = array("d", [0.0] * size)
+        self.last_seen = 0.0
+
+    def add(self, epoch: int, amount: float, ts: float):
+        i = epoch % len(self.epochs)
+        if self.epochs[i] != epoch:
+            self.epochs[i] = epoch
+            self.totals[i] = 0.0
+        self.totals[i] += amount
+        self.last_seen = max(self.last_seen, ts)
+
+    def total(self, current_epoch: int) -> float:
+        oldest = current_epoch - len(self.epochs)
+        return sum(t for e, t in zip(self.epochs, self.totals) if oldest < e <= current_epoch)
+
+class DistinctTracker:
+    """
+    Last time each distinct value was seen for one key.
+    Values are kept in order of last sighting, so the stalest is always at the front.
+    """
+    __slots__ = ("seen", "last_seen")
+
+    def __init__(self):
+        self.seen: "OrderedDict[Any, float]" = OrderedDict()
+        self.last_seen = 0.0
+
+    def add(self, value: Any, ts: float):
+        seen = self.seen
+        previous = seen.get(value)
+        if previous is None:
+            if len(seen) >= MAX_DISTINCT_PER_KEY:
+                # Drop the stalest value to stay within the cap
+                seen.popitem(last=False)
+            seen[value] = ts
+        elif ts >= previous:
+            seen[value] = ts
+            seen.move_to_end(value)
+        self.last_seen = max(self.last_seen, ts)
+
+    def count(self, cutoff: float) -> int:
+        seen = self.seen
+        while seen:
+            value, ts = next(iter(seen.items()))
+            if ts > cutoff:
+                break
+            seen.popitem(last=False)
+        return len(seen)
+
+class Window:
+    """State of one WindowSpec across all keys"""
+
+    def __init__(self, spec: WindowSpec):
+        self.spec = spec
+        self.width = spec.seconds / BUCKETS_PER_WINDOW
+        self.keys: "OrderedDict[Any, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key: Any, value: Any, now: float):
+        spec = self.spec
+        with self.lock:
+            state = self.keys.get(key)
+            if state is None:
+                state = DistinctTracker() if spec.fn == "distinct_count_over" else BucketRing(BUCKETS_PER_WINDOW)
+                self.keys[key] = state
+            else:
+                self.keys.move_to_end(key)
+
+            if spec.fn == "distinct_count_over":
+                state.add(value, now)
+            else:
+                amount = 1.0 if spec.fn == "count_over" else float(value)
+                state.add(int(now // self.width), amount, now)
+            self._evict(now)
+
+    def query(self, key: Any, now: float) -> float:
+        with self.lock:
+            state = self.keys.get(key)
+            if state is None:
+                return 0
+            if self.spec.fn == "distinct_count_over":
+                return state.count(now - self.spec.seconds)
+            total = state.total(int(now // self.width))
+            return int(total) if self.spec.fn == "count_over" else total
+
+    def _evict(self, now: float):
+        cutoff = now - self.spec.seconds
+        keys = self.keys
+        # Keys are ordered by last update, so expired ones are at the front
+        while keys:
+            oldest_key = next(iter(keys))
+            if keys[oldest_key].last_seen > cutoff and len(keys) <= MAX_KEYS_PER_WINDOW:
+                break
+            keys.popitem(last=False)
+
+class WindowStore:
+    """All windows referenced by the active ruleset"""
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self._windows: Dict[str, Window] = {}
+        self._lock = threading.Lock()
+        # Replays use a clock that follows the replayed events' timestamps
+        self.clock = clock
+
+    def _window(self, spec: WindowSpec) -> Window:
+        window = self._windows.get(spec.id)
+        if window is None:
+            with self._lock:
+                window = self._windows.setdefault(spec.id, Window(spec))
+        return window
+
+    def observe(self, observations: Iterable[Tuple[WindowSpec, Any, Any]], now: Optional[float] = None):
+        """Record (spec, key, value) observations for the current event"""
+        now = self.clock() if now is None else now
+        for spec, key, value in observations:
+            try:
+                self._window(spec).add(key, value, now)
+            except (TypeError, ValueError):
+                # Unhashable keys or non-numeric sums are not tracked
+                continue
+
+    def query(self, spec: WindowSpec, key: Any, now: Optional[float] = None) -> float:
+        now = self.clock() if now is None else now
+        try:
+            return self._window(spec).query(key, now)
+        except TypeError:
+            return 0
+
+    def stats(self) -> Dict[str, int]:
+        return {spec_id: len(w.keys) for spec_id, w in self._windows.items()}
+
+    # ========== SNAPSHOTS ==========
+
+    def snapshot(self, path: str):
+        """Atomically write all window state to a local JSON file"""
+        data = []
+        for window in list(self._windows.values()):
+            spec = window.spec
+            with window.lock:
+                if spec.fn == "distinct_count_over":
+                    keys = [[k, list(s.seen.items())] for k, s in window.keys.items()]
+                else:
+                    keys = [[k, list(s.epochs), list(s.totals), s.last_seen] for k, s in window.keys.items()]
+            data.append({
+                "fn": spec.fn,
+                "key_field": spec.key_field,
+                "value_field": spec.value_field,
+                "window": spec.window,
+                "buckets": BUCKETS_PER_WINDOW,
+                "keys": keys
+            })
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"saved_at": time.time(), "windows": data}, f)
+        os.replace(tmp, path)
+
+    def restore(self, path: str) -> int:
+        """Load window state written by snapshot(); returns the number of windows restored"""
+        with open(path) as f:
+            data = json.load(f)
+        restored = 0
+        for entry in data.get("windows", []):
+            if entry.get("buckets") != BUCKETS_PER_WINDOW:
+                logger.warning(f"Skipping window snapshot with {entry.get('buckets')} buckets")
+                continue
+            spec = WindowSpec(entry["fn"], entry["key_field"], entry["value_field"], entry["window"])
+            window = self._window(spec)
+            with window.lock:
+                for item in entry["keys"]:
+                    if spec.fn == "distinct_count_over":
+                        key, seen = item
+                        state = DistinctTracker()
+                        for value, ts in sorted(seen, key=lambda item: item[1]):
+                            state.add(value, ts)
+                    else:
+                        key, epochs, totals, last_seen = item
+                        state = BucketRing(BUCKETS_PER_WINDOW)
+                        state.epochs = array("q", epochs)
+                        state.totals = array("d", totals)
+                        state.last_seen = last_seen
+                    window.keys[key] = state
+            restored += 1
+        return restored
+
+def collect_window_specs(condition: Dict, specs: Optional[Dict[str, WindowSpec]] = None) -> Dict[str, WindowSpec]:
+    """Collect the window functions used in a condition AST, keyed by spec id"""
+    if specs is None:
+        specs = {}
+    if not isinstance(condition, dict):
+        return specs
+    for clause in condition.get("clauses", []) or []:
+        collect_window_specs(clause, specs)
+    if condition.get("fn") in WINDOW_FUNCTIONS:
+        try:
+            spec = WindowSpec.from_condition(condition)
+            specs[spec.id] = spec
+        except ValueError:
+            pass
+    return specs
+
+# Global store instance
+_store = WindowStore()
+
+# Store used instead of the global one in the current thread/task (see use_window_store)
+_override: ContextVar[Optional[WindowStore]] = ContextVar("window_store", default=None)
+
+def get_window_store() -> WindowStore:
+    """Get the window store: the process-wide one unless use_window_store() is in effect"""
+    store = _override.get()
+    return _store if store is None else store
+
+@contextmanager
+def use_window_store(store: WindowStore):
+    """Evaluate against `store` instead of the process-wide windows in this thread/task"""
+    token = _override.set(store)
+    try:
+        yield store
+    finally:
+        _override.reset(token)
+
+class SnapshotWriter:
+    """Background thread that periodically snapshots the window store"""
+
+    def __init__(self, store: WindowStore, path: str, interval: float):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="window-snapshots", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.save()
+
+    def save(self):
+        try:
+            self.store.snapshot(self.path)
+        except Exception as e:
+            logger.error(f"Failed to snapshot windows to {self.path}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self.save()
+
+_snapshot_writer: Optional[SnapshotWriter] = None
+
+def start_snapshots():
+    """Restore window state and start periodic snapshots if WINDOW_SNAPSHOT_PATH is set"""
+    global _snapshot_writer
+    path = os.getenv("WINDOW_SNAPSHOT_PATH")
+    if not path or _snapshot_writer is not None:
+        return
+    if os.path.exists(path):
+        try:
+            restored = _store.restore(path)
+            logger.info(f"Restored {restored} windows from {path}")
+        except Exception as e:
+            logger.error(f"Failed to restore windows from {path}: {e}")
+    _snapshot_writer = SnapshotWriter(_store, path, float(os.getenv("WINDOW_SNAPSHOT_INTERVAL", "60")))
+    _snapshot_writer.start()
+
+def stop_snapshots():
+    """Write a final snapshot and stop the background writer"""
+    global _snapshot_writer
+    if _snapshot_writer is not None:
+        _snapshot_writer.stop()
+        _snapshot_writer = None